@@ -0,0 +1,221 @@
+"""Admission control for expensive endpoints.
+
+Each configured route gets:
+  * a concurrency limit: at most ``concurrency`` requests run at once and up
+    to ``max_queue`` more wait for a slot. A request that waits longer than
+    ``queue_timeout`` seconds, or finds the queue full, gets 503.
+  * a token-bucket rate limit per client IP: ``rate`` requests per second
+    with bursts of up to ``burst``. Clients over the limit get 429. Link
+    tokens in the query string aren't checked until the endpoint runs, so
+    they never select the bucket; a client could otherwise send a new random
+    ``token`` with each request to dodge the limit.
+
+Both rejections carry a ``Retry-After`` header. Limits are enforced per worker
+process. Behind a reverse proxy, run uvicorn with ``--proxy-headers`` so the
+client IP is the real one rather than the proxy's.
+
+Unconfigured routes, such as ``/api/calculator``, pass straight through, so
+cheap reads keep their latency while heavy writes are throttled.
+"""
+from collections import OrderedDict
+from dataclasses import dataclass
+from math import ceil
+from time import monotonic
+from typing import Optional
+import asyncio
+import json
+
+from metrics import REGISTRY
+
+admission_requests = REGISTRY.counter(
+    "loanease_admission_requests",
+    "Requests seen by admission control, by route and outcome",
+    ("route", "outcome"),
+)
+admission_in_flight = REGISTRY.gauge(
+    "loanease_admission_in_flight",
+    "Requests currently holding a concurrency slot, by route",
+    ("route",),
+)
+admission_queued = REGISTRY.gauge(
+    "loanease_admission_queued",
+    "Requests waiting for a concurrency slot, by route",
+    ("route",),
+)
+admission_queue_wait = REGISTRY.histogram(
+    "loanease_admission_queue_wait_seconds",
+    "Time admitted requests spent waiting for a concurrency slot, by route",
+    ("route",),
+)
+
+
+@dataclass
+class RoutePolicy:
+    concurrency: Optional[int] = None
+    max_queue: int = 100
+    queue_timeout: float = 1.0
+    rate: Optional[float] = None
+    burst: int = 1
+
+
+# Keyed by "METHOD /route/template"
+DEFAULT_POLICIES = {
+    "POST /api/applications/{application_id}/upload-document": RoutePolicy(
+        concurrency=8, max_queue=32, queue_timeout=5.0, rate=1.0, burst=10
+    ),
+    "POST /api/applications": RoutePolicy(concurrency=32, max_queue=256, queue_timeout=2.0, rate=0.5, burst=5),
+    "POST /api/applications/accept-loan": RoutePolicy(concurrency=16, max_queue=64, queue_timeout=2.0, rate=0.5, burst=5),
+    "GET /api/applications/{application_id}/documents.zip": RoutePolicy(concurrency=4, max_queue=16, queue_timeout=5.0),
+}
+
+
+def load_policies(raw):
+    """Parse ``ADMISSION_POLICIES`` JSON, e.g. ``{"POST /api/applications": {"concurrency": 16}}``.
+
+    Entries override the defaults route by route; ``null`` removes a default.
+    """
+    policies = dict(DEFAULT_POLICIES)
+    for key, value in (json.loads(raw) if raw else {}).items():
+        if value is None:
+            policies.pop(key, None)
+        else:
+            policies[key] = RoutePolicy(**value)
+    return policies
+
+
+class TokenBuckets:
+    """Per-client token buckets, bounded to the ``max_clients`` most recently seen"""
+
+    def __init__(self, rate, burst, max_clients=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+
+    def take(self, client, now):
+        """Consume a token; return 0 when allowed, else seconds until one is available"""
+        tokens, last = self._buckets.pop(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens >= 1:
+            self._buckets[client] = (tokens - 1, now)
+            retry_after = 0.0
+        else:
+            self._buckets[client] = (tokens, now)
+            retry_after = (1 - tokens) / self.rate
+        if len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+
+class RouteLimiter:
+    def __init__(self, label, policy):
+        self.label = label
+        self.policy = policy
+        self.semaphore = asyncio.Semaphore(policy.concurrency) if policy.concurrency else None
+        self.waiting = 0
+        self.buckets = TokenBuckets(policy.rate, policy.burst) if policy.rate else None
+
+
+def _client_key(scope):
+    client = scope.get("client")
+    return "ip:" + (client[0] if client else "unknown")
+
+
+async def _reject(send, status_code, detail, retry_after):
+    body = json.dumps({"detail": detail}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status_code,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(max(1, ceil(retry_after))).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class AdmissionMiddleware:
+    """Pure ASGI middleware applying per-route concurrency and rate limits"""
+
+    def __init__(self, app, policies):
+        self.app = app
+        self.policies = policies
+        self._limiters = None
+
+    def _resolve(self, scope):
+        # Map configured templates to the app's compiled route regexes on first use
+        if self._limiters is None:
+            self._limiters = []
+            for route in scope["app"].router.routes:
+                for method in getattr(route, "methods", None) or ():
+                    key = f"{method} {route.path}"
+                    if key in self.policies:
+                        limiter = RouteLimiter(route.path, self.policies[key])
+                        self._limiters.append((method, route.path_regex, route.endpoint, limiter))
+        path = scope["path"]
+        method = scope["method"]
+        for route_method, regex, endpoint, limiter in self._limiters:
+            if route_method == method and regex.match(path):
+                return endpoint, limiter
+        return None, None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        endpoint, limiter = self._resolve(scope)
+        if limiter is None:
+            await self.app(scope, receive, send)
+            return
+
+        label = limiter.label
+        policy = limiter.policy
+
+        if limiter.buckets is not None:
+            retry_after = limiter.buckets.take(_client_key(scope), monotonic())
+            if retry_after:
+                admission_requests.inc(label, "rate_limited")
+                # Lets the metrics middleware label the rejection with its route
+                scope["endpoint"] = endpoint
+                await _reject(send, 429, "Too many requests, please retry later", retry_after)
+                return
+
+        semaphore = limiter.semaphore
+        if semaphore is None:
+            admission_requests.inc(label, "admitted")
+            await self.app(scope, receive, send)
+            return
+
+        if semaphore.locked():
+            if limiter.waiting >= policy.max_queue:
+                admission_requests.inc(label, "queue_full")
+                scope["endpoint"] = endpoint
+                await _reject(send, 503, "Server busy, please retry later", policy.queue_timeout)
+                return
+            limiter.waiting += 1
+            admission_queued.inc(label)
+            start = monotonic()
+            try:
+                await asyncio.wait_for(semaphore.acquire(), policy.queue_timeout)
+            except asyncio.TimeoutError:
+                admission_requests.inc(label, "queue_timeout")
+                scope["endpoint"] = endpoint
+                await _reject(send, 503, "Server busy, please retry later", policy.queue_timeout)
+                return
+            finally:
+                limiter.waiting -= 1
+                admission_queued.dec(label)
+            admission_queue_wait.observe(monotonic() - start, label)
+        else:
+            await semaphore.acquire()
+            admission_queue_wait.observe(0.0, label)
+
+        admission_requests.inc(label, "admitted")
+        admission_in_flight.inc(label)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            admission_in_flight.dec(label)
+            semaphore.release()
@@ -0,0 +1,297 @@
+"""Pre-aggregated application analytics.
+
+``application_rollups`` holds one document per hour and per day, plus one
+``total`` document, updated with ``$inc`` upserts as applications are created
+and change status. Two kinds of counters live in each bucket:
+
+  cohort      applications created in the bucket: ``applications``,
+              ``requested_amount``, ``states``, ``employment_statuses``,
+              ``statuses`` (their current status) and ``approved_amount``
+              (requested amount of those currently approved). A status change
+              moves the application between statuses of its creation bucket.
+  transitions status changes made during the bucket: ``entered`` (per new
+              status) and ``entered_approved_amount``.
+
+Summing cohort counters over the ``total`` document gives what the dashboard
+used to count over the whole collection, and a time range reads one document
+per bucket instead of scanning applications.
+
+The counters are derived data, written after the application itself. Cohort
+counters of applications created before rollups existed, or left out by a
+failed write, are rebuilt with:
+    python analytics.py --backfill
+Run it while status changes are paused (e.g. during a deploy), since changes
+made during the rebuild can be counted twice or not at all. Until it has run
+on a deployment that already had applications, ``totals`` returns None and
+the dashboard counts over the collection as before; a deployment that starts
+with no applications has nothing to rebuild and is marked as rebuilt.
+"""
+from datetime import datetime, timedelta, timezone
+import re
+import uuid
+
+from pymongo import UpdateOne
+
+COLLECTION = "application_rollups"
+
+# Granularity -> bucket length
+GRANULARITIES = {
+    "hour": timedelta(hours=1),
+    "day": timedelta(days=1),
+}
+
+# Longest range one query may cover, in buckets
+MAX_BUCKETS = 2000
+
+# Buckets covered when a query gives no start
+DEFAULT_BUCKETS = {
+    "hour": 48,
+    "day": 30,
+}
+
+# Cohort counters, which the backfill rebuilds
+COHORT_FIELDS = ("applications", "requested_amount", "approved_amount", "states", "employment_statuses", "statuses")
+TRANSITION_FIELDS = ("entered", "entered_approved_amount")
+
+# Counters keyed by a dimension value
+MAP_FIELDS = {"states", "employment_statuses", "statuses", "entered"}
+
+
+async def ensure_indexes(db):
+    await db[COLLECTION].create_index([("granularity", 1), ("start", 1)], unique=True)
+    if not await db.loan_applications.find_one({}, {"_id": 1}):
+        # Every application will be counted as it is created, so there is nothing to backfill
+        await db[COLLECTION].update_one(
+            {"_id": "total"},
+            {"$setOnInsert": {"granularity": "total", "start": None, "cohort_rebuild": "empty"}},
+            upsert=True,
+        )
+
+
+def dimension_key(value):
+    """A dimension value usable as a field name: lowercased, other than letters, digits and _ replaced"""
+    key = re.sub(r"[^a-z0-9_]+", "_", str(value or "").strip().lower()).strip("_")[:40]
+    return key or "unknown"
+
+
+def state_key(value):
+    """States are counted by their uppercase postal code"""
+    return dimension_key(value).upper()
+
+
+def bucket_start(moment, granularity):
+    moment = moment.astimezone(timezone.utc)
+    if granularity == "hour":
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def as_utc(value):
+    """A datetime or ISO-8601 string as an aware datetime; naive values are taken as UTC"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def _bucket_ids(moment):
+    """(_id, granularity, start) of every rollup a moment counts towards"""
+    for granularity in GRANULARITIES:
+        start = bucket_start(moment, granularity)
+        yield f"{granularity}:{start.isoformat()}", granularity, start
+    yield "total", "total", None
+
+
+def _add(increments, moment, counters):
+    for bucket_id, granularity, start in _bucket_ids(moment):
+        bucket = increments.setdefault(bucket_id, (granularity, start, {}))[2]
+        for field, amount in counters.items():
+            bucket[field] = bucket.get(field, 0) + amount
+
+
+async def _apply(db, increments):
+    await db[COLLECTION].bulk_write([
+        UpdateOne(
+            {"_id": bucket_id},
+            {"$inc": counters, "$setOnInsert": {"granularity": granularity, "start": start}},
+            upsert=True,
+        )
+        for bucket_id, (granularity, start, counters) in increments.items()
+    ], ordered=False)
+
+
+def _cohort_counters(application, sign=1):
+    amount = application.get("loan_amount_requested") or 0
+    status = dimension_key(application.get("status"))
+    counters = {
+        "applications": sign,
+        "requested_amount": sign * amount,
+        f"states.{state_key(application.get('state'))}": sign,
+        f"employment_statuses.{dimension_key(application.get('employment_status'))}": sign,
+        f"statuses.{status}": sign,
+    }
+    if status == "approved":
+        counters["approved_amount"] = sign * amount
+    return counters
+
+
+async def record_created(db, application):
+    """Count a newly inserted application"""
+    increments = {}
+    _add(increments, as_utc(application["created_at"]), _cohort_counters(application))
+    await _apply(db, increments)
+
+
+async def record_status_change(db, application, new_status, changed_at):
+    """Count a status change of ``application``, given as it was before the change"""
+    old_status = dimension_key(application.get("status"))
+    new_status = dimension_key(new_status)
+    amount = application.get("loan_amount_requested") or 0
+    cohort = {f"statuses.{old_status}": -1, f"statuses.{new_status}": 1}
+    if old_status == "approved":
+        cohort["approved_amount"] = -amount
+    if new_status == "approved":
+        cohort["approved_amount"] = amount
+    transition = {f"entered.{new_status}": 1}
+    if new_status == "approved":
+        transition["entered_approved_amount"] = amount
+
+    increments = {}
+    _add(increments, as_utc(application["created_at"]), cohort)
+    _add(increments, changed_at, transition)
+    await _apply(db, increments)
+
+
+def _merge(target, source):
+    for field, value in source.items():
+        if isinstance(value, dict):
+            _merge(target.setdefault(field, {}), value)
+        elif isinstance(value, (int, float)):
+            target[field] = target.get(field, 0) + value
+
+
+def _public(bucket):
+    result = {"start": bucket["start"]}
+    for field in COHORT_FIELDS + TRANSITION_FIELDS:
+        if field in MAP_FIELDS:
+            # Counters a status change moved to zero are left in place; they add nothing
+            result[field] = {key: count for key, count in bucket.get(field, {}).items() if count}
+        else:
+            result[field] = bucket.get(field, 0)
+    return result
+
+
+async def read_range(db, granularity, start, end):
+    """Non-empty buckets starting in ``[start, end)``, oldest first, and their sum"""
+    start, end = as_utc(start), as_utc(end)
+    buckets = await db[COLLECTION].find(
+        {"granularity": granularity, "start": {"$gte": bucket_start(start, granularity), "$lt": end}},
+        {"_id": 0},
+    ).sort("start", 1).to_list(MAX_BUCKETS + 1)
+    buckets = [_public(bucket) for bucket in buckets]
+    totals = {}
+    for bucket in buckets:
+        _merge(totals, {field: value for field, value in bucket.items() if field != "start"})
+    return buckets, _public({"start": None, **totals})
+
+
+async def totals(db):
+    """All-time counters from the ``total`` rollup; None until its cohort counters were backfilled"""
+    total = await db[COLLECTION].find_one({"_id": "total"})
+    if total is None or "cohort_rebuild" not in total:
+        return None
+    return _public(total)
+
+
+async def count_totals(db):
+    """The counters ``totals`` reads, counted over ``loan_applications`` instead"""
+    groups = await db.loan_applications.aggregate([
+        {"$group": {"_id": "$status", "count": {"$sum": 1}, "amount": {"$sum": "$loan_amount_requested"}}},
+    ]).to_list(None)
+    statuses = {}
+    for group in groups:
+        _merge(statuses, {dimension_key(group["_id"]): group["count"]})
+    return {
+        "applications": sum(group["count"] for group in groups),
+        "requested_amount": sum(group["amount"] for group in groups),
+        "approved_amount": sum(group["amount"] for group in groups if dimension_key(group["_id"]) == "approved"),
+        "statuses": statuses,
+    }
+
+
+async def backfill(db, batch_size=1000):
+    """Rebuild cohort counters of every bucket from ``loan_applications``; returns the buckets written"""
+    # created_at is an ISO-8601 UTC string, so its first 13 characters name the hour
+    groups = db.loan_applications.aggregate([
+        {"$group": {
+            "_id": {
+                "hour": {"$substrCP": ["$created_at", 0, 13]},
+                "state": "$state",
+                "employment_status": "$employment_status",
+                "status": "$status",
+            },
+            "count": {"$sum": 1},
+            "amount": {"$sum": "$loan_amount_requested"},
+        }},
+    ], allowDiskUse=True)
+
+    buckets = {}
+    async for group in groups:
+        key = group["_id"]
+        moment = datetime.fromisoformat(key["hour"] + ":00").replace(tzinfo=timezone.utc)
+        status = dimension_key(key["status"])
+        counters = {
+            "applications": group["count"],
+            "requested_amount": group["amount"],
+            "approved_amount": group["amount"] if status == "approved" else 0,
+            "states": {state_key(key["state"]): group["count"]},
+            "employment_statuses": {dimension_key(key["employment_status"]): group["count"]},
+            "statuses": {status: group["count"]},
+        }
+        for bucket_id, granularity, start in _bucket_ids(moment):
+            _merge(buckets.setdefault(bucket_id, {"granularity": granularity, "start": start}), counters)
+
+    rebuild = uuid.uuid4().hex
+    requests = [
+        UpdateOne(
+            {"_id": bucket_id},
+            {"$set": {**{field: bucket.get(field, 0) for field in COHORT_FIELDS}, "cohort_rebuild": rebuild},
+             "$setOnInsert": {"granularity": bucket["granularity"], "start": bucket["start"]}},
+            upsert=True,
+        )
+        for bucket_id, bucket in buckets.items()
+    ]
+    for offset in range(0, len(requests), batch_size):
+        await db[COLLECTION].bulk_write(requests[offset:offset + batch_size], ordered=False)
+    # Buckets whose applications are all gone keep only their transition counters
+    await db[COLLECTION].update_many(
+        {"cohort_rebuild": {"$ne": rebuild}},
+        {"$unset": {field: "" for field in COHORT_FIELDS}}
+    )
+    return len(requests)
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+    import os
+    from pathlib import Path
+
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Manage the application analytics rollups")
+    parser.add_argument("--backfill", action="store_true", help="rebuild cohort counters from the applications")
+    args = parser.parse_args()
+
+    async def main():
+        load_dotenv(Path(__file__).parent / '.env')
+        client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+        db = client[os.environ['DB_NAME']]
+        await ensure_indexes(db)
+        if args.backfill:
+            print(f"Rebuilt {await backfill(db)} rollup buckets")
+        client.close()
+
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+"""Case-normalized email lookup for applicant tracking.
+
+Applications store ``email_normalized`` and notifications store
+``recipient_email_normalized``: the address trimmed and lowercased. The track
+page looks applicants up through these fields, so ``John.Doe@Example.com``
+finds what was submitted as ``john.doe@example.com``. Each lookup is served by
+a compound index that also covers the newest-first sort.
+
+Documents written before these fields existed are updated by ``backfill``,
+which the API starts in the background when it hasn't completed yet. Until it
+has, lookups also match the original address as typed, so older applications
+and notifications don't disappear meanwhile. It can also be run by hand:
+    python applicant_email.py --backfill
+"""
+import os
+
+from pymongo import UpdateOne
+
+MIGRATIONS = "migrations"
+MIGRATION_ID = "applicant_email"
+
+# Set once this process has seen the backfill completed; it never goes back
+_backfilled = False
+
+
+def normalize_email(email):
+    return (email or "").strip().lower()
+
+
+async def backfilled(db):
+    global _backfilled
+    if not _backfilled:
+        _backfilled = await db[MIGRATIONS].find_one({"_id": MIGRATION_ID}, {"_id": 1}) is not None
+    return _backfilled
+
+
+def lookup(field, legacy_field, email, complete):
+    """Filter on the normalized ``field``; also the exact ``legacy_field`` while the backfill isn't ``complete``"""
+    normalized = normalize_email(email)
+    if complete:
+        return {field: normalized}
+    return {"$or": [{field: normalized}, {legacy_field: {"$in": [email.strip(), normalized]}}]}
+
+
+async def ensure_indexes(db):
+    await db.loan_applications.create_index([("email_normalized", 1), ("created_at", -1)])
+    await db.notifications.create_index(
+        [("recipient_email_normalized", 1), ("recipient_type", 1), ("created_at", -1)]
+    )
+
+
+async def _backfill_collection(collection, source, target, batch_size):
+    count = 0
+    batch = []
+    async for doc in collection.find({target: {"$exists": False}}, {"_id": 1, source: 1}):
+        batch.append(UpdateOne({"_id": doc["_id"]}, {"$set": {target: normalize_email(doc.get(source))}}))
+        if len(batch) >= batch_size:
+            count += (await collection.bulk_write(batch, ordered=False)).modified_count
+            batch = []
+    if batch:
+        count += (await collection.bulk_write(batch, ordered=False)).modified_count
+    return count
+
+
+async def backfill(db, batch_size=1000):
+    """Add normalized emails to documents missing them; returns how many were updated"""
+    applications = await _backfill_collection(db.loan_applications, "email", "email_normalized", batch_size)
+    notifications = await _backfill_collection(
+        db.notifications, "recipient_email", "recipient_email_normalized", batch_size
+    )
+    await db[MIGRATIONS].update_one({"_id": MIGRATION_ID}, {"$set": {"completed": True}}, upsert=True)
+    global _backfilled
+    _backfilled = True
+    return applications, notifications
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+    from pathlib import Path
+
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Manage normalized applicant email fields and indexes")
+    parser.add_argument("--backfill", action="store_true", help="normalize emails on existing documents")
+    args = parser.parse_args()
+
+    async def main():
+        load_dotenv(Path(__file__).parent / '.env')
+        client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+        db = client[os.environ['DB_NAME']]
+        await ensure_indexes(db)
+        if args.backfill:
+            applications, notifications = await backfill(db)
+            print(f"Normalized {applications} applications and {notifications} notifications")
+        client.close()
+
+    asyncio.run(main())
@@ -0,0 +1,216 @@
+"""Applicant search for the admin dashboard.
+
+Each application carries a ``search`` sub-document of normalized fields,
+written on create:
+    search.first_name / last_name / email / city   lowercased, accents stripped
+    search.phone                                   digits only
+    search.reference                               id[:8].upper(), as in notification messages
+
+Two query paths, both index-backed:
+  * single term: anchored prefix matches (``^term``), one query per
+    normalized field, each served by its own ascending index and capped at
+    ``PREFIX_CANDIDATES`` matches, so a common prefix on one field can't
+    crowd out a reference or phone hit on another. Candidates are merged and
+    ranked by the fields they match (reference > email > last name >
+    first name / phone > city); when a field had more matches than its cap
+    the results are flagged ``truncated``. Pages follow on with a ``cursor``
+    naming the last hit, rather than by skipping
+  * several terms: the ``application_text`` text index, ranked by textScore
+
+Applications created before this module existed can be indexed with:
+    python applicant_search.py --backfill
+"""
+import base64
+import json
+import os
+import re
+import unicodedata
+
+from pymongo import UpdateOne
+
+MIN_PREFIX_LENGTH = 2
+
+# Matches per field of a prefix search that are ranked; typing more of the term narrows them
+PREFIX_CANDIDATES = 500
+
+TEXT_INDEX = "application_text"
+
+# Prefix-searched fields and their ranking weight
+PREFIX_FIELDS = {
+    "search.reference": 100,
+    "search.email": 50,
+    "search.last_name": 40,
+    "search.first_name": 30,
+    "search.phone": 30,
+    "search.city": 10,
+}
+
+# Returned for each hit; enough for the dashboard list without the full document
+SUMMARY_PROJECTION = {
+    "_id": 0,
+    "id": 1,
+    "first_name": 1,
+    "last_name": 1,
+    "email": 1,
+    "phone": 1,
+    "city": 1,
+    "state": 1,
+    "status": 1,
+    "loan_amount_requested": 1,
+    "created_at": 1,
+    "search.reference": 1,
+}
+
+
+def normalize(value):
+    """Lowercase, strip accents and collapse whitespace"""
+    value = unicodedata.normalize("NFKD", value or "")
+    value = "".join(char for char in value if not unicodedata.combining(char))
+    return " ".join(value.lower().split())
+
+
+def digits(value):
+    return re.sub(r"\D", "", value or "")
+
+
+def reference(application_id):
+    return application_id[:8].upper()
+
+
+def search_fields(application):
+    return {
+        "first_name": normalize(application["first_name"]),
+        "last_name": normalize(application["last_name"]),
+        "email": normalize(application["email"]),
+        "phone": digits(application["phone"]),
+        "city": normalize(application["city"]),
+        "reference": reference(application["id"]),
+    }
+
+
+async def ensure_indexes(collection):
+    for field in PREFIX_FIELDS:
+        await collection.create_index(field)
+    await collection.create_index(
+        [("first_name", "text"), ("last_name", "text"), ("email", "text"), ("city", "text"),
+         ("search.reference", "text")],
+        name=TEXT_INDEX,
+        weights={"search.reference": 10, "last_name": 5, "first_name": 4, "email": 3, "city": 1},
+        default_language="none",
+    )
+
+
+def prefix_conditions(term):
+    """Anchored, case-sensitive regexes on normalized fields, so each can use its index"""
+    conditions = {}
+    normalized = normalize(term)
+    if len(normalized) >= MIN_PREFIX_LENGTH:
+        pattern = "^" + re.escape(normalized)
+        for field in ("search.email", "search.last_name", "search.first_name", "search.city"):
+            conditions[field] = pattern
+    if re.fullmatch(r"[0-9a-fA-F]{2,8}", term):
+        conditions["search.reference"] = "^" + re.escape(term.upper())
+    if re.fullmatch(r"[0-9()+.\- ]+", term) and len(digits(term)) >= 3:
+        conditions["search.phone"] = "^" + digits(term)
+    return conditions
+
+
+def encode_cursor(hit):
+    """Opaque cursor of the page after ``hit``"""
+    position = [hit["score"], hit["created_at"], hit["id"]]
+    return base64.urlsafe_b64encode(json.dumps(position, separators=(",", ":")).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """``(score, created_at, id)`` of a cursor; raises ValueError when it isn't one"""
+    try:
+        score, created_at, application_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError("invalid cursor") from e
+    return score, created_at, application_id
+
+
+def _after(hit, cursor):
+    score, created_at, application_id = cursor
+    return (hit["score"], hit["created_at"], hit["id"]) < (score, created_at, application_id)
+
+
+async def prefix_search(collection, term, limit, cursor=None):
+    """``(hits, truncated)``: up to ``limit`` best-ranked prefix matches after ``cursor``
+
+    ``truncated`` is set when a field matched more than ``PREFIX_CANDIDATES``
+    applications, so some matches were never ranked. Raises ValueError for an
+    invalid cursor.
+    """
+    position = decode_cursor(cursor) if cursor else None
+    conditions = prefix_conditions(term)
+    projection = dict(SUMMARY_PROJECTION, **{field: 1 for field in conditions})
+    candidates = {}
+    truncated = False
+    # Heaviest fields first, so an exact reference or phone hit is always a candidate
+    for field in sorted(conditions, key=PREFIX_FIELDS.get, reverse=True):
+        matches = await collection.find(
+            {field: {"$regex": conditions[field]}}, projection
+        ).limit(PREFIX_CANDIDATES + 1).to_list(PREFIX_CANDIDATES + 1)
+        truncated = truncated or len(matches) > PREFIX_CANDIDATES
+        for match in matches[:PREFIX_CANDIDATES]:
+            candidates.setdefault(match["id"], match)
+
+    hits = []
+    for hit in candidates.values():
+        search = hit.get("search", {})
+        hit["score"] = float(sum(
+            PREFIX_FIELDS[field] for field, pattern in conditions.items()
+            if re.match(pattern, search.get(field.split(".", 1)[1]) or "")
+        ))
+        if position is None or _after(hit, position):
+            hits.append(hit)
+    hits.sort(key=lambda hit: (hit["score"], hit["created_at"], hit["id"]), reverse=True)
+    return hits[:limit], truncated
+
+
+def text_query(terms):
+    return (
+        {"$text": {"$search": terms}},
+        dict(SUMMARY_PROJECTION, score={"$meta": "textScore"}),
+        [("score", {"$meta": "textScore"})],
+    )
+
+
+async def backfill(collection, batch_size=1000):
+    """Add ``search`` fields to applications missing them; returns how many were updated"""
+    count = 0
+    batch = []
+    fields = {"_id": 1, "id": 1, "first_name": 1, "last_name": 1, "email": 1, "phone": 1, "city": 1}
+    async for application in collection.find({"search": {"$exists": False}}, fields):
+        batch.append(UpdateOne({"_id": application["_id"]}, {"$set": {"search": search_fields(application)}}))
+        if len(batch) >= batch_size:
+            count += (await collection.bulk_write(batch, ordered=False)).modified_count
+            batch = []
+    if batch:
+        count += (await collection.bulk_write(batch, ordered=False)).modified_count
+    return count
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+    from pathlib import Path
+
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Manage applicant search fields and indexes")
+    parser.add_argument("--backfill", action="store_true", help="add search fields to existing applications")
+    args = parser.parse_args()
+
+    async def main():
+        load_dotenv(Path(__file__).parent / '.env')
+        client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+        collection = client[os.environ['DB_NAME']].loan_applications
+        await ensure_indexes(collection)
+        if args.backfill:
+            print(f"Indexed {await backfill(collection)} applications")
+        client.close()
+
+    asyncio.run(main())
@@ -0,0 +1,331 @@
+"""Columnar export of loan data for offline analysis.
+
+Three tables can be exported, each with a fixed Arrow schema:
+
+  applications   ``loan_applications``, one row per application
+  notifications  ``notifications`` followed by ``notifications_archive``
+  documents      document metadata, one row per uploaded document
+
+They are written as zstd-compressed Parquet or as an Arrow IPC stream. Rows
+are read from Mongo ``EXPORT_BATCH_SIZE`` at a time, converted to one record
+batch (one Parquet row group), written and handed to the caller. Memory stays
+at about one batch however large the table is.
+
+Personal data is masked rather than exported. Names, phone numbers, street
+addresses, SSN digits, free-text messages, file names and tokens are left
+out. Dates of birth become birth years and ZIP codes their first three
+digits. Email addresses are replaced by a keyed BLAKE2b pseudonym, so the
+applications and notifications of one person can still be grouped. The key is
+``EXPORT_PSEUDONYM_KEY``, which must be set: nothing is exported without it,
+since pseudonyms under a throwaway key would not match across exports.
+
+Export to files with:
+    python columnar_export.py applications notifications documents -o exports/
+"""
+from datetime import datetime
+from pathlib import Path
+import asyncio
+import hashlib
+import os
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from analytics import as_utc
+from notification_retention import ARCHIVE as NOTIFICATIONS_ARCHIVE
+
+FORMATS = {
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+}
+
+TIMESTAMP = pa.timestamp("us", tz="UTC")
+
+
+class PseudonymKeyMissing(Exception):
+    """``EXPORT_PSEUDONYM_KEY`` is not set"""
+
+
+def batch_size():
+    return int(os.environ.get('EXPORT_BATCH_SIZE', '5000'))
+
+
+def compression():
+    return os.environ.get('EXPORT_COMPRESSION', 'zstd')
+
+
+async def ensure_indexes(db):
+    # Incremental exports read the rows created since the previous one
+    await db.loan_applications.create_index("created_at")
+    await db.notifications.create_index("created_at")
+    await db[NOTIFICATIONS_ARCHIVE].create_index("created_at")
+
+
+def pseudonym_key():
+    key = os.environ.get('EXPORT_PSEUDONYM_KEY')
+    if not key:
+        raise PseudonymKeyMissing("EXPORT_PSEUDONYM_KEY is not set; refusing to export")
+    # BLAKE2b takes keys of up to 64 bytes
+    return hashlib.blake2b(key.encode()).digest()
+
+
+def _timestamps(values):
+    try:
+        # ISO-8601 strings, or datetimes (naive ones are UTC), parsed by Arrow in one pass
+        return pa.array(values).cast(TIMESTAMP)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+        # Strings and datetimes mixed in one column
+        return pa.array([as_utc(value) if value else None for value in values], type=TIMESTAMP)
+
+
+def _pseudonyms(values):
+    key = pseudonym_key()
+    # Notifications repeat a few addresses many times, so each is hashed once per batch
+    pseudonyms = {
+        value: hashlib.blake2b(value.strip().lower().encode(), key=key, digest_size=16).hexdigest()
+        for value in set(values) if value
+    }
+    return [pseudonyms.get(value) for value in values]
+
+
+def _birth_years(values):
+    try:
+        return pc.cast(pc.utf8_slice_codeunits(pa.array(values, type=pa.string()), 0, 4), pa.int16())
+    except pa.ArrowInvalid:
+        # Some date of birth doesn't start with a year
+        return [int(value[:4]) if value and value[:4].isdigit() else None for value in values]
+
+
+def _zip3(values):
+    return pc.utf8_slice_codeunits(pa.array(values, type=pa.string()), 0, 3)
+
+
+def _counts(values):
+    return [len(value) if value else 0 for value in values]
+
+
+def _extensions(values):
+    return [Path(value).suffix.lstrip(".").lower() or None if value else None for value in values]
+
+
+def _present(values):
+    return [value is not None for value in values]
+
+
+# Table -> columns of (name, Mongo field, Arrow type, conversion of the field's values to a list or an array)
+COLUMNS = {
+    "applications": [
+        ("id", "id", pa.string(), None),
+        ("created_at", "created_at", TIMESTAMP, _timestamps),
+        ("status", "status", pa.string(), None),
+        ("status_changed_at", "status_changed_at", TIMESTAMP, _timestamps),
+        ("email_pseudonym", "email", pa.string(), _pseudonyms),
+        ("birth_year", "date_of_birth", pa.int16(), _birth_years),
+        ("state", "state", pa.string(), None),
+        ("zip3", "zip_code", pa.string(), _zip3),
+        ("employment_status", "employment_status", pa.string(), None),
+        ("annual_income", "annual_income", pa.float64(), None),
+        ("loan_amount_requested", "loan_amount_requested", pa.float64(), None),
+        ("locale", "locale", pa.string(), None),
+        ("loan_accepted", "loan_accepted", pa.bool_(), None),
+        ("banking_info_submitted", "banking_info_submitted", pa.bool_(), None),
+        ("document_count", "documents", pa.int32(), _counts),
+    ],
+    "notifications": [
+        ("id", "id", pa.string(), None),
+        ("application_id", "application_id", pa.string(), None),
+        ("recipient_type", "recipient_type", pa.string(), None),
+        ("recipient_pseudonym", "recipient_email", pa.string(), _pseudonyms),
+        ("subject", "subject", pa.string(), None),
+        ("read", "read", pa.bool_(), None),
+        ("created_at", "created_at", TIMESTAMP, _timestamps),
+        ("delivery_status", "delivery_status", pa.string(), None),
+        ("delivery_attempts", "delivery_attempts", pa.int32(), None),
+        ("delivered_at", "delivered_at", TIMESTAMP, _timestamps),
+        ("failed_at", "failed_at", TIMESTAMP, _timestamps),
+        ("archived_at", "archived_at", TIMESTAMP, _timestamps),
+    ],
+    "documents": [
+        ("id", "id", pa.string(), None),
+        ("application_id", "application_id", pa.string(), None),
+        ("uploaded_at", "uploaded_at", TIMESTAMP, _timestamps),
+        ("content_type", "content_type", pa.string(), None),
+        ("extension", "filename", pa.string(), _extensions),
+        ("size", "size", pa.int64(), None),
+        ("sha256", "sha256", pa.string(), None),
+        ("normalized", "original_content_type", pa.bool_(), _present),
+        ("original_content_type", "original_content_type", pa.string(), None),
+        ("original_size", "original_size", pa.int64(), None),
+    ],
+}
+
+SCHEMAS = {
+    table: pa.schema([pa.field(name, arrow_type) for name, _, arrow_type, _ in columns])
+    for table, columns in COLUMNS.items()
+}
+
+# Table -> columns with few distinct values, which Parquet stores dictionary-encoded
+DICTIONARY_COLUMNS = {
+    "applications": ["status", "state", "zip3", "employment_status", "locale"],
+    "notifications": ["recipient_type", "subject", "delivery_status"],
+    "documents": ["content_type", "extension", "original_content_type"],
+}
+
+# Table -> field its `since` filter applies to
+SINCE_FIELDS = {"applications": "created_at", "notifications": "created_at", "documents": "uploaded_at"}
+
+
+def _projection(table):
+    return {"_id": 0, **{field: 1 for _, field, _, _ in COLUMNS[table]}}
+
+
+def cursors(db, table, since=None):
+    """Cursors over the documents of ``table``, in the order they are exported"""
+    # Timestamps are stored as ISO-8601 UTC strings, which sort like the times they name
+    condition = {SINCE_FIELDS[table]: {"$gte": as_utc(since).isoformat()}} if since else {}
+    if table == "applications":
+        # Only the number of documents is exported, so only their ids are read
+        projection = {field: value for field, value in _projection(table).items() if field != "documents"}
+        return [db.loan_applications.find(condition, {**projection, "documents.id": 1})]
+    if table == "notifications":
+        return [
+            db.notifications.find(condition, _projection(table)),
+            db[NOTIFICATIONS_ARCHIVE].find(condition, _projection(table)),
+        ]
+    nested = {f"documents.{field}": value for field, value in condition.items()}
+    pipeline = [{"$match": nested}] if nested else []
+    pipeline += [
+        {"$project": {"_id": 0, "id": 1, "documents": 1}},
+        {"$unwind": "$documents"},
+    ]
+    pipeline += [{"$match": nested}] if nested else []
+    pipeline.append({"$project": {
+        "application_id": "$id",
+        **{field: f"$documents.{field}" for _, field, _, _ in COLUMNS[table] if field != "application_id"},
+    }})
+    return [db.loan_applications.aggregate(pipeline)]
+
+
+async def _batches(cursors, size):
+    batch = []
+    for cursor in cursors:
+        async for document in cursor:
+            batch.append(document)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def record_batch(table, documents):
+    """``documents`` of ``table`` as one record batch of its schema"""
+    arrays = []
+    for name, field, arrow_type, convert in COLUMNS[table]:
+        values = [document.get(field) for document in documents]
+        if convert:
+            values = convert(values)
+        arrays.append(values if isinstance(values, pa.Array) else pa.array(values, type=arrow_type))
+    return pa.RecordBatch.from_arrays(arrays, schema=SCHEMAS[table])
+
+
+def open_writer(sink, table, fmt):
+    if fmt == "parquet":
+        # Dictionaries of ids and hashes only grow until Parquet gives up on them
+        return pq.ParquetWriter(
+            sink, SCHEMAS[table], compression=compression(), use_dictionary=DICTIONARY_COLUMNS[table]
+        )
+    return pa.ipc.new_stream(sink, SCHEMAS[table], options=pa.ipc.IpcWriteOptions(compression=compression()))
+
+
+class _Sink:
+    """File-like object collecting what a writer writes until it is drained"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+async def stream(db, table, fmt="parquet", since=None):
+    """Yield the bytes of an export of ``table`` as each batch is written"""
+    pseudonym_key()
+    sink = _Sink()
+    writer = open_writer(pa.PythonFile(sink, mode="w"), table, fmt)
+    try:
+        async for documents in _batches(cursors(db, table, since), batch_size()):
+            # Building and compressing a batch is CPU work, kept off the event loop
+            await asyncio.to_thread(lambda: writer.write_batch(record_batch(table, documents)))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+async def export_file(db, table, path, fmt="parquet", since=None):
+    """Write an export of ``table`` to ``path``; returns the rows written"""
+    pseudonym_key()
+    rows = 0
+    with open_writer(str(path), table, fmt) as writer:
+        async for documents in _batches(cursors(db, table, since), batch_size()):
+            await asyncio.to_thread(lambda: writer.write_batch(record_batch(table, documents)))
+            rows += len(documents)
+    return rows
+
+
+def filename(table, fmt, moment=None):
+    moment = moment or datetime.now()
+    return f"loanease-{table}-{moment:%Y%m%d}.{FORMATS[fmt][1]}"
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Export loan data as Parquet or Arrow, with personal data masked")
+    parser.add_argument("tables", nargs="+", choices=sorted(COLUMNS))
+    parser.add_argument("-o", "--output-dir", default=".", help="directory to write the files to")
+    parser.add_argument("--format", choices=sorted(FORMATS), default="parquet")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="only rows created (uploaded) at or after this")
+    args = parser.parse_args()
+
+    async def main():
+        load_dotenv(Path(__file__).parent / '.env')
+        try:
+            pseudonym_key()
+        except PseudonymKeyMissing as e:
+            sys.exit(str(e))
+        client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+        db = client[os.environ['DB_NAME']]
+        output_dir = Path(args.output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        for table in args.tables:
+            path = output_dir / filename(table, args.format)
+            rows = await export_file(db, table, path, args.format, args.since)
+            print(f"Wrote {rows} {table} rows to {path}")
+        client.close()
+
+    asyncio.run(main())
@@ -0,0 +1,570 @@
+"""Email delivery of applicant notifications.
+
+While ``SMTP_HOST`` is set, applicant notifications are created with
+``delivery_status`` ``pending``; without it nothing is queued, so configuring
+SMTP later doesn't send a backlog of old notifications. A
+``DeliveryWorker`` claims due ones in batches and sends them over a pool of
+SMTP connections:
+
+  * a batch is claimed by marking up to ``EMAIL_BATCH_SIZE`` due notifications
+    ``sending`` under one claim id with a lease; a lease that expires (the
+    worker died) makes them claimable again
+  * the batch is split across ``SMTP_POOL_SIZE`` connections, which stay open
+    between batches, and each connection pipelines its messages (RFC 2920) when
+    the server offers PIPELINING: the content of one message goes out in the
+    same write as the next message's envelope, so a message costs one round
+    trip instead of four
+  * a message refused with a 4xx reply, or lost with its connection, is retried
+    with exponential backoff and jitter up to ``EMAIL_MAX_ATTEMPTS`` attempts;
+    a 5xx reply fails it at once. Either way it ends ``sent`` or ``failed``
+    with the server's last reply
+  * a notification more than ``EMAIL_MAX_AGE_HOURS`` old when claimed, e.g.
+    after a long SMTP outage, is failed instead of sent
+  * the outcomes of a batch are written back with one ``bulk_write``
+
+A connection lost after a message's content was sent but before the server
+replied leaves the outcome unknown; the message is retried, so delivery is at
+least once. Its ``Message-ID`` derives from the notification id, which lets
+mail clients collapse such duplicates.
+
+The API runs one worker per process when ``SMTP_HOST`` is set, unless
+``EMAIL_API_WORKER`` is ``0``, and ``python email_delivery.py`` runs one on
+its own. Notifications created before delivery existed, or while it wasn't
+configured, have no ``delivery_status`` and are never sent.
+"""
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from email import policy
+from email.message import EmailMessage
+from email.utils import format_datetime, parseaddr
+from time import monotonic, perf_counter
+import asyncio
+import base64
+import logging
+import os
+import random
+import re
+import socket
+import ssl
+import uuid
+
+from pymongo import UpdateOne
+
+from analytics import as_utc
+from metrics import REGISTRY
+
+PENDING = "pending"
+SENDING = "sending"
+SENT = "sent"
+FAILED = "failed"
+
+logger = logging.getLogger(__name__)
+
+emails_processed = REGISTRY.counter(
+    "loanease_emails_processed",
+    "Notification emails handled by the delivery worker, by outcome (sent|retried|failed)",
+    ("outcome",),
+)
+email_batch_duration = REGISTRY.histogram(
+    "loanease_email_batch_seconds",
+    "Time to send one claimed batch of notification emails",
+)
+
+# Workers running in this process, woken when an applicant notification is created
+_workers = set()
+
+# Characters that would let an address break out of an SMTP command
+UNSAFE_ADDRESS = re.compile(r"[\s<>\x00-\x1f\x7f]")
+
+LEADING_DOT = re.compile(rb"^\.", re.MULTILINE)
+
+
+def max_attempts():
+    return int(os.environ.get('EMAIL_MAX_ATTEMPTS', '8'))
+
+
+def retry_delay(attempts):
+    """Exponential backoff with jitter, capped at ``EMAIL_RETRY_MAX_SECONDS``"""
+    base = float(os.environ.get('EMAIL_RETRY_BASE_SECONDS', '30'))
+    cap = float(os.environ.get('EMAIL_RETRY_MAX_SECONDS', '3600'))
+    return min(cap, base * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+
+
+def enabled():
+    """Whether new applicant notifications are queued for delivery"""
+    return bool(os.environ.get('SMTP_HOST'))
+
+
+def max_age():
+    return timedelta(hours=float(os.environ.get('EMAIL_MAX_AGE_HOURS', '72')))
+
+
+def pending_fields():
+    """Fields that queue a new applicant notification for delivery"""
+    return {"delivery_status": PENDING, "delivery_attempts": 0, "next_attempt_at": datetime.now(timezone.utc)}
+
+
+def wake():
+    for worker in _workers:
+        worker.wake()
+
+
+async def ensure_indexes(db):
+    await db.notifications.create_index([("delivery_status", 1), ("next_attempt_at", 1)])
+    await db.notifications.create_index([("delivery_status", 1), ("delivery_lease_expires_at", 1)])
+    await db.notifications.create_index("delivery_claim", sparse=True)
+
+
+class SMTPReplyError(Exception):
+    """A message or command the server refused"""
+
+    def __init__(self, code, text):
+        super().__init__(f"{code} {text}")
+        self.code = code
+
+    @property
+    def permanent(self):
+        return self.code >= 500
+
+
+def is_permanent(error):
+    return isinstance(error, ValueError) or isinstance(error, SMTPReplyError) and error.permanent
+
+
+class SMTPConnection:
+    """One SMTP session, reused for many messages"""
+
+    def __init__(self, reader, writer, timeout):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.extensions = {}
+        self.messages_sent = 0
+        self.broken = False
+        self.last_used = monotonic()
+
+    @classmethod
+    async def open(cls, host, port, tls, username, password, timeout):
+        context = ssl.create_default_context() if tls in ("ssl", "starttls") else None
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=context if tls == "ssl" else None), timeout
+        )
+        connection = cls(reader, writer, timeout)
+        try:
+            await connection._expect(None, 220)
+            await connection._ehlo()
+            if tls == "starttls":
+                if "STARTTLS" not in connection.extensions:
+                    raise ConnectionError(f"{host}:{port} does not offer STARTTLS")
+                await connection._expect(b"STARTTLS\r\n", 220)
+                await asyncio.wait_for(writer.start_tls(context, server_hostname=host), timeout)
+                await connection._ehlo()
+            if username:
+                credentials = base64.b64encode(f"\0{username}\0{password}".encode()).decode()
+                await connection._expect(f"AUTH PLAIN {credentials}\r\n".encode(), 235)
+        except BaseException:
+            connection.close()
+            raise
+        return connection
+
+    @property
+    def pipelining(self):
+        return "PIPELINING" in self.extensions
+
+    async def _reply(self):
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            if not line.endswith(b"\n"):
+                raise ConnectionError("SMTP server closed the connection")
+            lines.append(line[4:].strip().decode("utf-8", "replace"))
+            if line[3:4] != b"-":
+                return int(line[:3]), "\n".join(lines)
+
+    async def _expect(self, command, code):
+        if command is not None:
+            self.writer.write(command)
+            await self.writer.drain()
+        reply_code, text = await self._reply()
+        if reply_code != code:
+            raise SMTPReplyError(reply_code, text)
+        return text
+
+    async def _ehlo(self):
+        text = await self._expect(f"EHLO {socket.gethostname()}\r\n".encode(), 250)
+        self.extensions = {}
+        for line in text.split("\n")[1:]:
+            keyword, _, parameters = line.partition(" ")
+            self.extensions[keyword.upper()] = parameters
+
+    async def _exchange(self, commands):
+        """Send commands that are each answered by one reply; in a single write when pipelining"""
+        if self.pipelining:
+            self.writer.write(b"".join(commands))
+            await self.writer.drain()
+            return [await self._reply() for _ in commands]
+        replies = []
+        for command in commands:
+            self.writer.write(command)
+            await self.writer.drain()
+            replies.append(await self._reply())
+        return replies
+
+    async def send(self, sender, messages):
+        """Send ``(recipient, content)`` pairs; returns the final reply text or an exception per message"""
+        results = [None] * len(messages)
+        # (index, dot-stuffed content) of the message whose DATA was accepted, sent with the next envelope
+        content = None
+        reset = False
+        try:
+            for index in range(len(messages) + 1):
+                commands = []
+                if content is not None:
+                    commands.append(content[1])
+                if reset:
+                    commands.append(b"RSET\r\n")
+                if index < len(messages):
+                    recipient, data = messages[index]
+                    size = f" SIZE={len(data)}" if "SIZE" in self.extensions else ""
+                    commands += [
+                        f"MAIL FROM:<{sender}>{size}\r\n".encode(),
+                        f"RCPT TO:<{recipient}>\r\n".encode(),
+                        b"DATA\r\n",
+                    ]
+                if not commands:
+                    break
+
+                replies = await self._exchange(commands)
+                if content is not None:
+                    code, text = replies.pop(0)
+                    sent_index = content[0]
+                    if results[sent_index] is None:
+                        results[sent_index] = text if code == 250 else SMTPReplyError(code, text)
+                        self.messages_sent += 1
+                    content = None
+                if reset:
+                    replies.pop(0)
+                    reset = False
+                if index == len(messages):
+                    break
+
+                refused = next(
+                    (SMTPReplyError(code, text)
+                     for (code, text), expected in zip(replies, (250, 250, 354)) if code != expected),
+                    None,
+                )
+                if refused is not None:
+                    results[index] = refused
+                    reset = True
+                if replies[2][0] == 354:
+                    # A server that accepts DATA after refusing the envelope still needs the terminating dot
+                    content = (index, dot_stuff(messages[index][1]) if refused is None else b".\r\n")
+        except (OSError, EOFError, ValueError, asyncio.TimeoutError, ConnectionError) as e:
+            # A malformed reply leaves the session out of step too
+            self.broken = True
+            error = ConnectionError(f"SMTP connection lost: {type(e).__name__}: {e}")
+            results = [error if result is None else result for result in results]
+        self.last_used = monotonic()
+        return results
+
+    async def quit(self):
+        try:
+            await asyncio.wait_for(self._expect(b"QUIT\r\n", 221), self.timeout)
+        except Exception:
+            pass
+        self.close()
+
+    def close(self):
+        self.broken = True
+        self.writer.close()
+
+
+def dot_stuff(data):
+    """Message content as sent after DATA: CRLF line endings, leading dots doubled, terminated by a dot"""
+    data = LEADING_DOT.sub(b"..", data)
+    if not data.endswith(b"\r\n"):
+        data += b"\r\n"
+    return data + b".\r\n"
+
+
+class SMTPPool:
+    """Up to ``size`` SMTP connections, kept open and reused across batches"""
+
+    def __init__(self, host, port=587, tls="starttls", username=None, password=None, size=4,
+                 timeout=30.0, max_messages=100, idle_seconds=30.0):
+        self.host = host
+        self.port = port
+        self.tls = tls
+        self.username = username
+        self.password = password
+        self.size = size
+        self.timeout = timeout
+        self.max_messages = max_messages
+        self.idle_seconds = idle_seconds
+        self._idle = []
+        self._slots = asyncio.Semaphore(size)
+
+    @asynccontextmanager
+    async def connection(self):
+        async with self._slots:
+            connection = None
+            while self._idle and connection is None:
+                candidate = self._idle.pop()
+                # Servers drop idle sessions; a stale one would cost its first message a retry
+                if monotonic() - candidate.last_used < self.idle_seconds:
+                    connection = candidate
+                else:
+                    await candidate.quit()
+            if connection is None:
+                connection = await SMTPConnection.open(
+                    self.host, self.port, self.tls, self.username, self.password, self.timeout
+                )
+            try:
+                yield connection
+            except BaseException:
+                connection.close()
+                raise
+            if connection.broken:
+                connection.close()
+            elif connection.messages_sent >= self.max_messages:
+                await connection.quit()
+            else:
+                self._idle.append(connection)
+
+    async def _send_chunk(self, sender, messages):
+        try:
+            async with self.connection() as connection:
+                return await connection.send(sender, messages)
+        except (OSError, EOFError, asyncio.TimeoutError, ConnectionError, SMTPReplyError) as e:
+            # Failing to connect or log in is the server's or the configuration's fault, never the message's
+            error = ConnectionError(f"SMTP connection to {self.host}:{self.port} failed: {type(e).__name__}: {e}")
+            return [error] * len(messages)
+
+    async def send(self, sender, messages):
+        """Spread ``(recipient, content)`` pairs over the pool; returns a reply text or exception per message"""
+        if not messages:
+            return []
+        chunk_size = -(-len(messages) // self.size)
+        chunks = [messages[start:start + chunk_size] for start in range(0, len(messages), chunk_size)]
+        results = await asyncio.gather(*(self._send_chunk(sender, chunk) for chunk in chunks))
+        return [result for chunk in results for result in chunk]
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        await asyncio.gather(*(connection.quit() for connection in idle))
+
+
+def pool_from_env():
+    return SMTPPool(
+        os.environ['SMTP_HOST'],
+        port=int(os.environ.get('SMTP_PORT', '587')),
+        tls=os.environ.get('SMTP_TLS', 'starttls'),
+        username=os.environ.get('SMTP_USERNAME') or None,
+        password=os.environ.get('SMTP_PASSWORD', ''),
+        size=int(os.environ.get('SMTP_POOL_SIZE', '4')),
+        timeout=float(os.environ.get('SMTP_TIMEOUT_SECONDS', '30')),
+        max_messages=int(os.environ.get('SMTP_MAX_MESSAGES_PER_CONNECTION', '100')),
+    )
+
+
+def build_message(notification, sender):
+    """The notification as RFC 5322 bytes, 7-bit clean so no server extension is needed"""
+    recipient = notification["recipient_email"].strip()
+    if not recipient or UNSAFE_ADDRESS.search(recipient) or "@" not in recipient:
+        raise ValueError(f"Invalid recipient address {recipient!r}")
+    message = EmailMessage()
+    message["From"] = sender
+    message["To"] = recipient
+    message["Subject"] = notification["subject"]
+    message["Date"] = format_datetime(datetime.fromisoformat(notification["created_at"]))
+    message["Message-ID"] = f"<{notification['id']}@{parseaddr(sender)[1].rpartition('@')[2]}>"
+    message.set_content(notification["message"], cte="quoted-printable")
+    return recipient, message.as_bytes(policy=policy.SMTP)
+
+
+async def claim_batch(collection, claim_id, batch_size, lease_seconds):
+    """Mark up to ``batch_size`` due notifications as sending under ``claim_id``; returns them"""
+    now = datetime.now(timezone.utc)
+    due = {"$or": [
+        {"delivery_status": PENDING, "next_attempt_at": {"$lte": now}},
+        {"delivery_status": SENDING, "delivery_lease_expires_at": {"$lt": now}},
+    ]}
+    candidates = await collection.find(due, {"_id": 1}).sort("next_attempt_at", 1).to_list(batch_size)
+    if not candidates:
+        return []
+    # Another worker may claim some of them between the find and the update; the filter skips those
+    await collection.update_many(
+        {"_id": {"$in": [doc["_id"] for doc in candidates]}, **due},
+        {"$set": {
+            "delivery_status": SENDING,
+            "delivery_claim": claim_id,
+            "delivery_lease_expires_at": now + timedelta(seconds=lease_seconds),
+        }, "$inc": {"delivery_attempts": 1}}
+    )
+    return await collection.find({"delivery_claim": claim_id}).to_list(batch_size)
+
+
+def outcome_update(notification, result, now):
+    """The update recording one send result, and the outcome it counts as"""
+    done = {"delivery_claim": "", "delivery_lease_expires_at": ""}
+    if not isinstance(result, Exception):
+        return "sent", {
+            "$set": {"delivery_status": SENT, "delivered_at": now, "delivery_response": result},
+            "$unset": {**done, "next_attempt_at": "", "delivery_error": ""},
+        }
+    error = str(result)[:2000]
+    if is_permanent(result) or notification["delivery_attempts"] >= max_attempts():
+        return "failed", {
+            "$set": {"delivery_status": FAILED, "failed_at": now, "delivery_error": error},
+            "$unset": {**done, "next_attempt_at": ""},
+        }
+    return "retried", {
+        "$set": {
+            "delivery_status": PENDING,
+            "next_attempt_at": now + timedelta(seconds=retry_delay(notification["delivery_attempts"])),
+            "delivery_error": error,
+        },
+        "$unset": done,
+    }
+
+
+async def retry_failed(collection):
+    """Queue every failed notification again with a fresh set of attempts; returns how many"""
+    result = await collection.update_many(
+        {"delivery_status": FAILED},
+        {"$set": {"delivery_status": PENDING, "delivery_attempts": 0, "next_attempt_at": datetime.now(timezone.utc)},
+         "$unset": {"failed_at": ""}}
+    )
+    return result.modified_count
+
+
+class DeliveryWorker:
+    """Claims batches of due applicant notifications and sends them until cancelled"""
+
+    def __init__(self, db, pool, sender, batch_size=100, lease_seconds=120, poll_interval=5.0):
+        self.collection = db.notifications
+        self.pool = pool
+        self.sender = sender
+        self.envelope_sender = parseaddr(sender)[1]
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def run(self):
+        _workers.add(self)
+        try:
+            while True:
+                try:
+                    delivered = await self.deliver_batch()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Email delivery error: {e}")
+                    delivered = 0
+                if delivered < self.batch_size:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            _workers.discard(self)
+            await self.pool.close()
+
+    async def run_pending(self):
+        """Send every due notification, then return; returns how many were handled"""
+        total = 0
+        while count := await self.deliver_batch():
+            total += count
+        return total
+
+    async def deliver_batch(self):
+        """Claim, send and record one batch; returns its size"""
+        claim_id = uuid.uuid4().hex
+        batch = await claim_batch(self.collection, claim_id, self.batch_size, self.lease_seconds)
+        if not batch:
+            return 0
+
+        start = perf_counter()
+        oldest = datetime.now(timezone.utc) - max_age()
+        results = [None] * len(batch)
+        messages = []
+        for index, notification in enumerate(batch):
+            try:
+                if as_utc(notification["created_at"]) < oldest:
+                    raise ValueError("older than EMAIL_MAX_AGE_HOURS, not sent")
+                messages.append((index, build_message(notification, self.sender)))
+            except (ValueError, KeyError) as e:
+                results[index] = ValueError(f"Undeliverable notification: {e}")
+        sent = await self.pool.send(self.envelope_sender, [message for _, message in messages])
+        for (index, _), result in zip(messages, sent):
+            results[index] = result
+
+        now = datetime.now(timezone.utc)
+        requests = []
+        for notification, result in zip(batch, results):
+            outcome, update = outcome_update(notification, result, now)
+            emails_processed.inc(outcome)
+            if outcome == "failed":
+                logger.warning(f"Email notification {notification['id']} failed: {result}")
+            requests.append(UpdateOne({"_id": notification["_id"], "delivery_claim": claim_id}, update))
+        await self.collection.bulk_write(requests, ordered=False)
+        email_batch_duration.observe(perf_counter() - start)
+        return len(batch)
+
+
+def worker_from_env(db):
+    return DeliveryWorker(
+        db,
+        pool_from_env(),
+        os.environ.get('EMAIL_FROM', 'LoanEase <no-reply@loanease.local>'),
+        batch_size=int(os.environ.get('EMAIL_BATCH_SIZE', '100')),
+        poll_interval=float(os.environ.get('EMAIL_POLL_INTERVAL_SECONDS', '5')),
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+    from pathlib import Path
+
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Send applicant notifications by email outside the API process")
+    parser.add_argument("--drain", action="store_true", help="send the notifications that are due, then exit")
+    parser.add_argument("--retry-failed", action="store_true", help="queue failed notifications again and exit")
+    parser.add_argument("--report", action="store_true", help="print notification counts by delivery status and exit")
+    args = parser.parse_args()
+
+    async def main():
+        load_dotenv(Path(__file__).parent / '.env')
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+        db = client[os.environ['DB_NAME']]
+        await ensure_indexes(db)
+        try:
+            if args.retry_failed:
+                print(f"Queued {await retry_failed(db.notifications)} notifications")
+            elif args.report:
+                async for row in db.notifications.aggregate([
+                    {"$match": {"delivery_status": {"$exists": True}}},
+                    {"$group": {"_id": "$delivery_status", "count": {"$sum": 1}}},
+                ]):
+                    print(f"{row['_id']:<8} {row['count']}")
+            elif args.drain:
+                worker = worker_from_env(db)
+                try:
+                    print(f"Handled {await worker.run_pending()} notifications")
+                finally:
+                    await worker.pool.close()
+            else:
+                logger.info("Email delivery worker running")
+                await worker_from_env(db).run()
+        finally:
+            client.close()
+
+    asyncio.run(main())
@@ -0,0 +1,21 @@
+# Gunicorn settings for running the API on every core:
+#   gunicorn -c gunicorn.conf.py "server:create_app()"
+#
+# Each worker builds its own app and opens its own MongoDB client in the
+# lifespan, after the fork, so the app is deliberately not preloaded.
+import multiprocessing
+import os
+
+bind = os.environ.get("BIND", "127.0.0.1:8001")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = False
+
+# On SIGTERM workers stop accepting connections and get this long to finish in-flight requests
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", "30"))
+timeout = int(os.environ.get("WORKER_TIMEOUT", "60"))
+keepalive = 5
+
+# Recycle workers periodically, staggered so they never all restart at once
+max_requests = int(os.environ.get("MAX_REQUESTS", "10000"))
+max_requests_jitter = max_requests // 10
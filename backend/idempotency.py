@@ -0,0 +1,118 @@
+"""Idempotency-Key support for retried POST requests.
+
+The first request with a given key claims it by inserting a record into the
+``idempotency_keys`` collection (``_id`` is the key, scoped to the operation),
+runs the handler and stores the response. Retries with the same key get the
+stored response back from a single ``_id`` lookup, without running the
+handler again. Records expire through a TTL index on ``created_at``.
+
+  * same key, different payload: 422
+  * same key while the first request is still running: 409 with Retry-After
+  * handler fails with a 5xx or an unexpected error: the key is released so
+    the client can retry
+"""
+from datetime import datetime, timedelta, timezone
+import hashlib
+import json
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pymongo.errors import DuplicateKeyError
+
+from ttl_indexes import ensure_ttl_index
+
+MAX_KEY_LENGTH = 255
+
+# A claim older than this is assumed abandoned (e.g. the worker died) and can be taken over
+LOCK_TIMEOUT = timedelta(seconds=60)
+
+
+def fingerprint(payload):
+    """Stable hash of a request body model"""
+    body = json.dumps(payload.model_dump(mode="json"), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(body.encode()).hexdigest()
+
+
+async def ensure_indexes(collection, ttl_seconds):
+    await ensure_ttl_index(collection, "created_at", ttl_seconds)
+
+
+def _replay(record):
+    return JSONResponse(
+        status_code=record["status_code"],
+        content=record["body"],
+        headers={"Idempotent-Replayed": "true"},
+    )
+
+
+async def _claim(collection, record_id, request_hash):
+    """Claim the key; return None if claimed, else the response for a retry"""
+    now = datetime.now(timezone.utc)
+    try:
+        await collection.insert_one({
+            "_id": record_id,
+            "state": "in_progress",
+            "fingerprint": request_hash,
+            "created_at": now,
+            "locked_at": now,
+        })
+        return None
+    except DuplicateKeyError:
+        pass
+
+    record = await collection.find_one({"_id": record_id})
+    if record is None:
+        # Expired between the insert and the read; claim it again
+        return await _claim(collection, record_id, request_hash)
+    if record["fingerprint"] != request_hash:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+    if record["state"] == "completed":
+        return _replay(record)
+
+    taken_over = await collection.update_one(
+        {"_id": record_id, "state": "in_progress", "locked_at": {"$lt": now - LOCK_TIMEOUT}},
+        {"$set": {"locked_at": now}}
+    )
+    if taken_over.modified_count:
+        return None
+    raise HTTPException(
+        status_code=409,
+        detail="A request with this Idempotency-Key is already in progress",
+        headers={"Retry-After": "1"},
+    )
+
+
+async def _complete(collection, record_id, status_code, body):
+    await collection.update_one(
+        {"_id": record_id},
+        {"$set": {"state": "completed", "status_code": status_code, "body": body}}
+    )
+
+
+async def run_idempotent(collection, operation, key, payload, handler):
+    """Run ``handler()`` at most once per ``(operation, key)``; without a key just run it"""
+    if key is None:
+        return await handler()
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key must be 1-{MAX_KEY_LENGTH} characters")
+
+    record_id = f"{operation}:{key}"
+    replay = await _claim(collection, record_id, fingerprint(payload))
+    if replay is not None:
+        return replay
+
+    try:
+        result = await handler()
+    except HTTPException as e:
+        if e.status_code >= 500:
+            await collection.delete_one({"_id": record_id})
+        else:
+            await _complete(collection, record_id, e.status_code, {"detail": e.detail})
+        raise
+    except BaseException:
+        await collection.delete_one({"_id": record_id})
+        raise
+
+    await _complete(collection, record_id, 200, jsonable_encoder(result))
+    return result
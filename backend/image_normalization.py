@@ -0,0 +1,141 @@
+"""Optional normalization of uploaded photos and scans.
+
+With ``UPLOAD_IMAGE_NORMALIZATION=1``, JPEG and PNG uploads are re-encoded
+before they are stored:
+  * EXIF and other metadata (GPS position, camera serial, ...) are dropped,
+    after applying the EXIF orientation to the pixels
+  * images larger than ``UPLOAD_IMAGE_MAX_SIDE`` pixels on their longest side
+    are downscaled
+  * the result is written as ``UPLOAD_IMAGE_FORMAT`` (WebP or JPEG) at
+    ``UPLOAD_IMAGE_QUALITY``
+
+An image that would only grow and carries no metadata is stored as uploaded.
+The original is kept next to the normalized file only with
+``UPLOAD_KEEP_ORIGINALS=1``.
+
+Encoding is CPU-bound and runs in the preview process pool. Bytes saved are
+counted in ``loanease_upload_bytes_saved`` when stored and each time the
+smaller file is served; totals across stored documents are printed by:
+    python image_normalization.py --report
+"""
+from io import BytesIO
+import asyncio
+import os
+
+from metrics import REGISTRY
+import previews
+
+IMAGE_TYPES = {"image/jpeg", "image/jpg", "image/png"}
+
+# Format name -> (Pillow format, media type, file extension, save options)
+FORMATS = {
+    "webp": ("WEBP", "image/webp", "webp", {"method": 4}),
+    "jpeg": ("JPEG", "image/jpeg", "jpg", {"optimize": True, "progressive": True}),
+}
+
+upload_bytes_saved = REGISTRY.counter(
+    "loanease_upload_bytes_saved",
+    "Bytes saved by upload image normalization, when stored and when served",
+    ("stage",),
+)
+
+
+def enabled():
+    return os.environ.get('UPLOAD_IMAGE_NORMALIZATION', '0') == '1'
+
+
+def keep_originals():
+    return os.environ.get('UPLOAD_KEEP_ORIGINALS', '0') == '1'
+
+
+def normalize(contents, max_side, fmt, quality):
+    """Re-encode one image; returns the new bytes, or None to keep the original. Runs in a worker process"""
+    from PIL import Image, ImageOps
+
+    pil_format, _, _, options = FORMATS[fmt]
+    image = Image.open(BytesIO(contents))
+    has_metadata = bool(image.info.get("exif") or image.info.get("xmp") or image.getexif())
+    # Let the JPEG decoder downscale while decoding instead of after
+    image.draft("RGB", (max_side, max_side))
+    image = ImageOps.exif_transpose(image)
+
+    resized = max(image.size) > max_side
+    if resized:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    if image.mode not in ("RGB", "RGBA", "L"):
+        image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+    if pil_format == "JPEG" and image.mode == "RGBA":
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+
+    # Saved without exif=, so no metadata is carried over
+    output = BytesIO()
+    image.save(output, pil_format, quality=quality, **options)
+    normalized = output.getvalue()
+    if len(normalized) >= len(contents) and not resized and not has_metadata:
+        return None
+    return normalized
+
+
+async def normalize_upload(contents):
+    """``(bytes, content_type, extension)`` for the stored image, or None to store the upload as-is"""
+    fmt = os.environ.get('UPLOAD_IMAGE_FORMAT', 'webp')
+    normalized = await asyncio.get_running_loop().run_in_executor(
+        previews.executor(), normalize, contents,
+        int(os.environ.get('UPLOAD_IMAGE_MAX_SIDE', '2048')),
+        fmt,
+        int(os.environ.get('UPLOAD_IMAGE_QUALITY', '80')),
+    )
+    if normalized is None:
+        return None
+    _, content_type, extension, _ = FORMATS[fmt]
+    return normalized, content_type, extension
+
+
+def record_served(document):
+    """Count the bytes a download of a normalized document saved"""
+    saved = document.get("original_size", 0) - document["size"]
+    if saved > 0:
+        upload_bytes_saved.inc("served", amount=saved)
+
+
+async def report(collection):
+    """Totals over all normalized documents"""
+    totals = await collection.aggregate([
+        {"$unwind": "$documents"},
+        {"$match": {"documents.original_size": {"$exists": True}}},
+        {"$group": {
+            "_id": None,
+            "documents": {"$sum": 1},
+            "original_bytes": {"$sum": "$documents.original_size"},
+            "stored_bytes": {"$sum": "$documents.size"},
+        }},
+    ]).to_list(1)
+    return totals[0] if totals else {"documents": 0, "original_bytes": 0, "stored_bytes": 0}
+
+
+if __name__ == "__main__":
+    import argparse
+    from pathlib import Path
+
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Upload image normalization")
+    parser.add_argument("--report", action="store_true", help="print bytes saved across stored documents")
+    args = parser.parse_args()
+
+    async def main():
+        load_dotenv(Path(__file__).parent / '.env')
+        client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+        if args.report:
+            totals = await report(client[os.environ['DB_NAME']].loan_applications)
+            saved = totals["original_bytes"] - totals["stored_bytes"]
+            percent = 100 * saved / totals["original_bytes"] if totals["original_bytes"] else 0
+            print(f"{totals['documents']} normalized documents: {totals['original_bytes']} bytes uploaded, "
+                  f"{totals['stored_bytes']} bytes stored, {saved} saved ({percent:.1f}%)")
+        client.close()
+
+    asyncio.run(main())
@@ -0,0 +1,345 @@
+"""Durable job queue for work that runs after a request has committed.
+
+Request handlers write their own state, ``enqueue`` a job describing the
+follow-up work (notifications, ...) and return. Jobs live in the
+``jobs`` collection:
+
+  * a worker claims the oldest due job with one ``find_one_and_update`` that
+    sets a lease; a lease that expires (the worker died) makes the job
+    claimable again, and a running job's lease is renewed while it works. A
+    worker that can't renew a lease before it expires, or finds another
+    worker holding it, cancels the job, which may be running elsewhere by then
+  * a failed job is retried with exponential backoff and jitter, up to
+    ``JOB_MAX_ATTEMPTS`` attempts
+  * a job that keeps failing is dead-lettered: it stays in the collection with
+    status ``dead`` and its last error until requeued with
+    ``python jobs.py --retry-dead``
+  * finished jobs are dropped by a TTL index after ``JOB_RETENTION_HOURS``
+
+Since a job can run more than once, handlers must be idempotent.
+
+``WorkerPool`` runs the jobs with a fixed number of asyncio workers. The API
+starts one in each process (``JOB_WORKERS``, 0 to disable) and
+``python jobs.py`` runs one on its own. With ``JOB_QUEUE=inline`` jobs skip the
+collection and run inside ``enqueue``, which is handy for local development
+without a worker.
+"""
+from datetime import datetime, timedelta, timezone
+from time import monotonic, perf_counter
+import asyncio
+import logging
+import os
+import random
+import socket
+import uuid
+
+from pymongo import ReturnDocument
+
+from metrics import REGISTRY
+from ttl_indexes import ensure_ttl_index
+
+COLLECTION = "jobs"
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+DEAD = "dead"
+
+# Job type -> async handler(db, job)
+HANDLERS = {}
+
+logger = logging.getLogger(__name__)
+
+jobs_processed = REGISTRY.counter(
+    "loanease_jobs_processed",
+    "Background jobs finished, by type and outcome (done|retried|dead|lease_lost)",
+    ("type", "outcome"),
+)
+job_duration = REGISTRY.histogram(
+    "loanease_job_duration_seconds",
+    "Background job run time, by type",
+    ("type",),
+)
+
+# Pools running in this process, woken on enqueue so local jobs start without polling delay
+_pools = set()
+
+
+def handler(job_type):
+    """Register an ``async def (db, job)`` handler for ``job_type``"""
+    def register(func):
+        HANDLERS[job_type] = func
+        return func
+    return register
+
+
+def max_attempts():
+    return int(os.environ.get('JOB_MAX_ATTEMPTS', '5'))
+
+
+def retry_delay(attempts):
+    """Exponential backoff with jitter, capped at ``JOB_RETRY_MAX_SECONDS``"""
+    base = float(os.environ.get('JOB_RETRY_BASE_SECONDS', '5'))
+    cap = float(os.environ.get('JOB_RETRY_MAX_SECONDS', '3600'))
+    return min(cap, base * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+
+
+async def ensure_indexes(collection, retention_seconds):
+    await collection.create_index([("status", 1), ("run_at", 1)])
+    await collection.create_index([("status", 1), ("lease_expires_at", 1)])
+    # Only finished jobs carry completed_at, so queued and dead jobs never expire
+    await ensure_ttl_index(collection, "completed_at", retention_seconds)
+
+
+async def enqueue(db, job_type, payload, delay=0):
+    """Queue a job; returns its id"""
+    now = datetime.now(timezone.utc)
+    job = {
+        "_id": str(uuid.uuid4()),
+        "type": job_type,
+        "payload": payload,
+        "status": QUEUED,
+        "attempts": 0,
+        "run_at": now + timedelta(seconds=delay),
+        "created_at": now,
+    }
+    if os.environ.get('JOB_QUEUE', 'mongo') == 'inline':
+        await _run_inline(db, job)
+        return job["_id"]
+
+    await db[COLLECTION].insert_one(job)
+    for pool in _pools:
+        pool.wake()
+    return job["_id"]
+
+
+async def _run_inline(db, job):
+    job["attempts"] = 1
+    start = perf_counter()
+    try:
+        await HANDLERS[job["type"]](db, job)
+        jobs_processed.inc(job["type"], "done")
+    except Exception as e:
+        jobs_processed.inc(job["type"], "dead")
+        logger.error(f"Inline job {job['type']} {job['_id']} failed: {e}")
+    job_duration.observe(perf_counter() - start, job["type"])
+
+
+async def claim(collection, worker_id, lease_seconds):
+    """Lease the oldest due job, or one whose lease has expired; None when idle"""
+    now = datetime.now(timezone.utc)
+    return await collection.find_one_and_update(
+        {"$or": [
+            {"status": QUEUED, "run_at": {"$lte": now}},
+            {"status": RUNNING, "lease_expires_at": {"$lt": now}},
+        ]},
+        {
+            "$set": {
+                "status": RUNNING,
+                "locked_by": worker_id,
+                "lease_expires_at": now + timedelta(seconds=lease_seconds),
+            },
+            "$inc": {"attempts": 1},
+        },
+        sort=[("run_at", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def complete(collection, job, worker_id):
+    await collection.update_one(
+        {"_id": job["_id"], "locked_by": worker_id},
+        {"$set": {"status": DONE, "completed_at": datetime.now(timezone.utc)},
+         "$unset": {"lease_expires_at": "", "locked_by": ""}}
+    )
+
+
+async def fail(collection, job, worker_id, error):
+    """Schedule a retry, or dead-letter the job once it is out of attempts"""
+    now = datetime.now(timezone.utc)
+    update = {"last_error": error[:2000]}
+    if job["attempts"] >= max_attempts():
+        update.update(status=DEAD, dead_at=now)
+    else:
+        update.update(status=QUEUED, run_at=now + timedelta(seconds=retry_delay(job["attempts"])))
+    await collection.update_one(
+        {"_id": job["_id"], "locked_by": worker_id},
+        {"$set": update, "$unset": {"lease_expires_at": "", "locked_by": ""}}
+    )
+    return update["status"]
+
+
+async def release(collection, job, worker_id):
+    """Hand an interrupted job back without counting the attempt"""
+    await collection.update_one(
+        {"_id": job["_id"], "locked_by": worker_id},
+        {"$set": {"status": QUEUED, "run_at": datetime.now(timezone.utc)},
+         "$inc": {"attempts": -1},
+         "$unset": {"lease_expires_at": "", "locked_by": ""}}
+    )
+
+
+async def retry_dead(collection):
+    """Requeue every dead-lettered job with a fresh set of attempts; returns how many"""
+    result = await collection.update_many(
+        {"status": DEAD},
+        {"$set": {"status": QUEUED, "attempts": 0, "run_at": datetime.now(timezone.utc)},
+         "$unset": {"dead_at": ""}}
+    )
+    return result.modified_count
+
+
+class WorkerPool:
+    """``concurrency`` asyncio workers claiming and running jobs until cancelled"""
+
+    def __init__(self, db, concurrency=4, lease_seconds=60, poll_interval=1.0):
+        self.db = db
+        self.collection = db[COLLECTION]
+        self.concurrency = concurrency
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._wakeup = asyncio.Event()
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def run(self):
+        _pools.add(self)
+        try:
+            await asyncio.gather(*(self._worker() for _ in range(self.concurrency)))
+        finally:
+            _pools.discard(self)
+
+    async def run_pending(self):
+        """Run every due job, then return; returns how many ran"""
+        count = 0
+        while await self._run_one():
+            count += 1
+        return count
+
+    async def _worker(self):
+        while True:
+            try:
+                ran = await self._run_one()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Job worker error: {e}")
+                ran = False
+            if not ran:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _renew_lease(self, job, work):
+        """Renew ``job``'s lease while ``work`` runs; cancel ``work`` once the lease is lost"""
+        renewed = monotonic()
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            attempted = monotonic()
+            try:
+                result = await self.collection.update_one(
+                    {"_id": job["_id"], "locked_by": self.worker_id},
+                    {"$set": {"lease_expires_at": datetime.now(timezone.utc) + timedelta(seconds=self.lease_seconds)}}
+                )
+            except Exception as e:
+                if monotonic() - renewed < self.lease_seconds:
+                    logger.warning(f"Renewing the lease of job {job['type']} {job['_id']} failed, will retry: {e}")
+                    continue
+                reason = f"renewing it failed until it expired: {e}"
+            else:
+                if result.matched_count:
+                    renewed = attempted
+                    continue
+                reason = "another worker claimed it after it expired"
+            logger.error(f"Lost the lease of job {job['type']} {job['_id']} ({reason}), cancelling it")
+            work.cancel()
+            return
+
+    async def _run_one(self):
+        job = await claim(self.collection, self.worker_id, self.lease_seconds)
+        if job is None:
+            return False
+
+        job_type = job["type"]
+        start = perf_counter()
+        heartbeat = None
+        try:
+            job_handler = HANDLERS.get(job_type)
+            if job_handler is None:
+                raise LookupError(f"No handler registered for job type {job_type!r}")
+            work = asyncio.ensure_future(job_handler(self.db, job))
+            heartbeat = asyncio.create_task(self._renew_lease(job, work))
+            await work
+        except asyncio.CancelledError:
+            if heartbeat is not None and heartbeat.done() and not heartbeat.cancelled():
+                # The heartbeat cancelled the job; whoever holds the lease now settles it
+                jobs_processed.inc(job_type, "lease_lost")
+                return True
+            await release(self.collection, job, self.worker_id)
+            raise
+        except Exception as e:
+            outcome = await fail(self.collection, job, self.worker_id, f"{type(e).__name__}: {e}")
+            if outcome == DEAD:
+                logger.error(f"Job {job_type} {job['_id']} dead-lettered after {job['attempts']} attempts: {e}")
+            else:
+                logger.warning(f"Job {job_type} {job['_id']} failed (attempt {job['attempts']}), will retry: {e}")
+            jobs_processed.inc(job_type, "retried" if outcome == QUEUED else "dead")
+        else:
+            await complete(self.collection, job, self.worker_id)
+            jobs_processed.inc(job_type, "done")
+        finally:
+            if heartbeat is not None:
+                heartbeat.cancel()
+            job_duration.observe(perf_counter() - start, job_type)
+        return True
+
+
+def pool_from_env(db):
+    return WorkerPool(
+        db,
+        concurrency=int(os.environ.get('JOB_WORKERS', '4')),
+        lease_seconds=int(os.environ.get('JOB_LEASE_SECONDS', '60')),
+        poll_interval=float(os.environ.get('JOB_POLL_INTERVAL_SECONDS', '1')),
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+    from pathlib import Path
+
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Run background jobs outside the API process")
+    parser.add_argument("--drain", action="store_true", help="run the jobs that are due, then exit")
+    parser.add_argument("--retry-dead", action="store_true", help="requeue dead-lettered jobs and exit")
+    args = parser.parse_args()
+
+    async def main():
+        load_dotenv(Path(__file__).parent / '.env')
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        # Import through the module name so the handlers server registers are the ones used here
+        import jobs
+        import server
+
+        client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+        server.db = client[os.environ['DB_NAME']]
+        collection = server.db[jobs.COLLECTION]
+        await jobs.ensure_indexes(collection, int(os.environ.get('JOB_RETENTION_HOURS', '24')) * 3600)
+        try:
+            if args.retry_dead:
+                print(f"Requeued {await jobs.retry_dead(collection)} jobs")
+            elif args.drain:
+                print(f"Ran {await jobs.pool_from_env(server.db).run_pending()} jobs")
+            else:
+                pool = jobs.pool_from_env(server.db)
+                logger.info(f"Job worker {pool.worker_id} running {pool.concurrency} workers")
+                await pool.run()
+        finally:
+            client.close()
+
+    asyncio.run(main())
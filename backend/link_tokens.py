@@ -0,0 +1,139 @@
+"""Hashed index of approval and document-upload link tokens.
+
+Every link token issued to an applicant has a small record in the ``tokens``
+collection, keyed by the SHA-256 of the token, with its purpose,
+application id and expiry. Verifying a link is one point lookup on the unique
+``token_hash`` index instead of a scan of ``loan_applications``. A TTL index
+on ``expires_at`` removes expired links.
+
+The raw token is still kept on the application, so the admin dashboard and
+track page can show the link.
+
+Links issued before this collection existed are indexed by ``backfill``,
+which the API runs at startup, so they keep working after the upgrade. Only
+links that are still usable are indexed (approval links of approved
+applications whose loan isn't accepted yet, upload links of applications
+awaiting documents), so a revoked link is never brought back. It can also be
+run by hand:
+    python link_tokens.py --backfill
+"""
+from datetime import datetime, timedelta, timezone
+import hashlib
+import os
+
+from pymongo.errors import DuplicateKeyError
+
+APPROVAL = "approval"
+DOCUMENT_UPLOAD = "document_upload"
+
+# Application field holding the raw token, per purpose
+TOKEN_FIELDS = {
+    APPROVAL: "approval_token",
+    DOCUMENT_UPLOAD: "document_upload_token",
+}
+
+# Applications whose link of each purpose can still be used
+LIVE = {
+    APPROVAL: {"status": "approved", "banking_info_submitted": {"$ne": True}},
+    DOCUMENT_UPLOAD: {"status": "documents_required"},
+}
+
+
+def token_ttl(purpose):
+    if purpose == APPROVAL:
+        return timedelta(days=int(os.environ.get('APPROVAL_TOKEN_TTL_DAYS', '14')))
+    return timedelta(days=int(os.environ.get('DOCUMENT_UPLOAD_TOKEN_TTL_DAYS', '7')))
+
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+async def ensure_indexes(collection):
+    await collection.create_index("token_hash", unique=True)
+    await collection.create_index("application_id")
+    await collection.create_index("expires_at", expireAfterSeconds=0)
+
+
+async def issue_token(collection, token, purpose, application_id, issued_at=None):
+    """Index a new token, revoking any earlier token for the same purpose and application"""
+    issued_at = issued_at or datetime.now(timezone.utc)
+    await collection.delete_many({"application_id": application_id, "purpose": purpose})
+    await collection.insert_one({
+        "token_hash": hash_token(token),
+        "purpose": purpose,
+        "application_id": application_id,
+        "created_at": issued_at,
+        "expires_at": issued_at + token_ttl(purpose),
+    })
+
+
+async def resolve_token(collection, token, purpose):
+    """Application id for a live token of this purpose, or None"""
+    record = await collection.find_one(
+        {"token_hash": hash_token(token), "purpose": purpose, "expires_at": {"$gt": datetime.now(timezone.utc)}},
+        {"_id": 0, "application_id": 1}
+    )
+    return record["application_id"] if record else None
+
+
+async def revoke_tokens(collection, application_id, purpose):
+    await collection.delete_many({"application_id": application_id, "purpose": purpose})
+
+
+async def _index_missing(collection, purpose, field, applications):
+    hashes = {hash_token(application[field]): application for application in applications}
+    existing = await collection.find({"token_hash": {"$in": list(hashes)}}, {"_id": 0, "token_hash": 1}).to_list(None)
+    count = 0
+    for token_hash in hashes.keys() - {record["token_hash"] for record in existing}:
+        application = hashes[token_hash]
+        try:
+            await issue_token(collection, application[field], purpose, application["id"])
+        except DuplicateKeyError:
+            # Indexed meanwhile by another worker starting up
+            continue
+        count += 1
+    return count
+
+
+async def backfill(db, batch_size=1000):
+    """Index the live raw tokens stored on applications; returns how many were indexed"""
+    count = 0
+    for purpose, field in TOKEN_FIELDS.items():
+        cursor = db.loan_applications.find(
+            dict(LIVE[purpose], **{field: {"$ne": None}}),
+            {"_id": 0, "id": 1, field: 1}
+        )
+        batch = []
+        async for application in cursor:
+            batch.append(application)
+            if len(batch) >= batch_size:
+                count += await _index_missing(db.tokens, purpose, field, batch)
+                batch = []
+        if batch:
+            count += await _index_missing(db.tokens, purpose, field, batch)
+    return count
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+    from pathlib import Path
+
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Manage the link token index")
+    parser.add_argument("--backfill", action="store_true", help="index tokens stored on existing applications")
+    args = parser.parse_args()
+
+    async def main():
+        load_dotenv(Path(__file__).parent / '.env')
+        client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+        db = client[os.environ['DB_NAME']]
+        await ensure_indexes(db.tokens)
+        if args.backfill:
+            print(f"Indexed {await backfill(db)} tokens")
+        client.close()
+
+    asyncio.run(main())
@@ -0,0 +1,268 @@
+"""Prometheus-compatible metrics for the LoanEase API.
+
+Collectors are plain dicts keyed by label tuples so that recording a sample
+is a dict lookup plus an addition, under a lock per collector: the MongoDB
+command listener records from the threads Motor runs pymongo on, concurrently
+with the event loop. Everything is rendered on demand in the Prometheus text
+exposition format (version 0.0.4) by ``/metrics``.
+"""
+from bisect import bisect_left
+from time import perf_counter
+import threading
+
+from pymongo import monitoring
+
+CONTENT_TYPE_LATEST = "text/plain; version=0.0.4; charset=utf-8"
+
+# Buckets in seconds, tuned for an API whose handlers mostly sit in the 1-100ms range
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Counter:
+    """Monotonically increasing counter"""
+    type_name = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        return self._values.get(labels, 0)
+
+    def _snapshot(self):
+        with self._lock:
+            return sorted(self._values.items())
+
+    def collect(self):
+        for labels, value in self._snapshot():
+            yield f"{self.name}_total{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    """Value that can go up and down"""
+    type_name = "gauge"
+
+    def set(self, *labels, value):
+        with self._lock:
+            self._values[labels] = value
+
+    def dec(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) - amount
+
+    def collect(self):
+        for labels, value in self._snapshot():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Histogram:
+    """Fixed-bucket histogram; per-bucket counts are cumulated only at render time"""
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # [bucket counts..., +Inf count, sum]
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def count(self, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            return sum(series[:-1]) if series else 0
+
+    def collect(self):
+        with self._lock:
+            snapshot = sorted((labels, list(series)) for labels, series in self._series.items())
+        for labels, series in snapshot:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += bucket_count
+                le = f'le="{_format_value(float(bound))}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(series[-1])}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self._collectors = []
+
+    def register(self, collector):
+        self._collectors.append(collector)
+        return collector
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        lines = []
+        for collector in self._collectors:
+            lines.append(f"# HELP {collector.name} {collector.documentation}")
+            lines.append(f"# TYPE {collector.name} {collector.type_name}")
+            lines.extend(collector.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+http_requests = REGISTRY.counter(
+    "loanease_http_requests",
+    "HTTP requests handled, by method, route template and status code",
+    ("method", "route", "status"),
+)
+http_request_duration = REGISTRY.histogram(
+    "loanease_http_request_duration_seconds",
+    "HTTP request latency, by method, route template and status code",
+    ("method", "route", "status"),
+)
+http_requests_in_progress = REGISTRY.gauge(
+    "loanease_http_requests_in_progress",
+    "HTTP requests currently being handled",
+)
+mongo_command_duration = REGISTRY.histogram(
+    "loanease_mongo_command_duration_seconds",
+    "MongoDB command latency as reported by the driver, by collection and operation",
+    ("collection", "operation", "outcome"),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+)
+upload_bytes = REGISTRY.counter(
+    "loanease_upload_bytes",
+    "Bytes received through document uploads, by content type",
+    ("content_type",),
+)
+cache_requests = REGISTRY.counter(
+    "loanease_cache_requests",
+    "Cache lookups, by cache name and result (hit or miss)",
+    ("cache", "result"),
+)
+
+
+def record_cache(cache, hit):
+    cache_requests.inc(cache, "hit" if hit else "miss")
+
+
+_route_paths = {}
+
+
+def route_label(scope):
+    """Route template for a routed request scope, or ``unmatched``"""
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return "unmatched"
+    path = _route_paths.get(endpoint)
+    if path is None:
+        for route in scope["app"].router.routes:
+            if hasattr(route, "endpoint"):
+                _route_paths[route.endpoint] = route.path
+        path = _route_paths.setdefault(endpoint, "unmatched")
+    return path
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware recording request count and latency per route template.
+
+    Route templates (``/api/applications/{application_id}``) are used as labels
+    instead of raw paths so cardinality stays bounded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        http_requests_in_progress.inc()
+        start = perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = perf_counter() - start
+            http_requests_in_progress.dec()
+            labels = (scope["method"], route_label(scope), str(status_code))
+            http_requests.inc(*labels)
+            http_request_duration.observe(elapsed, *labels)
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """pymongo command listener feeding ``mongo_command_duration``.
+
+    Motor runs pymongo on executor threads, so callbacks arrive from those
+    threads concurrently; the pending map is guarded like the metrics are.
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        name = event.command_name
+        collection = event.command.get(name)
+        if not isinstance(collection, str):
+            collection = "-"
+        with self._lock:
+            self._pending[(event.connection_id, event.request_id)] = collection
+
+    def _finish(self, event, outcome):
+        with self._lock:
+            collection = self._pending.pop((event.connection_id, event.request_id), "-")
+        mongo_command_duration.observe(event.duration_micros / 1e6, collection, event.command_name, outcome)
+
+    def succeeded(self, event):
+        self._finish(event, "success")
+
+    def failed(self, event):
+        self._finish(event, "failure")
@@ -0,0 +1,117 @@
+"""Retention policy for the notifications collection.
+
+Read notifications older than ``NOTIFICATION_RETENTION_DAYS`` are moved in
+bounded batches to ``notifications_archive``, which is created with zstd block
+compression. A TTL index drops archived notifications after
+``NOTIFICATION_ARCHIVE_TTL_DAYS``. Unread notifications are never archived.
+
+Each batch is copied with upserts keyed by ``_id`` before the originals are
+deleted. That makes a batch safe to repeat, so every worker can run the
+archiver and an interrupted run loses nothing.
+
+Run once from the command line with:
+    python notification_retention.py
+"""
+from datetime import datetime, timedelta, timezone
+import asyncio
+import logging
+import os
+
+from pymongo import ReplaceOne
+from pymongo.errors import CollectionInvalid, OperationFailure
+
+from ttl_indexes import ensure_ttl_index
+
+ARCHIVE = "notifications_archive"
+
+NAMESPACE_EXISTS = 48
+
+logger = logging.getLogger(__name__)
+
+
+async def ensure_indexes(db, archive_ttl_days):
+    if ARCHIVE not in await db.list_collection_names():
+        try:
+            await db.create_collection(
+                ARCHIVE, storageEngine={"wiredTiger": {"configString": "block_compressor=zstd"}}
+            )
+        except CollectionInvalid:
+            # Another worker starting alongside created it first
+            pass
+        except OperationFailure as e:
+            if e.code != NAMESPACE_EXISTS:
+                raise
+    # Serves the archiver's scan of old read notifications
+    await db.notifications.create_index([("read", 1), ("created_at", 1)])
+    archive = db[ARCHIVE]
+    await archive.create_index([("application_id", 1), ("created_at", -1)])
+    await archive.create_index([("recipient_email", 1), ("recipient_type", 1), ("created_at", -1)])
+    await ensure_ttl_index(archive, "archived_at", archive_ttl_days * 86400)
+
+
+async def archive_batch(db, cutoff, batch_size):
+    """Move up to ``batch_size`` read notifications created before ``cutoff``; returns how many"""
+    # created_at is stored as an ISO-8601 UTC string, which sorts chronologically
+    batch = await db.notifications.find(
+        {"read": True, "created_at": {"$lt": cutoff.isoformat()}}
+    ).sort("created_at", 1).to_list(batch_size)
+    if not batch:
+        return 0
+
+    archived_at = datetime.now(timezone.utc)
+    await db[ARCHIVE].bulk_write(
+        [ReplaceOne({"_id": doc["_id"]}, dict(doc, archived_at=archived_at), upsert=True) for doc in batch],
+        ordered=False
+    )
+    await db.notifications.delete_many({"_id": {"$in": [doc["_id"] for doc in batch]}})
+    return len(batch)
+
+
+async def archive_old_notifications(db, retention_days, batch_size=1000, max_batches=None):
+    """Archive everything past retention, one batch at a time; returns the total moved"""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=retention_days)
+    total = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        moved = await archive_batch(db, cutoff, batch_size)
+        total += moved
+        batches += 1
+        if moved < batch_size:
+            break
+        # Give request handlers a turn between batches
+        await asyncio.sleep(0)
+    return total
+
+
+async def run_archiver(db, retention_days, batch_size, interval_seconds):
+    """Background loop started by the app lifespan"""
+    while True:
+        try:
+            moved = await archive_old_notifications(db, retention_days, batch_size)
+            if moved:
+                logger.info(f"Archived {moved} notifications older than {retention_days} days")
+        except Exception as e:
+            logger.error(f"Notification archiving failed: {e}")
+        await asyncio.sleep(interval_seconds)
+
+
+if __name__ == "__main__":
+    from pathlib import Path
+
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    async def main():
+        load_dotenv(Path(__file__).parent / '.env')
+        client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+        db = client[os.environ['DB_NAME']]
+        await ensure_indexes(db, int(os.environ.get('NOTIFICATION_ARCHIVE_TTL_DAYS', '365')))
+        moved = await archive_old_notifications(
+            db,
+            int(os.environ.get('NOTIFICATION_RETENTION_DAYS', '30')),
+            int(os.environ.get('NOTIFICATION_ARCHIVE_BATCH', '1000')),
+        )
+        print(f"Archived {moved} notifications")
+        client.close()
+
+    asyncio.run(main())
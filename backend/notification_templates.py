@@ -0,0 +1,209 @@
+"""Subjects and bodies of the notifications the API sends.
+
+Each template is written as a ``str.format`` string and compiled, when this
+module is imported, into a function that renders it as an f-string.
+``render`` formats only the requested template, so a status change renders
+one message instead of building every status's text to pick one.
+
+Applicant-facing templates have locale variants. A notification is rendered in
+the application's ``locale`` when a variant exists, falling back from e.g.
+``es-MX`` to ``es`` and then to ``NOTIFICATION_DEFAULT_LOCALE`` (``en``).
+"""
+from functools import lru_cache
+from string import Formatter
+import os
+
+SIGNATURE = {
+    "en": "Best regards,\nLoanEase Team",
+    "es": "Saludos cordiales,\nEquipo de LoanEase",
+}
+
+# Template name -> locale -> (subject, message)
+SOURCES = {
+    "application_received.admin": {
+        "en": (
+            "New Loan Application Received",
+            "A new loan application has been submitted by {first_name} {last_name} for ${loan_amount:,.2f}. "
+            "Application ID: {ref}",
+        ),
+    },
+    "application_received.applicant": {
+        "en": (
+            "Application Received - LoanEase",
+            "Dear {first_name},\n\nThank you for submitting your loan application. Your application reference is {ref}.\n\n"
+            "We will review your application and get back to you within 24-48 hours.\n\n" + SIGNATURE["en"],
+        ),
+        "es": (
+            "Solicitud recibida - LoanEase",
+            "Estimado/a {first_name}:\n\nGracias por enviar su solicitud de préstamo. La referencia de su solicitud es {ref}.\n\n"
+            "Revisaremos su solicitud y le responderemos en un plazo de 24 a 48 horas.\n\n" + SIGNATURE["es"],
+        ),
+    },
+    "status.under_review": {
+        "en": (
+            "Application Under Review - LoanEase",
+            "Dear {first_name},\n\nYour loan application (Ref: {ref}) is now under review. "
+            "Our team is carefully evaluating your application.\n\n"
+            "We will notify you once a decision has been made.\n\n" + SIGNATURE["en"],
+        ),
+        "es": (
+            "Solicitud en revisión - LoanEase",
+            "Estimado/a {first_name}:\n\nSu solicitud de préstamo (Ref: {ref}) está ahora en revisión. "
+            "Nuestro equipo está evaluando su solicitud con atención.\n\n"
+            "Le avisaremos en cuanto se haya tomado una decisión.\n\n" + SIGNATURE["es"],
+        ),
+    },
+    "status.approved": {
+        "en": (
+            "🎉 Application Approved - LoanEase",
+            "Dear {first_name},\n\nCongratulations! Your loan application (Ref: {ref}) has been APPROVED!\n\n"
+            "Loan Amount: ${loan_amount:,.2f}\n\n"
+            "To complete your loan and receive funds, please click the link below to accept the terms "
+            "and provide your banking information:\n\n[Complete Your Loan]\n\n"
+            "This is your unique secure link. Do not share it with anyone.\n\n" + SIGNATURE["en"],
+        ),
+        "es": (
+            "🎉 Solicitud aprobada - LoanEase",
+            "Estimado/a {first_name}:\n\n¡Felicidades! Su solicitud de préstamo (Ref: {ref}) ha sido APROBADA.\n\n"
+            "Monto del préstamo: ${loan_amount:,.2f}\n\n"
+            "Para completar su préstamo y recibir los fondos, haga clic en el enlace de abajo para aceptar "
+            "las condiciones e indicar sus datos bancarios:\n\n[Completar su préstamo]\n\n"
+            "Este enlace es único y seguro. No lo comparta con nadie.\n\n" + SIGNATURE["es"],
+        ),
+    },
+    "status.rejected": {
+        "en": (
+            "Application Update - LoanEase",
+            "Dear {first_name},\n\nWe regret to inform you that your loan application (Ref: {ref}) "
+            "has been declined at this time.\n\n"
+            "If you have any questions, please don't hesitate to contact us.\n\n" + SIGNATURE["en"],
+        ),
+        "es": (
+            "Actualización de su solicitud - LoanEase",
+            "Estimado/a {first_name}:\n\nLamentamos informarle que su solicitud de préstamo (Ref: {ref}) "
+            "no ha sido aprobada en este momento.\n\n"
+            "Si tiene alguna pregunta, no dude en ponerse en contacto con nosotros.\n\n" + SIGNATURE["es"],
+        ),
+    },
+    "status.pending": {
+        "en": (
+            "Application Status Update - LoanEase",
+            "Dear {first_name},\n\nYour loan application (Ref: {ref}) status has been updated to pending.\n\n"
+            + SIGNATURE["en"],
+        ),
+        "es": (
+            "Actualización del estado de su solicitud - LoanEase",
+            "Estimado/a {first_name}:\n\nEl estado de su solicitud de préstamo (Ref: {ref}) se ha cambiado a pendiente.\n\n"
+            + SIGNATURE["es"],
+        ),
+    },
+    "status.documents_required": {
+        "en": (
+            "📄 Documents Required - LoanEase",
+            "Dear {first_name},\n\nWe need additional documents to process your loan application (Ref: {ref}).\n\n"
+            "{document_request_message}\n\n"
+            "Please visit our Track Application page and enter your email to upload the required documents.\n\n"
+            + SIGNATURE["en"],
+        ),
+        "es": (
+            "📄 Documentos requeridos - LoanEase",
+            "Estimado/a {first_name}:\n\nNecesitamos documentos adicionales para tramitar su solicitud de préstamo "
+            "(Ref: {ref}).\n\n{document_request_message}\n\n"
+            "Visite nuestra página Seguimiento de solicitud e introduzca su correo electrónico para subir "
+            "los documentos requeridos.\n\n" + SIGNATURE["es"],
+        ),
+    },
+    "status_changed.admin": {
+        "en": (
+            "Application Status Changed: {old_status} → {new_status}",
+            "Application {ref} for {first_name} {last_name} has been updated from {old_status} to {new_status}.",
+        ),
+    },
+    "document_uploaded.admin": {
+        "en": (
+            "Document Uploaded",
+            "A new document '{filename}' has been uploaded for application {ref} by {first_name} {last_name}.",
+        ),
+    },
+    "loan_accepted.applicant": {
+        "en": (
+            "Loan Accepted - Funds Processing",
+            "Dear {first_name},\n\nThank you for accepting your loan terms and providing your banking information.\n\n"
+            "Loan Amount: ${loan_amount:,.2f}\n\n"
+            "Your funds will be disbursed to your account ending in {account_last_four} within 1-3 business days.\n\n"
+            + SIGNATURE["en"],
+        ),
+        "es": (
+            "Préstamo aceptado - Fondos en proceso",
+            "Estimado/a {first_name}:\n\nGracias por aceptar las condiciones de su préstamo e indicar sus datos bancarios.\n\n"
+            "Monto del préstamo: ${loan_amount:,.2f}\n\n"
+            "Los fondos se depositarán en su cuenta terminada en {account_last_four} en un plazo de 1 a 3 días hábiles.\n\n"
+            + SIGNATURE["es"],
+        ),
+    },
+    "loan_accepted.admin": {
+        "en": (
+            "Loan Accepted - Banking Info Submitted",
+            "Application {ref} for {first_name} {last_name} has accepted the loan and submitted banking information.\n\n"
+            "Account ending: {account_last_four}\nCard ending: {card_last_four}\n\nReady for disbursement.",
+        ),
+    },
+}
+
+
+class Template:
+    """A subject and message pair, compiled once into an f-string function"""
+
+    __slots__ = ("fields", "render")
+
+    def __init__(self, subject, message):
+        # Parsing raises on malformed placeholders, so a broken template fails at import
+        fields = set()
+        for text in (subject, message):
+            for _, field, _, _ in Formatter().parse(text):
+                if field is not None and not field.isidentifier():
+                    raise ValueError(f"Template placeholder {{{field}}} is not a plain name")
+                if field:
+                    fields.add(field)
+        self.fields = frozenset(fields)
+        # str.format placeholders are valid f-string fields, so each text becomes an f-string literal
+        source = "def render(values):\n" + "".join(
+            f"    {field} = values[{field!r}]\n" for field in sorted(fields)
+        ) + f"    return {{'subject': f{subject!r}, 'message': f{message!r}}}\n"
+        namespace = {}
+        exec(compile(source, f"<template {subject!r}>", "exec"), namespace)
+        self.render = namespace["render"]
+
+
+# (template name, locale) -> Template
+TEMPLATES = {
+    (name, locale): Template(subject, message)
+    for name, variants in SOURCES.items()
+    for locale, (subject, message) in variants.items()
+}
+
+# Callers pass the same values whatever the locale, so every variant must use exactly those
+for (name, locale), template in TEMPLATES.items():
+    if template.fields != TEMPLATES[(name, "en")].fields:
+        raise ValueError(f"Template {name} ({locale}) uses different values than its English version")
+
+
+def default_locale():
+    return os.environ.get('NOTIFICATION_DEFAULT_LOCALE', 'en')
+
+
+# Locales come from applicants, so only the most recent ones are remembered
+@lru_cache(maxsize=1024)
+def resolve(name, locale=None):
+    """The template to use for ``name`` in ``locale``, after falling back to the language and the default"""
+    candidates = []
+    if locale:
+        locale = locale.lower().replace("_", "-")
+        candidates += [locale, locale.split("-")[0]]
+    candidates += [default_locale(), "en"]
+    return next(TEMPLATES[(name, candidate)] for candidate in candidates if (name, candidate) in TEMPLATES)
+
+
+def render(name, locale, values):
+    """``{"subject": ..., "message": ...}`` of one notification; ``values`` may hold more than it uses"""
+    return resolve(name, locale).render(values)
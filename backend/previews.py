@@ -0,0 +1,151 @@
+"""Thumbnails and first-page previews of uploaded documents.
+
+Each upload is rendered, once, into small JPEG and WebP images:
+    thumb   fits in 200x200, for document lists
+    page    fits in 1024x1024, for reading the document without downloading it
+PDFs are rendered from their first page (pypdfium2), images are EXIF-rotated
+and flattened onto white (Pillow).
+
+Rendering is CPU-bound, so it runs in a ``ProcessPoolExecutor`` of
+``PREVIEW_PROCESSES`` spawned processes and never on the event loop.
+Renditions are cached under ``backend/previews`` keyed by the SHA-256 of the
+uploaded file, so identical uploads share them and a cached file never goes
+stale. Uploads queue a ``generate_previews`` job; the preview endpoint renders
+on demand when the job hasn't run yet.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import uuid
+
+import aiofiles.os
+
+# Rendition name -> longest side in pixels
+SIZES = {
+    "thumb": 200,
+    "page": 1024,
+}
+
+# Format name -> (Pillow format, media type, save options)
+FORMATS = {
+    "webp": ("WEBP", "image/webp", {"quality": 75, "method": 4}),
+    "jpeg": ("JPEG", "image/jpeg", {"quality": 80, "optimize": True, "progressive": True}),
+}
+
+PDF_TYPES = {"application/pdf"}
+IMAGE_TYPES = {"image/jpeg", "image/jpg", "image/png", "image/webp"}
+
+_executor = None
+
+# sha256 -> future for renders in flight, so concurrent requests share one render
+_rendering = {}
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_path(cache_dir, sha256, size, fmt):
+    return Path(cache_dir) / sha256[:2] / f"{sha256}-{size}.{fmt}"
+
+
+async def is_cached(cache_dir, sha256):
+    for size in SIZES:
+        for fmt in FORMATS:
+            if not await aiofiles.os.path.exists(cache_path(cache_dir, sha256, size, fmt)):
+                return False
+    return True
+
+
+def supports(content_type):
+    return content_type in PDF_TYPES or content_type in IMAGE_TYPES
+
+
+def _open_source(source_path, content_type):
+    from PIL import Image, ImageOps
+
+    largest = max(SIZES.values())
+    if content_type in PDF_TYPES:
+        import pypdfium2
+
+        pdf = pypdfium2.PdfDocument(source_path)
+        try:
+            page = pdf[0]
+            width, height = page.get_size()
+            image = page.render(scale=largest / max(width, height)).to_pil()
+            page.close()
+        finally:
+            pdf.close()
+    else:
+        image = Image.open(source_path)
+        # Let the JPEG decoder downscale while decoding instead of after
+        image.draft("RGB", (largest, largest))
+        image = ImageOps.exif_transpose(image)
+
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    return image.convert("RGB")
+
+
+def render(source_path, content_type, sha256, cache_dir):
+    """Write every rendition of one document; runs in a worker process"""
+    from PIL import Image
+
+    image = _open_source(source_path, content_type)
+    # Largest first, so each smaller rendition is resized from the previous one
+    for size, longest in sorted(SIZES.items(), key=lambda item: -item[1]):
+        image.thumbnail((longest, longest), Image.LANCZOS)
+        for fmt, (pil_format, _, options) in FORMATS.items():
+            target = cache_path(cache_dir, sha256, size, fmt)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            # Write then rename, so readers never see a partial file
+            partial = target.with_name(f".{target.name}.{uuid.uuid4().hex}")
+            image.save(partial, pil_format, **options)
+            os.replace(partial, target)
+
+
+def executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=int(os.environ.get('PREVIEW_PROCESSES', '2')),
+            # Forking a process that runs an event loop and driver threads is unsafe
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def ensure_previews(source_path, content_type, sha256, cache_dir):
+    """Render the document's previews unless they are already cached"""
+    if await is_cached(cache_dir, sha256):
+        return
+    future = _rendering.get(sha256)
+    if future is None:
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(executor(), render, str(source_path), content_type, sha256, str(cache_dir))
+        _rendering[sha256] = future
+        future.add_done_callback(lambda _: _rendering.pop(sha256, None))
+    try:
+        await asyncio.shield(future)
+    except BrokenProcessPool:
+        # A worker died (e.g. killed for memory); start a fresh pool for the next render
+        shutdown()
+        raise
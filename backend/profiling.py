@@ -0,0 +1,163 @@
+"""Opt-in per-request profiling with flame-graph dumps.
+
+A request is profiled when it carries the admin profiling header or is picked
+by the sampling rate. While it runs, a background thread samples the event
+loop thread's Python stack every ``interval`` seconds. The collected stacks
+are written as a speedscope profile (open at https://www.speedscope.app) and
+as folded stacks for ``flamegraph.pl``.
+
+The sampler sees the whole event loop thread, so other requests interleaved
+with the profiled one show up in its profile too. Profile under light load,
+or use the sampling rate and read many profiles together.
+
+When profiling is disabled the middleware is not installed at all, so there
+is no per-request overhead.
+"""
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+from time import perf_counter
+import asyncio
+import hmac
+import json
+import logging
+import random
+import re
+import sys
+import threading
+
+from metrics import route_label
+
+PROFILE_HEADER = b"x-admin-profile"
+
+logger = logging.getLogger(__name__)
+
+
+class StackSampler:
+    """Samples the stack of one thread from a daemon thread"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            stack.reverse()
+            self.samples[tuple(stack)] += 1
+
+
+def to_speedscope(samples, name, interval):
+    """Render sampled stacks as a speedscope 'sampled' profile"""
+    frames = []
+    frame_index = {}
+    profile_samples = []
+    weights = []
+    for stack, count in samples.items():
+        indices = []
+        for frame in stack:
+            index = frame_index.get(frame)
+            if index is None:
+                index = frame_index[frame] = len(frames)
+                frames.append({"name": frame[0], "file": frame[1], "line": frame[2]})
+            indices.append(index)
+        profile_samples.append(indices)
+        weights.append(count * interval * 1000)
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "shared": {"frames": frames},
+        "profiles": [{
+            "type": "sampled",
+            "name": name,
+            "unit": "milliseconds",
+            "startValue": 0,
+            "endValue": sum(weights),
+            "samples": profile_samples,
+            "weights": weights,
+        }],
+        "name": name,
+        "exporter": "loanease-profiler",
+    }
+
+
+def to_folded(samples):
+    """Render sampled stacks in Brendan Gregg's folded format"""
+    lines = []
+    for stack, count in samples.items():
+        names = [f"{name} ({Path(filename).name}:{line})" for name, filename, line in stack]
+        lines.append(f"{';'.join(names)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+class ProfilingMiddleware:
+    """Pure ASGI middleware profiling selected requests and dumping flame graphs"""
+
+    def __init__(self, app, output_dir, admin_token, sample_rate=0.0, interval=0.001):
+        self.app = app
+        self.output_dir = Path(output_dir)
+        self.admin_token = admin_token.encode()
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+
+    def _should_profile(self, scope):
+        for key, value in scope["headers"]:
+            if key == PROFILE_HEADER:
+                return hmac.compare_digest(value, self.admin_token)
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        sampler = StackSampler(threading.get_ident(), self.interval)
+        sampler.start()
+        start = perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = perf_counter() - start
+            sampler.stop()
+            await asyncio.to_thread(
+                self._dump, sampler.samples, scope["method"], route_label(scope), status_code, elapsed
+            )
+
+    def _dump(self, samples, method, route, status_code, elapsed):
+        elapsed_ms = elapsed * 1000
+        name = f"{method} {route} {status_code} {elapsed_ms:.1f}ms"
+        slug = re.sub(r"[^A-Za-z0-9]+", "-", route).strip("-") or "root"
+        timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+        stem = f"{timestamp}_{method}_{slug}_{status_code}_{elapsed_ms:.0f}ms"
+        try:
+            (self.output_dir / f"{stem}.speedscope.json").write_text(
+                json.dumps(to_speedscope(samples, name, self.interval))
+            )
+            (self.output_dir / f"{stem}.folded").write_text(to_folded(samples))
+        except OSError as e:
+            logger.error(f"Failed to write request profile {stem}: {e}")
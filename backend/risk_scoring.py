@@ -0,0 +1,234 @@
+"""Risk scores of loan applications, computed in columnar batches with NumPy.
+
+Every application carries the score of the model version that computed it:
+
+    risk: {score, band, loan_to_income, model, scored_at}
+
+``score`` runs from 0 (lowest risk) to 100. It is the logistic function of a
+weighted sum of the loan-to-income ratio, the log of annual income relative
+to ``REFERENCE_INCOME`` and a weight per employment status. ``band`` is
+``low``, ``medium`` or ``high``. New applications are scored when they are
+submitted.
+
+Changing the model means changing ``MODEL`` and its ``version``. A rescore
+then reads the applications scored by any other version ``batch_size`` at a
+time, as one NumPy array per input column. It scores each batch in a process
+pool of ``RISK_PROCESSES`` spawned processes, off the event loop, and writes
+the batch back with one unordered ``bulk_write``, overlapped with reading and
+scoring the next batch. Run one with the API's ``POST /api/risk/rescore``,
+which queues a ``rescore_portfolio`` job, or with:
+    python risk_scoring.py --rescore
+"""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
+from time import perf_counter
+import asyncio
+import multiprocessing
+import os
+
+import numpy as np
+from pymongo import UpdateOne
+
+from metrics import REGISTRY
+
+MODEL = {
+    "version": "2026-10-19.1",
+    "intercept": -2.5,
+    # Per unit of loan amount over annual income; ratios above the cap count as the cap
+    "loan_to_income": 8.0,
+    "loan_to_income_cap": 2.0,
+    # Per unit of ln(annual income / REFERENCE_INCOME)
+    "log_income": -0.4,
+    "employment_status": {
+        "employed": 0.0,
+        "retired": 0.2,
+        "self_employed": 0.35,
+        "student": 0.6,
+        "unemployed": 1.2,
+    },
+    # Statuses the model doesn't know
+    "employment_status_default": 0.5,
+    # Band -> scores below this bound (the last band takes the rest)
+    "bands": {"low": 20, "medium": 50, "high": None},
+}
+
+REFERENCE_INCOME = 50000.0
+
+# Employment status codes the parent process sends to workers; the last is "unknown"
+EMPLOYMENT_STATUSES = list(MODEL["employment_status"])
+EMPLOYMENT_CODES = {status: code for code, status in enumerate(EMPLOYMENT_STATUSES)}
+UNKNOWN_EMPLOYMENT = len(EMPLOYMENT_STATUSES)
+
+BANDS = list(MODEL["bands"])
+
+_executor = None
+
+applications_scored = REGISTRY.counter(
+    "loanease_risk_scored_applications",
+    "Applications given a risk score, by trigger (submission|rescore)",
+    ("trigger",),
+)
+rescore_duration = REGISTRY.histogram(
+    "loanease_risk_rescore_seconds",
+    "Time to rescore every application not scored by the current model",
+)
+
+
+async def ensure_indexes(db):
+    # Rescoring reads the applications scored by another model version
+    await db.loan_applications.create_index("risk.model")
+
+
+def batch_size():
+    return int(os.environ.get('RISK_BATCH_SIZE', '10000'))
+
+
+def score_columns(annual_income, loan_amount, employment_code):
+    """(loan_to_income, score, band code) arrays of one batch; runs in a worker process"""
+    # Legacy applications may lack an income; they score as if it were 1
+    income = np.maximum(np.nan_to_num(annual_income, nan=1.0), 1.0)
+    loan_to_income = np.nan_to_num(loan_amount, nan=0.0) / income
+    weights = np.append(
+        np.array([MODEL["employment_status"][status] for status in EMPLOYMENT_STATUSES]),
+        MODEL["employment_status_default"],
+    )
+    logit = (
+        MODEL["intercept"]
+        + MODEL["loan_to_income"] * np.minimum(loan_to_income, MODEL["loan_to_income_cap"])
+        + MODEL["log_income"] * np.log(income / REFERENCE_INCOME)
+        + weights[employment_code]
+    )
+    score = np.round(100.0 / (1.0 + np.exp(-logit)), 1)
+    bounds = np.array([bound for bound in MODEL["bands"].values() if bound is not None])
+    band = np.searchsorted(bounds, score, side="right").astype(np.int8)
+    return loan_to_income, score, band
+
+
+def columns(applications):
+    """The model's input columns of a batch of application documents"""
+    return (
+        np.array([application.get("annual_income") for application in applications], dtype=np.float64),
+        np.array([application.get("loan_amount_requested") for application in applications], dtype=np.float64),
+        np.fromiter(
+            (EMPLOYMENT_CODES.get(application.get("employment_status"), UNKNOWN_EMPLOYMENT)
+             for application in applications),
+            dtype=np.int8, count=len(applications),
+        ),
+    )
+
+
+def risk_documents(loan_to_income, score, band, scored_at):
+    """The ``risk`` subdocuments of a scored batch"""
+    return [
+        {
+            "score": value,
+            "band": BANDS[band_code],
+            "loan_to_income": round(ratio, 4),
+            "model": MODEL["version"],
+            "scored_at": scored_at,
+        }
+        for ratio, value, band_code in zip(loan_to_income.tolist(), score.tolist(), band.tolist())
+    ]
+
+
+def score_application(application):
+    """The ``risk`` of one application, computed in-process; for new applications"""
+    applications_scored.inc("submission")
+    return risk_documents(
+        *score_columns(*columns([application])), datetime.now(timezone.utc).isoformat()
+    )[0]
+
+
+def executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=int(os.environ.get('RISK_PROCESSES', '2')),
+            # Forking a process that runs an event loop and driver threads is unsafe
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def _batches(cursor, size):
+    batch = []
+    async for application in cursor:
+        batch.append(application)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def rescore(db, rescore_all=False, size=None):
+    """Score every application the current model hasn't; returns how many were written"""
+    start = perf_counter()
+    loop = asyncio.get_running_loop()
+    query = {} if rescore_all else {"risk.model": {"$ne": MODEL["version"]}}
+    cursor = db.loan_applications.find(
+        query, {"_id": 1, "annual_income": 1, "loan_amount_requested": 1, "employment_status": 1}
+    ).batch_size(size or batch_size())
+    scored_at = datetime.now(timezone.utc).isoformat()
+    written = 0
+    pending = None
+    try:
+        async for applications in _batches(cursor, size or batch_size()):
+            try:
+                results = await loop.run_in_executor(executor(), score_columns, *columns(applications))
+            except BrokenProcessPool:
+                # A worker died (e.g. killed for memory); start a fresh pool for the next rescore
+                shutdown()
+                raise
+            requests = [
+                UpdateOne({"_id": application["_id"]}, {"$set": {"risk": risk}})
+                for application, risk in zip(applications, risk_documents(*results, scored_at))
+            ]
+            # The previous batch is written while this one is read and scored
+            if pending:
+                written += (await pending).modified_count
+            pending = asyncio.ensure_future(db.loan_applications.bulk_write(requests, ordered=False))
+            applications_scored.inc("rescore", amount=len(requests))
+        if pending:
+            written += (await pending).modified_count
+            pending = None
+    finally:
+        if pending:
+            pending.cancel()
+    rescore_duration.observe(perf_counter() - start)
+    return written
+
+
+if __name__ == "__main__":
+    import argparse
+    from pathlib import Path
+
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Score loan applications with the current risk model")
+    parser.add_argument("--rescore", action="store_true", help="score applications scored by another model")
+    parser.add_argument("--all", action="store_true", help="with --rescore, score every application")
+    args = parser.parse_args()
+
+    async def main():
+        load_dotenv(Path(__file__).parent / '.env')
+        client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+        db = client[os.environ['DB_NAME']]
+        await ensure_indexes(db)
+        if args.rescore:
+            start = perf_counter()
+            written = await rescore(db, rescore_all=args.all)
+            print(f"Scored {written} applications with model {MODEL['version']} in {perf_counter() - start:.1f}s")
+        client.close()
+        shutdown()
+
+    asyncio.run(main())
@@ -1,31 +1,48 @@
-from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Header, Query
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from dotenv import load_dotenv
+from contextlib import asynccontextmanager
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import DuplicateKeyError
 import os
+import asyncio
 import logging
-import aiofiles
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
 from typing import List, Optional, Literal
 import uuid
-from datetime import datetime, timezone
+import hashlib
+from datetime import datetime, timedelta, timezone
+from metrics import REGISTRY, CONTENT_TYPE_LATEST, MetricsMiddleware, MongoCommandListener, record_cache, upload_bytes
+from profiling import ProfilingMiddleware
+from admission import AdmissionMiddleware, load_policies
+import idempotency
+import link_tokens
+import notification_retention
+import applicant_search
+import applicant_email
+import jobs
+import previews
+import image_normalization
+import zip_stream
+import upload_storage
+import notification_templates
+import email_delivery
+import analytics
+import status_transitions
+import columnar_export
+import risk_scoring
 
 ROOT_DIR = Path(__file__).parent
-load_dotenv(ROOT_DIR / '.env')
-
-# Create uploads directory
 UPLOAD_DIR = ROOT_DIR / "uploads"
-UPLOAD_DIR.mkdir(exist_ok=True)
+PREVIEW_DIR = ROOT_DIR / "previews"
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# MongoDB connection, opened per worker process by the app lifespan
+client = None
+db = None
 
-# Create the main app without a prefix
-app = FastAPI()
+logger = logging.getLogger(__name__)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -49,6 +66,7 @@ class LoanApplicationCreate(BaseModel):
     employment_status: str = Field(...)
     loan_amount_requested: float = Field(..., ge=100, le=5000)
     ssn_last_four: str = Field(..., min_length=4, max_length=4)
+    locale: Optional[str] = Field(None, max_length=35)
 
 
 class LoanApplication(BaseModel):
@@ -68,6 +86,7 @@ class LoanApplication(BaseModel):
     employment_status: str
     loan_amount_requested: float
     ssn_last_four: str
+    locale: Optional[str] = None
     status: str = "pending"
     approval_token: Optional[str] = None
     loan_accepted: bool = False
@@ -76,6 +95,8 @@ class LoanApplication(BaseModel):
     document_request_message: Optional[str] = None
     documents: List[dict] = []
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    # Score of the risk model: score (0-100), band, loan_to_income, model, scored_at
+    risk: Optional[dict] = None
 
 
 class StatusUpdate(BaseModel):
@@ -94,6 +115,8 @@ class Notification(BaseModel):
     message: str
     read: bool = False
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    # Email delivery of applicant notifications: pending, sending, sent or failed
+    delivery_status: Optional[str] = None
 
 
 class AdminLoginRequest(BaseModel):
@@ -116,6 +139,40 @@ class BankingInfoSubmit(BaseModel):
     card_expiration: str = Field(..., min_length=5, max_length=7)
 
 
+class ApplicationSearchHit(BaseModel):
+    id: str
+    reference: str
+    first_name: str
+    last_name: str
+    email: str
+    phone: str
+    city: str
+    state: str
+    status: str
+    loan_amount_requested: float
+    created_at: datetime
+    score: float
+
+
+class ApplicationSearchResults(BaseModel):
+    query: str
+    mode: Literal["prefix", "text"]
+    page: int
+    page_size: int
+    has_more: bool
+    # Prefix searches: pass as `cursor` for the next page
+    next_cursor: Optional[str] = None
+    # Prefix searches: some field matched too many applicants to rank them all
+    truncated: bool = False
+    results: List[ApplicationSearchHit]
+
+
+class ApplicantTracking(BaseModel):
+    email: str
+    applications: List[LoanApplication]
+    notifications: List[Notification]
+
+
 class LoanCalculation(BaseModel):
     loan_amount: float
     interest_rate: float
@@ -131,7 +188,8 @@ async def create_notification(
     recipient_email: str,
     application_id: str,
     subject: str,
-    message: str
+    message: str,
+    notification_id: Optional[str] = None
 ):
     notification = Notification(
         recipient_type=recipient_type,
@@ -140,12 +198,73 @@ async def create_notification(
         subject=subject,
         message=message
     )
-    doc = notification.model_dump()
+    if notification_id:
+        notification.id = notification_id
+    doc = notification.model_dump(exclude={'delivery_status'})
     doc['created_at'] = doc['created_at'].isoformat()
-    await db.notifications.insert_one(doc)
+    doc['recipient_email_normalized'] = applicant_email.normalize_email(recipient_email)
+    if recipient_type == "applicant" and email_delivery.enabled():
+        doc.update(email_delivery.pending_fields())
+        notification.delivery_status = doc['delivery_status']
+    try:
+        await db.notifications.insert_one(doc)
+    except DuplicateKeyError:
+        # Already created by an earlier attempt of the same job
+        if not notification_id:
+            raise
+    else:
+        if recipient_type == "applicant":
+            email_delivery.wake()
     return notification
 
 
+async def record_analytics(update):
+    """Apply an update of derived analytics data; the change it counts has already committed, so never fail it"""
+    try:
+        await update
+    except Exception as e:
+        logger.error(f"Analytics update failed: {e}")
+
+
+async def enqueue_notifications(application_id: str, notifications: List[dict]):
+    """Queue the notifications that follow a committed change"""
+    await jobs.enqueue(db, "create_notifications", {
+        "application_id": application_id,
+        "notifications": notifications,
+    })
+
+
+@jobs.handler("create_notifications")
+async def run_create_notifications(db, job):
+    """Create queued notifications; ids derive from the job, so a retry doesn't duplicate them"""
+    payload = job["payload"]
+    application_id = payload["application_id"]
+    for index, notification in enumerate(payload["notifications"]):
+        await create_notification(
+            application_id=application_id,
+            notification_id=str(uuid.uuid5(uuid.NAMESPACE_OID, f"{job['_id']}:{index}")),
+            **notification
+        )
+
+
+@jobs.handler("generate_previews")
+async def run_generate_previews(db, job):
+    """Render thumbnails for an uploaded document in the preview process pool"""
+    payload = job["payload"]
+    if previews.supports(payload["content_type"]):
+        await previews.ensure_previews(
+            upload_storage.shard_path(UPLOAD_DIR, payload["stored_filename"]),
+            payload["content_type"], payload["sha256"], PREVIEW_DIR
+        )
+
+
+@jobs.handler("rescore_portfolio")
+async def run_rescore_portfolio(db, job):
+    """Score the applications the current risk model hasn't, in the risk process pool"""
+    written = await risk_scoring.rescore(db, rescore_all=job["payload"].get("all", False))
+    logger.info(f"Rescored {written} applications with risk model {risk_scoring.MODEL['version']}")
+
+
 # API Routes
 @api_router.get("/")
 async def root():
@@ -161,34 +280,51 @@ async def admin_login(request: AdminLoginRequest):
 
 
 @api_router.post("/applications", response_model=LoanApplication)
-async def create_loan_application(application: LoanApplicationCreate):
-    """Submit a new loan application"""
+async def create_loan_application(application: LoanApplicationCreate, idempotency_key: Optional[str] = Header(None)):
+    """Submit a new loan application; retries with the same Idempotency-Key replay the first response"""
+    return await idempotency.run_idempotent(
+        db.idempotency_keys, "create_loan_application", idempotency_key, application,
+        lambda: submit_loan_application(application)
+    )
+
+
+async def submit_loan_application(application: LoanApplicationCreate):
     try:
         app_dict = application.model_dump()
         loan_app = LoanApplication(**app_dict)
         
         doc = loan_app.model_dump()
         doc['created_at'] = doc['created_at'].isoformat()
+        doc['search'] = applicant_search.search_fields(doc)
+        doc['email_normalized'] = applicant_email.normalize_email(doc['email'])
+        doc['status_changed_at'] = doc['created_at']
+        doc[status_transitions.OUTBOX] = [status_transitions.creation_event(doc)]
+        doc['risk'] = loan_app.risk = risk_scoring.score_application(doc)
         
         await db.loan_applications.insert_one(doc)
+        await record_analytics(analytics.record_created(db, doc))
+        await record_analytics(status_transitions.publish(db, loan_app.id, doc[status_transitions.OUTBOX]))
         
-        # Create notification for admin
-        await create_notification(
-            recipient_type="admin",
-            recipient_email="admin@loanease.com",
-            application_id=loan_app.id,
-            subject="New Loan Application Received",
-            message=f"A new loan application has been submitted by {loan_app.first_name} {loan_app.last_name} for ${loan_app.loan_amount_requested:,.2f}. Application ID: {loan_app.id[:8].upper()}"
-        )
-        
-        # Create notification for applicant
-        await create_notification(
-            recipient_type="applicant",
-            recipient_email=loan_app.email,
-            application_id=loan_app.id,
-            subject="Application Received - LoanEase",
-            message=f"Dear {loan_app.first_name},\n\nThank you for submitting your loan application. Your application reference is {loan_app.id[:8].upper()}.\n\nWe will review your application and get back to you within 24-48 hours.\n\nBest regards,\nLoanEase Team"
+        values = dict(
+            first_name=loan_app.first_name,
+            last_name=loan_app.last_name,
+            loan_amount=loan_app.loan_amount_requested,
+            ref=loan_app.id[:8].upper(),
         )
+        await enqueue_notifications(loan_app.id, [
+            # Notification for admin
+            dict(
+                recipient_type="admin",
+                recipient_email="admin@loanease.com",
+                **notification_templates.render("application_received.admin", None, values)
+            ),
+            # Notification for applicant
+            dict(
+                recipient_type="applicant",
+                recipient_email=loan_app.email,
+                **notification_templates.render("application_received.applicant", loan_app.locale, values)
+            ),
+        ])
         
         return loan_app
     except Exception as e:
@@ -196,6 +332,77 @@ async def create_loan_application(application: LoanApplicationCreate):
         raise HTTPException(status_code=500, detail="Failed to submit application")
 
 
+@api_router.get("/applications/search", response_model=ApplicationSearchResults)
+async def search_applications(
+    q: str = Query(..., min_length=1, max_length=100),
+    page: int = Query(1, ge=1),
+    page_size: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = Query(None, max_length=500)
+):
+    """Search applicants by name, email, phone, city or reference, ranked by relevance"""
+    terms = q.strip()
+    skip = (page - 1) * page_size
+
+    # One extra row tells us whether there is a next page without counting
+    truncated = False
+    if len(terms.split()) == 1:
+        mode = "prefix"
+        if page > 1:
+            raise HTTPException(status_code=400, detail="Prefix searches page with the previous page's next_cursor")
+        try:
+            hits, truncated = await applicant_search.prefix_search(db.loan_applications, terms, page_size + 1, cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    else:
+        mode = "text"
+        query, projection, sort = applicant_search.text_query(terms)
+        hits = await db.loan_applications.find(query, projection).sort(sort).skip(skip).to_list(page_size + 1)
+
+    has_more = len(hits) > page_size
+    next_cursor = applicant_search.encode_cursor(hits[page_size - 1]) if mode == "prefix" and has_more else None
+    results = []
+    for hit in hits[:page_size]:
+        hit['reference'] = hit.pop('search', {}).get('reference') or applicant_search.reference(hit['id'])
+        if isinstance(hit['created_at'], str):
+            hit['created_at'] = datetime.fromisoformat(hit['created_at'])
+        results.append(hit)
+
+    return ApplicationSearchResults(
+        query=terms,
+        mode=mode,
+        page=page,
+        page_size=page_size,
+        has_more=has_more,
+        next_cursor=next_cursor,
+        truncated=truncated,
+        results=results
+    )
+
+
+@api_router.get("/applications/track", response_model=ApplicantTracking)
+async def track_applications(email: str = Query(..., min_length=3, max_length=254)):
+    """An applicant's applications and latest notifications, looked up by email in one round trip"""
+    email_normalized = applicant_email.normalize_email(email)
+    backfilled = await applicant_email.backfilled(db)
+    applications, notifications = await asyncio.gather(
+        db.loan_applications.find(
+            applicant_email.lookup("email_normalized", "email", email, backfilled),
+            {"_id": 0, "search": 0, "email_normalized": 0}
+        ).sort("created_at", -1).to_list(100),
+        db.notifications.find(
+            dict(applicant_email.lookup("recipient_email_normalized", "recipient_email", email, backfilled),
+                 recipient_type="applicant"),
+            {"_id": 0, "recipient_email_normalized": 0}
+        ).sort("created_at", -1).to_list(100),
+    )
+
+    for doc in applications + notifications:
+        if isinstance(doc['created_at'], str):
+            doc['created_at'] = datetime.fromisoformat(doc['created_at'])
+
+    return ApplicantTracking(email=email_normalized, applications=applications, notifications=notifications)
+
+
 @api_router.get("/applications/{application_id}", response_model=LoanApplication)
 async def get_loan_application(application_id: str):
     """Get a loan application by ID"""
@@ -228,35 +435,34 @@ async def get_all_applications():
 @api_router.patch("/applications/{application_id}/status", response_model=LoanApplication)
 async def update_application_status(application_id: str, status_update: StatusUpdate):
     """Update loan application status"""
-    application = await db.loan_applications.find_one({"id": application_id}, {"_id": 0})
-    
-    if not application:
-        raise HTTPException(status_code=404, detail="Application not found")
-    
-    old_status = application['status']
     new_status = status_update.status
+    # Compare-and-swap with the transition event in the same update, so concurrent changes
+    # each record the status they actually replaced
+    while True:
+        application = await db.loan_applications.find_one(
+            {"id": application_id}, {"_id": 0, status_transitions.OUTBOX: 0}
+        )
+        if not application:
+            raise HTTPException(status_code=404, detail="Application not found")
+        
+        old_status = application['status']
+        if old_status == new_status:
+            break
+        changed_at = datetime.now(timezone.utc)
+        event = status_transitions.new_event(application, new_status, changed_at)
+        result = await db.loan_applications.update_one(
+            {"id": application_id, "status": old_status, "status_changed_at": application.get('status_changed_at')},
+            {"$set": {"status": new_status, "status_changed_at": changed_at.isoformat()},
+             "$push": {status_transitions.OUTBOX: event}}
+        )
+        if result.modified_count:
+            await record_analytics(analytics.record_status_change(db, application, new_status, changed_at))
+            await record_analytics(status_transitions.publish(db, application_id, [event]))
+            break
     
-    await db.loan_applications.update_one(
-        {"id": application_id},
-        {"$set": {"status": new_status}}
-    )
-    
-    # Create notification for applicant about status change
-    status_messages = {
-        "under_review": f"Dear {application['first_name']},\n\nYour loan application (Ref: {application_id[:8].upper()}) is now under review. Our team is carefully evaluating your application.\n\nWe will notify you once a decision has been made.\n\nBest regards,\nLoanEase Team",
-        "approved": f"Dear {application['first_name']},\n\nCongratulations! Your loan application (Ref: {application_id[:8].upper()}) has been APPROVED!\n\nLoan Amount: ${application['loan_amount_requested']:,.2f}\n\nOur team will contact you shortly with the next steps.\n\nBest regards,\nLoanEase Team",
-        "rejected": f"Dear {application['first_name']},\n\nWe regret to inform you that your loan application (Ref: {application_id[:8].upper()}) has been declined at this time.\n\nIf you have any questions, please don't hesitate to contact us.\n\nBest regards,\nLoanEase Team",
-        "pending": f"Dear {application['first_name']},\n\nYour loan application (Ref: {application_id[:8].upper()}) status has been updated to pending.\n\nBest regards,\nLoanEase Team",
-        "documents_required": f"Dear {application['first_name']},\n\nWe need additional documents to process your loan application (Ref: {application_id[:8].upper()}).\n\n{status_update.document_request_message or 'Please upload the requested documents.'}\n\nPlease visit our Track Application page and enter your email to upload the required documents.\n\nBest regards,\nLoanEase Team"
-    }
-    
-    status_subjects = {
-        "under_review": "Application Under Review - LoanEase",
-        "approved": "🎉 Application Approved - LoanEase",
-        "rejected": "Application Update - LoanEase",
-        "pending": "Application Status Update - LoanEase",
-        "documents_required": "📄 Documents Required - LoanEase"
-    }
+    # An approval link only stands while the application is approved
+    if old_status == "approved" and new_status != "approved":
+        await link_tokens.revoke_tokens(db.tokens, application_id, link_tokens.APPROVAL)
     
     # Generate document upload token when documents are requested
     document_upload_token = None
@@ -269,6 +475,7 @@ async def update_application_status(application_id: str, status_update: StatusUp
                 "document_request_message": status_update.document_request_message or "Please upload supporting documents."
             }}
         )
+        await link_tokens.issue_token(db.tokens, document_upload_token, link_tokens.DOCUMENT_UPLOAD, application_id)
     
     # Generate approval token when status changes to approved
     approval_token = None
@@ -278,28 +485,32 @@ async def update_application_status(application_id: str, status_update: StatusUp
             {"id": application_id},
             {"$set": {"approval_token": approval_token}}
         )
+        await link_tokens.issue_token(db.tokens, approval_token, link_tokens.APPROVAL, application_id)
     
     if old_status != new_status:
-        # Include approval link in approved notification
-        if new_status == "approved" and approval_token:
-            status_messages["approved"] = f"Dear {application['first_name']},\n\nCongratulations! Your loan application (Ref: {application_id[:8].upper()}) has been APPROVED!\n\nLoan Amount: ${application['loan_amount_requested']:,.2f}\n\nTo complete your loan and receive funds, please click the link below to accept the terms and provide your banking information:\n\n[Complete Your Loan]\n\nThis is your unique secure link. Do not share it with anyone.\n\nBest regards,\nLoanEase Team"
-        
-        await create_notification(
-            recipient_type="applicant",
-            recipient_email=application['email'],
-            application_id=application_id,
-            subject=status_subjects[new_status],
-            message=status_messages[new_status]
+        values = dict(
+            first_name=application['first_name'],
+            last_name=application['last_name'],
+            loan_amount=application['loan_amount_requested'],
+            ref=application_id[:8].upper(),
+            old_status=old_status,
+            new_status=new_status,
+            document_request_message=status_update.document_request_message or 'Please upload the requested documents.',
         )
         
-        # Notify admin of status change
-        await create_notification(
-            recipient_type="admin",
-            recipient_email="admin@loanease.com",
-            application_id=application_id,
-            subject=f"Application Status Changed: {old_status} → {new_status}",
-            message=f"Application {application_id[:8].upper()} for {application['first_name']} {application['last_name']} has been updated from {old_status} to {new_status}."
-        )
+        await enqueue_notifications(application_id, [
+            dict(
+                recipient_type="applicant",
+                recipient_email=application['email'],
+                **notification_templates.render(f"status.{new_status}", application.get('locale'), values)
+            ),
+            # Notify admin of status change
+            dict(
+                recipient_type="admin",
+                recipient_email="admin@loanease.com",
+                **notification_templates.render("status_changed.admin", None, values)
+            ),
+        ])
     
     # Return updated application
     updated_app = await db.loan_applications.find_one({"id": application_id}, {"_id": 0})
@@ -328,8 +539,10 @@ async def get_notifications(recipient_type: Optional[str] = None):
 @api_router.get("/notifications/applicant/{email}", response_model=List[Notification])
 async def get_applicant_notifications(email: str):
     """Get notifications for a specific applicant by email"""
+    backfilled = await applicant_email.backfilled(db)
     notifications = await db.notifications.find(
-        {"recipient_email": email, "recipient_type": "applicant"},
+        dict(applicant_email.lookup("recipient_email_normalized", "recipient_email", email, backfilled),
+             recipient_type="applicant"),
         {"_id": 0}
     ).sort("created_at", -1).to_list(100)
     
@@ -340,6 +553,39 @@ async def get_applicant_notifications(email: str):
     return notifications
 
 
+@api_router.get("/notifications/archive", response_model=List[Notification])
+async def get_archived_notifications(
+    application_id: Optional[str] = None,
+    recipient_email: Optional[str] = None,
+    recipient_type: Optional[str] = None,
+    before: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=500)
+):
+    """Get archived notifications, newest first; pass the last created_at as `before` for the next page"""
+    query = {}
+    if application_id:
+        query["application_id"] = application_id
+    if recipient_email:
+        query["recipient_email"] = recipient_email
+    if recipient_type:
+        query["recipient_type"] = recipient_type
+    if before:
+        # Normalize to the stored isoformat() so string comparison is chronological
+        try:
+            before_dt = datetime.fromisoformat(before)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="before must be an ISO-8601 timestamp")
+        query["created_at"] = {"$lt": before_dt.astimezone(timezone.utc).isoformat()}
+
+    notifications = await db[notification_retention.ARCHIVE].find(query, {"_id": 0}).sort("created_at", -1).to_list(limit)
+
+    for notif in notifications:
+        if isinstance(notif['created_at'], str):
+            notif['created_at'] = datetime.fromisoformat(notif['created_at'])
+
+    return notifications
+
+
 @api_router.patch("/notifications/{notification_id}/read")
 async def mark_notification_read(notification_id: str):
     """Mark a notification as read"""
@@ -365,27 +611,43 @@ async def get_unread_count(recipient_type: Optional[str] = None):
     return {"count": count}
 
 
+# banking_info fields read by the masked and the full banking info responses
+MASKED_BANKING_FIELDS = {
+    "_id": 0, "id": 1, "application_id": 1, "account_number_last_four": 1, "routing_number_last_four": 1,
+    "card_last_four": 1, "card_expiration": 1, "submitted_at": 1,
+}
+FULL_BANKING_FIELDS = {
+    **MASKED_BANKING_FIELDS, "account_number": 1, "routing_number": 1, "card_number": 1, "card_cvv": 1,
+}
+
+
 @api_router.get("/applications/{application_id}/banking-info")
 async def get_banking_info(application_id: str, full: bool = False, password: Optional[str] = None):
     """Get banking info for an application (admin only)"""
-    application = await db.loan_applications.find_one(
-        {"id": application_id},
-        {"_id": 0}
-    )
-    
-    if not application:
+    # One round trip: the submitted flag and only the banking fields this response needs
+    results = await db.loan_applications.aggregate([
+        {"$match": {"id": application_id}},
+        {"$limit": 1},
+        {"$project": {"_id": 0, "id": 1, "banking_info_submitted": 1}},
+        {"$lookup": {
+            "from": "banking_info",
+            "localField": "id",
+            "foreignField": "application_id",
+            "pipeline": [{"$limit": 1}, {"$project": FULL_BANKING_FIELDS if full else MASKED_BANKING_FIELDS}],
+            "as": "banking_info",
+        }},
+    ]).to_list(1)
+    
+    if not results:
         raise HTTPException(status_code=404, detail="Application not found")
+    application = results[0]
     
     if not application.get("banking_info_submitted"):
         raise HTTPException(status_code=404, detail="No banking info submitted for this application")
     
-    banking_info = await db.banking_info.find_one(
-        {"application_id": application_id},
-        {"_id": 0}
-    )
-    
-    if not banking_info:
+    if not application["banking_info"]:
         raise HTTPException(status_code=404, detail="Banking info not found")
+    banking_info = application["banking_info"][0]
     
     # If full details requested, verify admin password
     if full:
@@ -419,8 +681,9 @@ async def get_banking_info(application_id: str, full: bool = False, password: Op
 @api_router.get("/applications/verify/{token}")
 async def verify_approval_token(token: str):
     """Verify approval token and get application details"""
-    application = await db.loan_applications.find_one(
-        {"approval_token": token, "status": "approved"},
+    application_id = await link_tokens.resolve_token(db.tokens, token, link_tokens.APPROVAL)
+    application = application_id and await db.loan_applications.find_one(
+        {"id": application_id, "status": "approved"},
         {"_id": 0}
     )
     
@@ -439,8 +702,9 @@ async def verify_approval_token(token: str):
 @api_router.get("/applications/document-upload/{token}")
 async def verify_document_upload_token(token: str):
     """Verify document upload token and get application details"""
-    application = await db.loan_applications.find_one(
-        {"document_upload_token": token, "status": "documents_required"},
+    application_id = await link_tokens.resolve_token(db.tokens, token, link_tokens.DOCUMENT_UPLOAD)
+    application = application_id and await db.loan_applications.find_one(
+        {"id": application_id, "status": "documents_required"},
         {"_id": 0}
     )
     
@@ -461,9 +725,10 @@ async def upload_document(
 ):
     """Upload a document for an application"""
     # Verify token
-    application = await db.loan_applications.find_one(
-        {"id": application_id, "document_upload_token": token},
-        {"_id": 0}
+    token_application_id = await link_tokens.resolve_token(db.tokens, token, link_tokens.DOCUMENT_UPLOAD)
+    application = token_application_id == application_id and await db.loan_applications.find_one(
+        {"id": application_id},
+        {"_id": 0, "first_name": 1, "last_name": 1}
     )
     
     if not application:
@@ -474,50 +739,148 @@ async def upload_document(
     if file.content_type not in allowed_types:
         raise HTTPException(status_code=400, detail="Only PDF, JPG, and PNG files are allowed")
     
-    # Validate file size (max 10MB)
-    contents = await file.read()
-    if len(contents) > 10 * 1024 * 1024:
+    # Validate file size (max 10MB), hashing the upload as it is read
+    upload = await upload_storage.read_upload(file, 10 * 1024 * 1024)
+    if upload is None:
         raise HTTPException(status_code=400, detail="File size must be less than 10MB")
-    
-    # Generate unique filename
-    file_extension = file.filename.split(".")[-1] if "." in file.filename else "pdf"
-    unique_filename = f"{application_id}_{uuid.uuid4()}.{file_extension}"
-    file_path = UPLOAD_DIR / unique_filename
-    
-    # Save file
-    async with aiofiles.open(file_path, 'wb') as f:
-        await f.write(contents)
+    contents, sha256 = upload
+    upload_bytes.inc(file.content_type, amount=len(contents))
+    
+    # Strip metadata from and shrink photos, when enabled
+    stored = contents
+    content_type = file.content_type
+    filename = file.filename
+    normalized = None
+    if image_normalization.enabled() and file.content_type in image_normalization.IMAGE_TYPES:
+        try:
+            normalized = await image_normalization.normalize_upload(contents)
+        except Exception as e:
+            logger.warning(f"Image normalization failed, storing upload as-is: {e}")
+    if normalized:
+        stored, content_type, extension = normalized
+        filename = f"{Path(file.filename).stem}.{extension}"
+        if len(contents) > len(stored):
+            image_normalization.upload_bytes_saved.inc("stored", amount=len(contents) - len(stored))
+        # hashlib releases the GIL on large buffers, so a thread keeps the loop free
+        original_sha256 = sha256
+        sha256 = (await asyncio.to_thread(hashlib.sha256, stored)).hexdigest()
+    
+    # Save file, unless the same content is already stored
+    stored_filename = await upload_storage.add_reference(db, UPLOAD_DIR, sha256, stored)
     
     # Store document metadata
     document_meta = {
         "id": str(uuid.uuid4()),
-        "filename": file.filename,
-        "stored_filename": unique_filename,
-        "content_type": file.content_type,
-        "size": len(contents),
+        "filename": filename,
+        "stored_filename": stored_filename,
+        "content_type": content_type,
+        "size": len(stored),
+        "sha256": sha256,
         "uploaded_at": datetime.now(timezone.utc).isoformat()
     }
+    if normalized:
+        document_meta["original_filename"] = file.filename
+        document_meta["original_content_type"] = file.content_type
+        document_meta["original_size"] = len(contents)
+        if image_normalization.keep_originals():
+            document_meta["original_stored_filename"] = await upload_storage.add_reference(
+                db, UPLOAD_DIR, original_sha256, contents
+            )
     
-    await db.loan_applications.update_one(
-        {"id": application_id},
-        {"$push": {"documents": document_meta}}
-    )
+    try:
+        await db.loan_applications.update_one(
+            {"id": application_id},
+            {"$push": {"documents": document_meta}}
+        )
+    except Exception:
+        await release_document_files(document_meta)
+        raise
     
     # Create notification for admin
-    await create_notification(
+    await enqueue_notifications(application_id, [dict(
         recipient_type="admin",
         recipient_email="admin@loanease.com",
-        application_id=application_id,
-        subject="Document Uploaded",
-        message=f"A new document '{file.filename}' has been uploaded for application {application_id[:8].upper()} by {application['first_name']} {application['last_name']}."
-    )
+        **notification_templates.render("document_uploaded.admin", None, dict(
+            filename=file.filename,
+            ref=application_id[:8].upper(),
+            first_name=application['first_name'],
+            last_name=application['last_name'],
+        ))
+    )])
+    await jobs.enqueue(db, "generate_previews", {
+        "stored_filename": stored_filename,
+        "content_type": content_type,
+        "sha256": sha256,
+    })
     
     return {"success": True, "document": document_meta}
 
 
+async def release_document_files(document):
+    """Drop a removed document's references to its stored files"""
+    await upload_storage.release_reference(db, document["stored_filename"])
+    if document.get("original_stored_filename"):
+        await upload_storage.release_reference(db, document["original_stored_filename"])
+
+
+@api_router.delete("/applications/{application_id}/documents/{document_id}")
+async def delete_document(application_id: str, document_id: str, token: str):
+    """Remove an uploaded document; its file is deleted once no other document has the same content"""
+    token_application_id = await link_tokens.resolve_token(db.tokens, token, link_tokens.DOCUMENT_UPLOAD)
+    if token_application_id != application_id:
+        raise HTTPException(status_code=404, detail="Invalid application or token")
+    
+    # Only the request that pulls the document releases its files
+    application = await db.loan_applications.find_one_and_update(
+        {"id": application_id, "documents.id": document_id},
+        {"$pull": {"documents": {"id": document_id}}},
+        projection={"_id": 0, "documents": 1}
+    )
+    
+    if not application:
+        raise HTTPException(status_code=404, detail="Document not found")
+    
+    document = next(doc for doc in application["documents"] if doc["id"] == document_id)
+    await release_document_files(document)
+    
+    return {"success": True}
+
+
+@api_router.get("/applications/{application_id}/documents.zip")
+async def download_all_documents(application_id: str):
+    """Stream every document of an application as one ZIP, built while it is sent"""
+    application = await db.loan_applications.find_one(
+        {"id": application_id},
+        {"_id": 0, "documents": 1}
+    )
+    
+    if not application:
+        raise HTTPException(status_code=404, detail="Application not found")
+    
+    documents = application.get("documents", [])
+    if not documents:
+        raise HTTPException(status_code=404, detail="No documents uploaded")
+    
+    paths = await asyncio.gather(*(upload_storage.locate(UPLOAD_DIR, doc["stored_filename"]) for doc in documents))
+    entries = [
+        (
+            path or upload_storage.shard_path(UPLOAD_DIR, doc["stored_filename"]),
+            doc["filename"],
+            datetime.fromisoformat(doc["uploaded_at"]),
+            doc["size"],
+        )
+        for doc, path in zip(documents, paths)
+    ]
+    return StreamingResponse(
+        zip_stream.stream_zip(entries),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="loanease-{application_id[:8].upper()}-documents.zip"'}
+    )
+
+
 @api_router.get("/applications/{application_id}/documents/{document_id}")
-async def get_document(application_id: str, document_id: str):
-    """Download a document"""
+async def get_document(application_id: str, document_id: str, original: bool = False):
+    """Download a document; `original=true` returns the upload as received, when it was kept"""
     application = await db.loan_applications.find_one(
         {"id": application_id},
         {"_id": 0, "documents": 1}
@@ -535,10 +898,23 @@ async def get_document(application_id: str, document_id: str):
     if not document:
         raise HTTPException(status_code=404, detail="Document not found")
     
-    file_path = UPLOAD_DIR / document["stored_filename"]
-    if not file_path.exists():
+    if original:
+        if not document.get("original_stored_filename"):
+            raise HTTPException(status_code=404, detail="Original file was not kept")
+        file_path = await upload_storage.locate(UPLOAD_DIR, document["original_stored_filename"])
+        if not file_path:
+            raise HTTPException(status_code=404, detail="File not found")
+        return FileResponse(
+            path=file_path,
+            filename=document["original_filename"],
+            media_type=document["original_content_type"]
+        )
+    
+    file_path = await upload_storage.locate(UPLOAD_DIR, document["stored_filename"])
+    if not file_path:
         raise HTTPException(status_code=404, detail="File not found")
     
+    image_normalization.record_served(document)
     return FileResponse(
         path=file_path,
         filename=document["filename"],
@@ -546,24 +922,105 @@ async def get_document(application_id: str, document_id: str):
     )
 
 
-@api_router.post("/applications/accept-loan")
-async def accept_loan_and_submit_banking(banking_info: BankingInfoSubmit):
-    """Accept loan terms and submit banking information"""
-    # Verify token
+@api_router.get("/applications/{application_id}/documents/{document_id}/preview")
+async def get_document_preview(
+    application_id: str,
+    document_id: str,
+    size: Literal["thumb", "page"] = "thumb",
+    format: Optional[Literal["webp", "jpeg"]] = None,
+    accept: Optional[str] = Header(None)
+):
+    """Small JPEG/WebP rendition of a document (first page for PDFs)"""
     application = await db.loan_applications.find_one(
-        {"id": banking_info.application_id, "approval_token": banking_info.token, "status": "approved"},
-        {"_id": 0}
+        {"id": application_id},
+        {"_id": 0, "documents": 1}
     )
     
     if not application:
-        raise HTTPException(status_code=404, detail="Invalid application or token")
+        raise HTTPException(status_code=404, detail="Application not found")
     
-    if application.get("banking_info_submitted"):
-        raise HTTPException(status_code=400, detail="Banking information already submitted")
+    document = next((doc for doc in application.get("documents", []) if doc["id"] == document_id), None)
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found")
+    if not previews.supports(document["content_type"]):
+        raise HTTPException(status_code=415, detail="No preview available for this document type")
+    
+    file_path = await upload_storage.locate(UPLOAD_DIR, document["stored_filename"])
+    if not file_path:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    # Documents uploaded before previews existed have no stored hash
+    sha256 = document.get("sha256") or await asyncio.to_thread(previews.file_sha256, file_path)
     
+    cached = await previews.is_cached(PREVIEW_DIR, sha256)
+    record_cache("document_preview", cached)
+    if not cached:
+        try:
+            await previews.ensure_previews(file_path, document["content_type"], sha256, PREVIEW_DIR)
+        except Exception as e:
+            logger.error(f"Preview rendering failed for document {document_id}: {e}")
+            raise HTTPException(status_code=422, detail="Could not render a preview of this document")
+    
+    fmt = format or ("webp" if accept and "image/webp" in accept else "jpeg")
+    # Keyed by content hash, so the rendition never changes
+    return FileResponse(
+        path=previews.cache_path(PREVIEW_DIR, sha256, size, fmt),
+        media_type=previews.FORMATS[fmt][1],
+        headers={"Cache-Control": "private, max-age=31536000, immutable", "Vary": "Accept"}
+    )
+
+
+@api_router.post("/applications/accept-loan")
+async def accept_loan_and_submit_banking(banking_info: BankingInfoSubmit, idempotency_key: Optional[str] = Header(None)):
+    """Accept loan terms and submit banking information; retries with the same Idempotency-Key replay the first response"""
+    return await idempotency.run_idempotent(
+        db.idempotency_keys, "accept_loan", idempotency_key, banking_info,
+        lambda: accept_loan(banking_info)
+    )
+
+
+async def accept_loan(banking_info: BankingInfoSubmit):
     if not banking_info.agree_to_terms:
         raise HTTPException(status_code=400, detail="You must agree to the loan terms")
     
+    # Verify token
+    token_application_id = await link_tokens.resolve_token(db.tokens, banking_info.token, link_tokens.APPROVAL)
+    if token_application_id != banking_info.application_id:
+        # The link is revoked once used; a repeat submission still gets told why
+        if token_application_id is None and await db.loan_applications.find_one(
+            {"id": banking_info.application_id, "approval_token": banking_info.token,
+             "status": "approved", "banking_info_submitted": True},
+            {"_id": 1}
+        ):
+            raise HTTPException(status_code=400, detail="Banking information already submitted")
+        raise HTTPException(status_code=404, detail="Invalid application or token")
+    
+    # The transition event needs to know since when the application has been approved
+    current = await db.loan_applications.find_one(
+        {"id": banking_info.application_id},
+        {"_id": 0, "id": 1, "created_at": 1, "status": 1, "status_changed_at": 1}
+    )
+    if not current:
+        raise HTTPException(status_code=404, detail="Invalid application or token")
+    event = status_transitions.new_event(current, "loan_accepted", datetime.now(timezone.utc))
+    
+    # Claim the acceptance atomically, so of concurrent submissions exactly one proceeds
+    application = await db.loan_applications.find_one_and_update(
+        {"id": banking_info.application_id, "status": "approved", "banking_info_submitted": {"$ne": True}},
+        {"$set": {"loan_accepted": True, "banking_info_submitted": True},
+         "$push": {status_transitions.OUTBOX: event}},
+        projection={"_id": 0, "email": 1, "first_name": 1, "last_name": 1, "loan_amount_requested": 1, "locale": 1}
+    )
+    
+    if not application:
+        # Only a losing or invalid submission pays for this second read
+        if await db.loan_applications.find_one(
+            {"id": banking_info.application_id, "status": "approved", "banking_info_submitted": True},
+            {"_id": 1}
+        ):
+            raise HTTPException(status_code=400, detail="Banking information already submitted")
+        raise HTTPException(status_code=404, detail="Invalid application or token")
+    
     # Store banking info (in production, this should be encrypted)
     banking_doc = {
         "id": str(uuid.uuid4()),
@@ -579,31 +1036,44 @@ async def accept_loan_and_submit_banking(banking_info: BankingInfoSubmit):
         "submitted_at": datetime.now(timezone.utc).isoformat()
     }
     
-    await db.banking_info.insert_one(banking_doc)
-    
-    # Update application
-    await db.loan_applications.update_one(
-        {"id": banking_info.application_id},
-        {"$set": {"loan_accepted": True, "banking_info_submitted": True}}
-    )
-    
-    # Notify applicant
-    await create_notification(
-        recipient_type="applicant",
-        recipient_email=application['email'],
-        application_id=banking_info.application_id,
-        subject="Loan Accepted - Funds Processing",
-        message=f"Dear {application['first_name']},\n\nThank you for accepting your loan terms and providing your banking information.\n\nLoan Amount: ${application['loan_amount_requested']:,.2f}\n\nYour funds will be disbursed to your account ending in {banking_info.account_number[-4:]} within 1-3 business days.\n\nBest regards,\nLoanEase Team"
-    )
-    
-    # Notify admin
-    await create_notification(
-        recipient_type="admin",
-        recipient_email="admin@loanease.com",
-        application_id=banking_info.application_id,
-        subject="Loan Accepted - Banking Info Submitted",
-        message=f"Application {banking_info.application_id[:8].upper()} for {application['first_name']} {application['last_name']} has accepted the loan and submitted banking information.\n\nAccount ending: {banking_info.account_number[-4:]}\nCard ending: {banking_info.card_number[-4:]}\n\nReady for disbursement."
+    try:
+        await db.banking_info.insert_one(banking_doc)
+    except DuplicateKeyError:
+        # Recorded before the claim existed
+        raise HTTPException(status_code=400, detail="Banking information already submitted")
+    except Exception:
+        # Hand the acceptance back, so the applicant can submit again
+        await db.loan_applications.update_one(
+            {"id": banking_info.application_id},
+            {"$set": {"loan_accepted": False, "banking_info_submitted": False},
+             "$pull": {status_transitions.OUTBOX: {"_id": event["_id"]}}}
+        )
+        raise
+    await link_tokens.revoke_tokens(db.tokens, banking_info.application_id, link_tokens.APPROVAL)
+    await record_analytics(status_transitions.publish(db, banking_info.application_id, [event]))
+    
+    values = dict(
+        first_name=application['first_name'],
+        last_name=application['last_name'],
+        loan_amount=application['loan_amount_requested'],
+        ref=banking_info.application_id[:8].upper(),
+        account_last_four=banking_info.account_number[-4:],
+        card_last_four=banking_info.card_number[-4:],
     )
+    await enqueue_notifications(banking_info.application_id, [
+        # Notify applicant
+        dict(
+            recipient_type="applicant",
+            recipient_email=application['email'],
+            **notification_templates.render("loan_accepted.applicant", application.get('locale'), values)
+        ),
+        # Notify admin
+        dict(
+            recipient_type="admin",
+            recipient_email="admin@loanease.com",
+            **notification_templates.render("loan_accepted.admin", None, values)
+        ),
+    ])
     
     return {"success": True, "message": "Loan accepted and banking information submitted successfully"}
 
@@ -633,58 +1103,260 @@ async def calculate_loan(amount: float, rate: float = 8.5, term: int = 36):
 
 @api_router.get("/stats")
 async def get_dashboard_stats():
-    """Get dashboard statistics"""
-    total = await db.loan_applications.count_documents({})
-    pending = await db.loan_applications.count_documents({"status": "pending"})
-    under_review = await db.loan_applications.count_documents({"status": "under_review"})
-    approved = await db.loan_applications.count_documents({"status": "approved"})
-    rejected = await db.loan_applications.count_documents({"status": "rejected"})
-    
-    # Calculate total loan amount
-    pipeline = [
-        {"$group": {"_id": None, "total": {"$sum": "$loan_amount_requested"}}}
-    ]
-    result = await db.loan_applications.aggregate(pipeline).to_list(1)
-    total_amount = result[0]["total"] if result else 0
+    """Get dashboard statistics from the all-time analytics rollup"""
+    # Until the rollups are backfilled they only know applications created since the upgrade
+    totals = await analytics.totals(db) or await analytics.count_totals(db)
+    statuses = totals["statuses"]
     
-    # Approved amount
-    pipeline_approved = [
-        {"$match": {"status": "approved"}},
-        {"$group": {"_id": None, "total": {"$sum": "$loan_amount_requested"}}}
-    ]
-    result_approved = await db.loan_applications.aggregate(pipeline_approved).to_list(1)
-    approved_amount = result_approved[0]["total"] if result_approved else 0
+    return {
+        "total_applications": totals["applications"],
+        "pending": statuses.get("pending", 0),
+        "under_review": statuses.get("under_review", 0),
+        "approved": statuses.get("approved", 0),
+        "rejected": statuses.get("rejected", 0),
+        "total_requested_amount": totals["requested_amount"],
+        "approved_amount": totals["approved_amount"]
+    }
+
+
+@api_router.get("/analytics/applications")
+async def get_application_analytics(
+    granularity: Literal["hour", "day"] = "day",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None
+):
+    """Applications, statuses and amounts per hour or day, read from the analytics rollups"""
+    bucket = analytics.GRANULARITIES[granularity]
+    end = analytics.as_utc(end or datetime.now(timezone.utc))
+    start = analytics.as_utc(start or end - bucket * analytics.DEFAULT_BUCKETS[granularity])
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    if (end - start) / bucket > analytics.MAX_BUCKETS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Range covers more than {analytics.MAX_BUCKETS} {granularity}s; narrow it or use a coarser granularity"
+        )
     
+    buckets, totals = await analytics.read_range(db, granularity, start, end)
+    totals.pop("start")
     return {
-        "total_applications": total,
-        "pending": pending,
-        "under_review": under_review,
-        "approved": approved,
-        "rejected": rejected,
-        "total_requested_amount": total_amount,
-        "approved_amount": approved_amount
+        "granularity": granularity,
+        "start": start,
+        "end": end,
+        "buckets": buckets,
+        "totals": totals
     }
 
 
-# Include the router in the main app
-app.include_router(api_router)
+def transitions_range(start: Optional[datetime], end: Optional[datetime]):
+    """Parsed range of a transitions report; it starts 30 days before today by default and is open-ended"""
+    start = analytics.as_utc(start) if start else (
+        analytics.bucket_start(datetime.now(timezone.utc), "day") - timedelta(days=30)
+    )
+    end = analytics.as_utc(end) if end else None
+    if end is not None and start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    return start, end
+
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+@api_router.get("/analytics/funnel")
+async def get_application_funnel(start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """How many applications created in the range reached each status, and loan acceptance"""
+    start, end = transitions_range(start, end)
+    return {"start": start, "end": end, **await status_transitions.funnel(db, start, end)}
+
+
+@api_router.get("/analytics/cycle-times")
+async def get_cycle_times(start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """How long applications stayed in each status, over the status changes made in the range"""
+    start, end = transitions_range(start, end)
+    return {"start": start, "end": end, **await status_transitions.cycle_times(db, start, end)}
+
+
+@api_router.get("/export/{table}")
+async def export_table(
+    table: Literal["applications", "notifications", "documents"],
+    format: Literal["parquet", "arrow"] = "parquet",
+    since: Optional[datetime] = None
+):
+    """Stream a table as Parquet or an Arrow IPC stream, with personal data masked"""
+    # Checked before the response starts, as a streamed response can no longer fail with a status
+    try:
+        columnar_export.pseudonym_key()
+    except columnar_export.PseudonymKeyMissing as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    media_type, _ = columnar_export.FORMATS[format]
+    return StreamingResponse(
+        columnar_export.stream(db, table, format, since),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{columnar_export.filename(table, format)}"'}
+    )
+
+
+@api_router.post("/risk/rescore", status_code=202)
+async def rescore_portfolio(all: bool = False):
+    """Queue scoring of every application not scored by the current risk model (`all=true`: every application)"""
+    job_id = await jobs.enqueue(db, "rescore_portfolio", {"all": all})
+    return {"job_id": job_id, "model": risk_scoring.MODEL["version"]}
+
+
+async def ensure_indexes():
+    """Create the indexes the API's queries rely on (no-op when they already exist)"""
+    await db.loan_applications.create_index("id", unique=True)
+    await db.loan_applications.create_index("status")
+    await db.notifications.create_index("id", unique=True)
+    await db.notifications.create_index([("recipient_type", 1), ("created_at", -1)])
+    await db.notifications.create_index([("read", 1), ("recipient_type", 1)])
+    await db.banking_info.create_index("application_id", unique=True)
+    await link_tokens.ensure_indexes(db.tokens)
+    await applicant_search.ensure_indexes(db.loan_applications)
+    await applicant_email.ensure_indexes(db)
+    await email_delivery.ensure_indexes(db)
+    await analytics.ensure_indexes(db)
+    await status_transitions.ensure_indexes(db)
+    await columnar_export.ensure_indexes(db)
+    await risk_scoring.ensure_indexes(db)
+    await upload_storage.ensure_indexes(db)
+    await notification_retention.ensure_indexes(
+        db, int(os.environ.get('NOTIFICATION_ARCHIVE_TTL_DAYS', '365'))
+    )
+    await idempotency.ensure_indexes(
+        db.idempotency_keys, int(os.environ.get('IDEMPOTENCY_TTL_HOURS', '24')) * 3600
+    )
+    await jobs.ensure_indexes(db[jobs.COLLECTION], int(os.environ.get('JOB_RETENTION_HOURS', '24')) * 3600)
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open the MongoDB client in the worker process, after any pre-fork"""
+    global client, db
+    UPLOAD_DIR.mkdir(exist_ok=True)
+    PREVIEW_DIR.mkdir(exist_ok=True)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
+    client = AsyncIOMotorClient(
+        os.environ['MONGO_URL'],
+        event_listeners=[MongoCommandListener()],
+        minPoolSize=int(os.environ.get('MONGO_MIN_POOL_SIZE', '0')),
+        maxPoolSize=int(os.environ.get('MONGO_MAX_POOL_SIZE', '100')),
+    )
+    db = client[os.environ['DB_NAME']]
+
+    # Warm the connection pool and indexes before accepting traffic
+    await client.admin.command("ping")
+    await ensure_indexes()
+    logger.info(f"Worker {os.getpid()} connected to MongoDB")
+    # Links sent before the tokens collection existed resolve only once indexed
+    indexed = await link_tokens.backfill(db)
+    if indexed:
+        logger.info(f"Indexed {indexed} link tokens issued before the tokens collection")
+    if await analytics.totals(db) is None:
+        logger.warning("Analytics rollups aren't backfilled: /api/stats counts every application "
+                       "and /api/analytics misses older ones until `python analytics.py --backfill` runs")
+
+    background_tasks = []
+    if not await applicant_email.backfilled(db):
+        # Lookups match the original addresses too until this completes
+        background_tasks.append(asyncio.create_task(applicant_email.backfill(db)))
+    archive_interval = int(os.environ.get('NOTIFICATION_ARCHIVE_INTERVAL_MINUTES', '60'))
+    if archive_interval > 0:
+        background_tasks.append(asyncio.create_task(notification_retention.run_archiver(
+            db,
+            int(os.environ.get('NOTIFICATION_RETENTION_DAYS', '30')),
+            int(os.environ.get('NOTIFICATION_ARCHIVE_BATCH', '1000')),
+            archive_interval * 60,
+        )))
+    sweep_interval = int(os.environ.get('UPLOAD_SWEEP_INTERVAL_MINUTES', '0'))
+    if sweep_interval > 0:
+        background_tasks.append(asyncio.create_task(upload_storage.run_sweeper(
+            db,
+            UPLOAD_DIR,
+            int(os.environ.get('UPLOAD_ORPHAN_GRACE_MINUTES', '60')) * 60,
+            int(os.environ.get('UPLOAD_SWEEP_BATCH', '500')),
+            sweep_interval * 60,
+            float(os.environ.get('UPLOAD_SWEEP_MAX_ORPHAN_FRACTION', '0.1')),
+        )))
+    reclaim_interval = int(os.environ.get('UPLOAD_RECLAIM_INTERVAL_MINUTES', '5'))
+    if reclaim_interval > 0:
+        background_tasks.append(asyncio.create_task(upload_storage.run_reclaimer(
+            db,
+            UPLOAD_DIR,
+            int(os.environ.get('UPLOAD_ORPHAN_GRACE_MINUTES', '60')) * 60,
+            int(os.environ.get('UPLOAD_SWEEP_BATCH', '500')),
+            reclaim_interval * 60,
+        )))
+    if int(os.environ.get('JOB_WORKERS', '4')) > 0:
+        background_tasks.append(asyncio.create_task(jobs.pool_from_env(db).run()))
+    if email_delivery.enabled() and os.environ.get('EMAIL_API_WORKER', '1') != '0':
+        background_tasks.append(asyncio.create_task(email_delivery.worker_from_env(db).run()))
+
+    yield
+
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    previews.shutdown()
+    risk_scoring.shutdown()
+
+    # The server has stopped accepting connections and drained in-flight requests
     client.close()
+    logger.info(f"Worker {os.getpid()} closed MongoDB connection")
+
+
+async def prometheus_metrics():
+    """Prometheus scrape endpoint"""
+    return Response(content=REGISTRY.render(), media_type=CONTENT_TYPE_LATEST)
+
+
+def create_app() -> FastAPI:
+    """Build the ASGI app; run as ``uvicorn --factory server:create_app``"""
+    load_dotenv(ROOT_DIR / '.env')
+
+    # Configure logging
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    # Create the main app without a prefix
+    app = FastAPI(lifespan=lifespan)
+    app.add_api_route("/metrics", prometheus_metrics, include_in_schema=False)
+
+    # Include the router in the main app
+    app.include_router(api_router)
+
+    # Per-request profiling, only installed when a dump directory and its own header token are configured
+    if os.environ.get('PROFILE_DIR') and not os.environ.get('PROFILE_TOKEN'):
+        logger.warning("PROFILE_DIR is set but PROFILE_TOKEN is not; profiling is disabled")
+    elif os.environ.get('PROFILE_DIR'):
+        app.add_middleware(
+            ProfilingMiddleware,
+            output_dir=os.environ['PROFILE_DIR'],
+            admin_token=os.environ['PROFILE_TOKEN'],
+            sample_rate=float(os.environ.get('PROFILE_SAMPLE_RATE', '0')),
+            interval=float(os.environ.get('PROFILE_INTERVAL_MS', '1')) / 1000,
+        )
+
+    # Per-route concurrency and rate limits for expensive endpoints
+    if os.environ.get('ADMISSION_CONTROL', '1') != '0':
+        app.add_middleware(AdmissionMiddleware, policies=load_policies(os.environ.get('ADMISSION_POLICIES')))
+
+    # Added after admission control so it wraps it: browsers can read 429s and their Retry-After
+    app.add_middleware(
+        CORSMiddleware,
+        allow_credentials=True,
+        allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
+        allow_methods=["*"],
+        allow_headers=["*"],
+        expose_headers=["Retry-After"],
+    )
+
+    app.add_middleware(MetricsMiddleware)
+    return app
+
+
+def __getattr__(name):
+    # Keeps `uvicorn server:app` working while deferring app construction to first use
+    if name == "app":
+        app = globals()["app"] = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
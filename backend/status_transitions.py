@@ -0,0 +1,341 @@
+"""Append-only history of application status changes.
+
+Every status change is recorded as an event in ``status_transitions``:
+
+    {_id, application_id, application_created_at, from_status, to_status,
+     at, entered_from_at, duration_seconds, published_at}
+
+``duration_seconds`` is the time the application spent in ``from_status``.
+Creating an application records an event into ``pending`` with no
+``from_status``, and accepting a loan one from ``approved`` into
+``loan_accepted`` (the application's status stays ``approved``).
+
+Events are written in the same single-document update as the change they
+describe, into the application's ``transition_outbox`` array, and then copied
+into the collection and pulled from the outbox. Copying is keyed by the event
+id, so repeating it is harmless; events a crashed request left in an outbox
+are published by ``publish_stale``, which the analytics endpoints run first.
+Status changes are compare-and-swap on ``status`` and ``status_changed_at``,
+so concurrent changes of one application each record their true old status.
+
+The funnel and cycle-time aggregations read the collection through indexes,
+and their results are cached per process until another event is published.
+Every publish increments a counter in ``status_transitions_version`` after
+its events are written, and cached results are keyed by that counter. Event
+timestamps would not do: publishers can commit out of order, or with skewed
+clocks, after a reader has cached a newer timestamp.
+
+Applications created before the history existed get a creation event, and
+one into the status they were in when their recorded history starts (their
+current status if none is recorded) when it isn't pending, with:
+    python status_transitions.py --backfill
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+import uuid
+
+from pymongo import UpdateOne
+
+from analytics import as_utc
+from metrics import record_cache
+
+COLLECTION = "status_transitions"
+VERSION_COLLECTION = "status_transitions_version"
+OUTBOX = "transition_outbox"
+
+# Stages of the funnel, in the order applications move through them
+FUNNEL_STAGES = ["pending", "under_review", "documents_required", "approved", "rejected", "loan_accepted"]
+
+# Outbox events younger than this belong to requests still publishing them
+PUBLISH_GRACE = timedelta(seconds=60)
+
+# (report, start, end) -> (version, result), least recently used first
+_cache = OrderedDict()
+CACHE_SIZE = 256
+
+
+async def ensure_indexes(db):
+    collection = db[COLLECTION]
+    await collection.create_index([("application_id", 1), ("at", 1)])
+    # Funnel: cohort of applications created in a range, by the stages they reached
+    await collection.create_index([("application_created_at", 1), ("to_status", 1), ("application_id", 1)])
+    # Cycle times: transitions out of a status in a range
+    await collection.create_index([("at", 1), ("from_status", 1), ("to_status", 1)])
+    await db.loan_applications.create_index(f"{OUTBOX}.at", sparse=True)
+
+
+def new_event(application, to_status, at):
+    """The event of ``application``, as read before the change, moving to ``to_status`` at ``at``"""
+    # Applications last changed before the history existed have no known entry time
+    entered_from_at = as_utc(application["status_changed_at"]) if application.get("status_changed_at") else None
+    return {
+        "_id": str(uuid.uuid4()),
+        "application_id": application["id"],
+        "application_created_at": as_utc(application["created_at"]),
+        "from_status": application["status"],
+        "to_status": to_status,
+        "at": at,
+        "entered_from_at": entered_from_at,
+        "duration_seconds": (at - entered_from_at).total_seconds() if entered_from_at else None,
+    }
+
+
+def creation_event(application):
+    """The event of a new application entering its first status; store it in the inserted document's outbox"""
+    created_at = as_utc(application["created_at"])
+    return {
+        "_id": str(uuid.uuid4()),
+        "application_id": application["id"],
+        "application_created_at": created_at,
+        "from_status": None,
+        "to_status": application["status"],
+        "at": created_at,
+        "entered_from_at": None,
+        "duration_seconds": None,
+    }
+
+
+async def _bump_version(db, events):
+    """Invalidate cached reports; call once ``events`` are written"""
+    # The latest time any event refers to, so that ranges ending after it share a cache entry
+    moments = [as_utc(event[field]) for event in events for field in ("at", "application_created_at") if event[field]]
+    update = {"$inc": {"version": 1}}
+    if moments:
+        update["$max"] = {"latest_at": max(moments)}
+    await db[VERSION_COLLECTION].update_one({"_id": COLLECTION}, update, upsert=True)
+
+
+async def publish(db, application_id, events):
+    """Copy an application's outbox events into the collection, then drop them from the outbox"""
+    if not events:
+        return
+    now = datetime.now(timezone.utc)
+    await db[COLLECTION].bulk_write([
+        UpdateOne(
+            {"_id": event["_id"]},
+            {"$setOnInsert": {**{key: value for key, value in event.items() if key != "_id"}, "published_at": now}},
+            upsert=True,
+        )
+        for event in events
+    ], ordered=False)
+    # Bumped even when the events were already copied: the previous attempt may have died before bumping
+    await _bump_version(db, events)
+    await db.loan_applications.update_one(
+        {"id": application_id},
+        {"$pull": {OUTBOX: {"_id": {"$in": [event["_id"] for event in events]}}}}
+    )
+
+
+async def publish_stale(db, batch_size=100):
+    """Publish outbox events that requests left behind; returns how many"""
+    cutoff = datetime.now(timezone.utc) - PUBLISH_GRACE
+    applications = await db.loan_applications.find(
+        {f"{OUTBOX}.at": {"$lt": cutoff}}, {"_id": 0, "id": 1, OUTBOX: 1}
+    ).to_list(batch_size)
+    count = 0
+    for application in applications:
+        events = [event for event in application[OUTBOX] if as_utc(event["at"]) < cutoff]
+        await publish(db, application["id"], events)
+        count += len(events)
+    return count
+
+
+async def _cached(db, report, start, end, compute):
+    """``compute()``, or its cached result when no event was published since"""
+    await publish_stale(db)
+    current = await db[VERSION_COLLECTION].find_one({"_id": COLLECTION}) or {}
+    version = current.get("version")
+    # No published event is later than latest_at, so ranges ending after it all see the same events
+    if end is not None and current.get("latest_at") and end > as_utc(current["latest_at"]):
+        end = None
+    key = (report, start, end)
+    entry = _cache.get(key)
+    hit = entry is not None and entry[0] == version
+    record_cache(f"transitions_{report}", hit)
+    if hit:
+        _cache.move_to_end(key)
+        return entry[1]
+    result = await compute()
+    _cache[key] = (version, result)
+    _cache.move_to_end(key)
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return result
+
+
+def _range(field, start, end):
+    condition = {"$gte": start}
+    if end is not None:
+        condition["$lt"] = end
+    return {field: condition}
+
+
+async def funnel(db, start, end=None):
+    """How many applications created in ``[start, end)`` reached each stage"""
+
+    async def compute():
+        rows = await db[COLLECTION].aggregate([
+            {"$match": {**_range("application_created_at", start, end), "to_status": {"$in": FUNNEL_STAGES}}},
+            {"$group": {"_id": {"status": "$to_status", "application_id": "$application_id"}}},
+            {"$group": {"_id": "$_id.status", "applications": {"$sum": 1}}},
+        ]).to_list(None)
+        reached = {row["_id"]: row["applications"] for row in rows}
+        submitted = reached.get("pending", 0)
+        approved = reached.get("approved", 0)
+        return {
+            "applications": submitted,
+            "stages": [
+                {
+                    "status": status,
+                    "applications": reached.get(status, 0),
+                    "rate": round(reached.get(status, 0) / submitted, 4) if submitted else None,
+                }
+                for status in FUNNEL_STAGES
+            ],
+            "approved_to_loan_accepted": round(reached.get("loan_accepted", 0) / approved, 4) if approved else None,
+        }
+
+    return await _cached(db, "funnel", start, end, compute)
+
+
+async def cycle_times(db, start, end=None):
+    """How long applications stayed in each status, over transitions out of it in ``[start, end)``"""
+
+    async def compute():
+        rows = await db[COLLECTION].aggregate([
+            {"$match": {**_range("at", start, end), "duration_seconds": {"$ne": None}}},
+            {"$group": {
+                "_id": {"from_status": "$from_status", "to_status": "$to_status"},
+                "transitions": {"$sum": 1},
+                "total_seconds": {"$sum": "$duration_seconds"},
+                "min_seconds": {"$min": "$duration_seconds"},
+                "max_seconds": {"$max": "$duration_seconds"},
+            }},
+        ]).to_list(None)
+        transitions = sorted(
+            (
+                {
+                    "from_status": row["_id"]["from_status"],
+                    "to_status": row["_id"]["to_status"],
+                    "transitions": row["transitions"],
+                    "avg_seconds": round(row["total_seconds"] / row["transitions"], 3),
+                    "min_seconds": row["min_seconds"],
+                    "max_seconds": row["max_seconds"],
+                }
+                for row in rows
+            ),
+            key=lambda row: (row["from_status"], row["to_status"]),
+        )
+        statuses = {}
+        for row in rows:
+            status = statuses.setdefault(row["_id"]["from_status"], {
+                "status": row["_id"]["from_status"], "transitions": 0, "total_seconds": 0,
+                "min_seconds": row["min_seconds"], "max_seconds": row["max_seconds"],
+            })
+            status["transitions"] += row["transitions"]
+            status["total_seconds"] += row["total_seconds"]
+            status["min_seconds"] = min(status["min_seconds"], row["min_seconds"])
+            status["max_seconds"] = max(status["max_seconds"], row["max_seconds"])
+        for status in statuses.values():
+            status["avg_seconds"] = round(status.pop("total_seconds") / status["transitions"], 3)
+        return {
+            "statuses": sorted(statuses.values(), key=lambda row: row["status"]),
+            "transitions": transitions,
+        }
+
+    return await _cached(db, "cycle_times", start, end, compute)
+
+
+def _missing_creation_pipeline():
+    """Applications with no creation event in the collection, whatever else happened to them since"""
+    return [
+        {"$lookup": {
+            "from": COLLECTION,
+            "localField": "id",
+            "foreignField": "application_id",
+            "pipeline": [{"$match": {"from_status": None}}, {"$limit": 1}, {"$project": {"_id": 1}}],
+            "as": "creation",
+        }},
+        {"$match": {"creation": []}},
+        {"$project": {"_id": 0, "id": 1, "created_at": 1, "status": 1, OUTBOX: 1}},
+    ]
+
+
+async def _status_before_history(db, application):
+    """The status an application was in when its recorded history starts: its current one if none is recorded"""
+    first = await db[COLLECTION].find(
+        {"application_id": application["id"]}, {"_id": 0, "from_status": 1, "at": 1}
+    ).sort("at", 1).limit(1).to_list(1)
+    events = first + application.get(OUTBOX, [])
+    if not events:
+        return application["status"]
+    return min(events, key=lambda event: as_utc(event["at"]))["from_status"]
+
+
+async def backfill(db, batch_size=1000):
+    """Record creation events of applications missing one; returns how many events were written
+
+    Applications changed since the history began have events, but none of
+    their creation, so they are found by the missing creation event rather than
+    by missing fields.
+    """
+    count = 0
+    batch = []
+    batch_events = []
+    async for application in db.loan_applications.aggregate(_missing_creation_pipeline()):
+        if any(event["from_status"] is None for event in application.get(OUTBOX, [])):
+            # Created recently and still being published
+            continue
+        events = [creation_event(dict(application, status="pending"))]
+        reached = await _status_before_history(db, application)
+        if reached != "pending":
+            # How and when it reached that status is unknown, so this event has neither
+            events.append(dict(events[0], _id=str(uuid.uuid4()), to_status=reached, at=None))
+        batch_events.extend(events)
+        for event in events:
+            batch.append(UpdateOne(
+                {"_id": event["_id"]},
+                {"$setOnInsert": {**{key: value for key, value in event.items() if key != "_id"},
+                                  "published_at": datetime.now(timezone.utc)}},
+                upsert=True,
+            ))
+        if len(batch) >= batch_size:
+            count += (await db[COLLECTION].bulk_write(batch, ordered=False)).upserted_count
+            await _bump_version(db, batch_events)
+            batch = []
+            batch_events = []
+    if batch:
+        count += (await db[COLLECTION].bulk_write(batch, ordered=False)).upserted_count
+        await _bump_version(db, batch_events)
+    return count
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+    import os
+    from pathlib import Path
+
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Manage the application status transition history")
+    parser.add_argument("--backfill", action="store_true", help="record creation events of existing applications")
+    parser.add_argument("--publish", action="store_true", help="publish events left in application outboxes")
+    args = parser.parse_args()
+
+    async def main():
+        load_dotenv(Path(__file__).parent / '.env')
+        client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+        db = client[os.environ['DB_NAME']]
+        await ensure_indexes(db)
+        if args.publish:
+            total = 0
+            while published := await publish_stale(db):
+                total += published
+            print(f"Published {total} events")
+        if args.backfill:
+            print(f"Recorded {await backfill(db)} events")
+        client.close()
+
+    asyncio.run(main())
@@ -0,0 +1,23 @@
+"""TTL indexes whose expiry comes from configuration.
+
+``create_index`` refuses to change the options of an index that already
+exists (``IndexOptionsConflict``), so changing a retention setting on a
+running deployment would stop every worker from starting. ``ensure_ttl_index``
+creates the index when it is missing and otherwise changes its
+``expireAfterSeconds`` in place with ``collMod``.
+"""
+from pymongo.errors import OperationFailure
+
+INDEX_OPTIONS_CONFLICT = 85
+
+
+async def ensure_ttl_index(collection, field, expire_after_seconds):
+    try:
+        await collection.create_index(field, expireAfterSeconds=expire_after_seconds)
+    except OperationFailure as e:
+        if e.code != INDEX_OPTIONS_CONFLICT:
+            raise
+        await collection.database.command(
+            "collMod", collection.name,
+            index={"keyPattern": {field: 1}, "expireAfterSeconds": expire_after_seconds},
+        )
@@ -0,0 +1,451 @@
+"""Sharded on-disk layout for uploaded documents.
+
+Uploads are stored two directory levels below ``UPLOAD_DIR``, chosen by the
+first four hex digits of the SHA-256 of the stored file name:
+    uploads/3f/a2/{application_id}_{uuid}.pdf
+so no directory holds more than a small slice of the files however many
+there are. Documents keep recording only ``stored_filename``; the path is
+derived from it. Files from the old flat layout are still found until they
+are moved with:
+    python upload_storage.py --migrate
+
+Every filesystem call made from the event loop goes through ``aiofiles`` or
+a worker thread.
+
+New uploads are content-addressed: the file is named by the SHA-256 of its
+bytes, and the ``upload_blobs`` collection keeps one record per stored content
+with a count of the documents referencing it. An upload whose content is
+already stored, e.g. the same bank statement sent twice or for two
+applications, only increments that count and writes nothing to disk. When the
+count drops to zero the record is marked released. Every worker runs a
+reclaimer (``UPLOAD_RECLAIM_INTERVAL_MINUTES``) that deletes the file once it
+has stayed released for ``UPLOAD_ORPHAN_GRACE_MINUTES``, after claiming the
+record so that a new reference arriving meanwhile waits for the delete to
+finish and writes the file again. Files from before content addressing keep
+their unique names.
+
+A background sweeper (``UPLOAD_SWEEP_INTERVAL_MINUTES``, off by default)
+walks the shards one directory at a time and removes files no document
+references, such as files written by an upload whose metadata update failed.
+Files are checked against Mongo in batches of ``UPLOAD_SWEEP_BATCH``, and
+files younger than ``UPLOAD_ORPHAN_GRACE_MINUTES`` are left alone so uploads
+in progress are never touched. Every worker may run the sweeper, but each
+interval only the one that claims it in ``upload_sweeps`` sweeps. A sweep
+that finds more than ``UPLOAD_SWEEP_MAX_ORPHAN_FRACTION`` of the files it
+checked unreferenced removes nothing: that is what pointing at the wrong or
+an empty database looks like. Run one pass by hand with:
+    python upload_storage.py --sweep [--dry-run] [--force]
+and print the space deduplication saves with:
+    python upload_storage.py --report
+"""
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+import asyncio
+import hashlib
+import logging
+import os
+import time
+import uuid
+
+import aiofiles
+import aiofiles.os
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from metrics import REGISTRY
+
+BLOB_COLLECTION = "upload_blobs"
+SWEEP_COLLECTION = "upload_sweeps"
+
+# Document fields that reference a file in UPLOAD_DIR
+REFERENCE_FIELDS = ("documents.stored_filename", "documents.original_stored_filename")
+
+# A delete claim older than this was left by a sweeper that died mid-delete
+CLAIM_TIMEOUT_SECONDS = 60
+
+logger = logging.getLogger(__name__)
+
+
+class SweepRefused(Exception):
+    """Too many of the files a sweep checked are unreferenced to trust the database it checked them against"""
+
+# sha256 -> future for blob writes in flight, so concurrent identical uploads share one write
+_writing = {}
+
+blob_writes = REGISTRY.counter(
+    "loanease_upload_blob_writes",
+    "Uploaded files, by whether their content was written or already stored",
+    ("outcome",),
+)
+blob_bytes = REGISTRY.counter(
+    "loanease_upload_blob_bytes",
+    "Bytes of uploaded files, by whether their content was written or already stored",
+    ("outcome",),
+)
+
+
+def shard_path(upload_dir, stored_filename):
+    digest = hashlib.sha256(stored_filename.encode()).hexdigest()
+    return Path(upload_dir) / digest[:2] / digest[2:4] / stored_filename
+
+
+async def locate(upload_dir, stored_filename):
+    """Path of a stored file in the sharded or the legacy flat layout, or None"""
+    path = shard_path(upload_dir, stored_filename)
+    if await aiofiles.os.path.exists(path):
+        return path
+    legacy = Path(upload_dir) / stored_filename
+    if await aiofiles.os.path.isfile(legacy):
+        return legacy
+    return None
+
+
+async def write_file(upload_dir, stored_filename, data):
+    path = shard_path(upload_dir, stored_filename)
+    await aiofiles.os.makedirs(path.parent, exist_ok=True)
+    # Write then rename, so concurrent writers of the same blob never interleave
+    partial = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+    async with aiofiles.open(partial, 'wb') as f:
+        await f.write(data)
+    await aiofiles.os.replace(partial, path)
+    return path
+
+
+async def read_upload(file, max_size, chunk_size=1024 * 1024):
+    """``(contents, sha256)`` of an upload, hashed chunk by chunk as it is read; None once it exceeds ``max_size``"""
+    digest = hashlib.sha256()
+    chunks = []
+    size = 0
+    while chunk := await file.read(chunk_size):
+        size += len(chunk)
+        if size > max_size:
+            return None
+        digest.update(chunk)
+        chunks.append(chunk)
+    return b"".join(chunks), digest.hexdigest()
+
+
+def is_blob(stored_filename):
+    """Whether a stored file is content-addressed rather than uniquely named"""
+    return len(stored_filename) == 64 and all(char in "0123456789abcdef" for char in stored_filename)
+
+
+async def add_reference(db, upload_dir, sha256, data):
+    """Store ``data`` under its hash, or count one more reference if it already is; returns the stored name"""
+    blobs = db[BLOB_COLLECTION]
+    while True:
+        now = datetime.now(timezone.utc)
+        try:
+            before = await blobs.find_one_and_update(
+                {"_id": sha256, "deleting_at": {"$exists": False}},
+                {
+                    "$inc": {"refs": 1},
+                    "$unset": {"released_at": ""},
+                    "$setOnInsert": {"size": len(data), "created_at": now},
+                },
+                upsert=True,
+                return_document=ReturnDocument.BEFORE,
+            )
+            break
+        except DuplicateKeyError:
+            # The sweeper is deleting this blob and drops the record once the file is gone.
+            # Take back a claim its sweeper never finished.
+            await blobs.update_one(
+                {"_id": sha256, "deleting_at": {"$lt": now - timedelta(seconds=CLAIM_TIMEOUT_SECONDS)}},
+                {"$unset": {"deleting_at": "", "stored": ""}}
+            )
+            await asyncio.sleep(0.05)
+
+    if before is not None and before.get("stored"):
+        outcome = "deduplicated"
+    elif sha256 in _writing:
+        # Another upload of the same content in this process is writing it
+        await asyncio.shield(_writing[sha256])
+        outcome = "deduplicated"
+    else:
+        # New content, or a writer in another process that hasn't finished:
+        # the rename makes a second write harmless
+        future = asyncio.ensure_future(_write_blob(blobs, upload_dir, sha256, data))
+        _writing[sha256] = future
+        future.add_done_callback(lambda _: _writing.pop(sha256, None))
+        await asyncio.shield(future)
+        outcome = "written"
+    blob_writes.inc(outcome)
+    blob_bytes.inc(outcome, amount=len(data))
+    return sha256
+
+
+async def _write_blob(blobs, upload_dir, sha256, data):
+    await write_file(upload_dir, sha256, data)
+    await blobs.update_one({"_id": sha256}, {"$set": {"stored": True}})
+
+
+async def release_reference(db, stored_filename):
+    """Drop one reference to a stored file; its space is reclaimed by the reclaimer once none are left"""
+    if not is_blob(stored_filename):
+        # Uniquely named files are removed by the orphan sweep
+        return
+    blobs = db[BLOB_COLLECTION]
+    blob = await blobs.find_one_and_update(
+        {"_id": stored_filename},
+        {"$inc": {"refs": -1}},
+        projection={"refs": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if blob and blob["refs"] <= 0:
+        await blobs.update_one(
+            {"_id": stored_filename, "refs": {"$lte": 0}},
+            {"$set": {"released_at": datetime.now(timezone.utc)}}
+        )
+
+
+async def reclaim_released(db, upload_dir, grace_seconds, batch_size=500, dry_run=False):
+    """Delete blobs that have had no references for ``grace_seconds``; returns how many"""
+    blobs = db[BLOB_COLLECTION]
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=grace_seconds)
+    released = await blobs.find(
+        {"refs": {"$lte": 0}, "released_at": {"$lt": cutoff}, "deleting_at": {"$exists": False}},
+        {"_id": 1}
+    ).limit(batch_size).to_list(batch_size)
+    removed = 0
+    for blob in released:
+        path = shard_path(upload_dir, blob["_id"])
+        if dry_run:
+            logger.info(f"Would remove released upload {path}")
+            removed += 1
+            continue
+        # From here on a new reference waits until the record is gone
+        claimed_at = datetime.now(timezone.utc)
+        claimed = await blobs.find_one_and_update(
+            {"_id": blob["_id"], "refs": {"$lte": 0}, "deleting_at": {"$exists": False}},
+            {"$set": {"deleting_at": claimed_at}}
+        )
+        if not claimed:
+            # Referenced again since it was listed
+            continue
+        logger.info(f"Removing released upload {path}")
+        try:
+            await aiofiles.os.remove(path)
+        except FileNotFoundError:
+            pass
+        await blobs.delete_one({"_id": blob["_id"], "deleting_at": claimed_at})
+        removed += 1
+    return removed
+
+
+async def report(db):
+    """Totals over all stored blobs: bytes on disk and bytes the documents referencing them add up to"""
+    totals = await db[BLOB_COLLECTION].aggregate([
+        {"$match": {"refs": {"$gt": 0}}},
+        {"$group": {
+            "_id": None,
+            "blobs": {"$sum": 1},
+            "references": {"$sum": "$refs"},
+            "stored_bytes": {"$sum": "$size"},
+            "referenced_bytes": {"$sum": {"$multiply": ["$size", "$refs"]}},
+        }},
+    ]).to_list(1)
+    return totals[0] if totals else {"blobs": 0, "references": 0, "stored_bytes": 0, "referenced_bytes": 0}
+
+
+async def ensure_indexes(db):
+    # Serve the sweeper's "is this file referenced" lookups
+    for field in REFERENCE_FIELDS:
+        await db.loan_applications.create_index(field)
+    await db[BLOB_COLLECTION].create_index(
+        [("released_at", 1)], partialFilterExpression={"refs": {"$lte": 0}}
+    )
+
+
+def _is_shard(name):
+    return len(name) == 2 and all(char in "0123456789abcdef" for char in name)
+
+
+def _list_shards(directory):
+    with os.scandir(directory) as entries:
+        return sorted(entry.name for entry in entries if entry.is_dir() and _is_shard(entry.name))
+
+
+def _list_files(directory, limit=None):
+    """``(name, mtime)`` of up to ``limit`` regular files directly in ``directory``"""
+    files = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False):
+                files.append((entry.name, entry.stat().st_mtime))
+                if limit and len(files) >= limit:
+                    break
+    return files
+
+
+async def iter_stored_files(upload_dir):
+    """Yield ``(path, name, mtime)`` for every stored file, one directory listing at a time"""
+    upload_dir = Path(upload_dir)
+    # Not yet migrated files of the flat layout
+    for name, mtime in await asyncio.to_thread(_list_files, upload_dir):
+        yield upload_dir / name, name, mtime
+    for level1 in await asyncio.to_thread(_list_shards, upload_dir):
+        for level2 in await asyncio.to_thread(_list_shards, upload_dir / level1):
+            directory = upload_dir / level1 / level2
+            for name, mtime in await asyncio.to_thread(_list_files, directory):
+                yield directory / name, name, mtime
+
+
+async def _unreferenced(db, batch):
+    names = [name for _, name in batch]
+    referenced = set()
+    for field in REFERENCE_FIELDS:
+        referenced.update(await db.loan_applications.distinct(field, {field: {"$in": names}}))
+    # Blobs are deleted by reference count, never as orphans
+    blobs = [name for name in names if is_blob(name)]
+    if blobs:
+        referenced.update(await db[BLOB_COLLECTION].distinct("_id", {"_id": {"$in": blobs}}))
+    return [path for path, name in batch if name not in referenced]
+
+
+async def sweep_orphans(db, upload_dir, grace_seconds, batch_size=500, dry_run=False, max_fraction=0.1):
+    """Remove stored files no document references; returns how many
+
+    Raises ``SweepRefused``, removing nothing, when more than ``max_fraction``
+    of the files checked are unreferenced.
+    """
+    cutoff = time.time() - grace_seconds
+    checked = 0
+    orphans = []
+    batch = []
+    async for path, name, mtime in iter_stored_files(upload_dir):
+        if mtime > cutoff:
+            # Possibly an upload whose metadata hasn't been written yet
+            continue
+        batch.append((path, name))
+        checked += 1
+        if len(batch) >= batch_size:
+            orphans += await _unreferenced(db, batch)
+            batch = []
+    if batch:
+        orphans += await _unreferenced(db, batch)
+    if not dry_run and len(orphans) > max_fraction * checked:
+        raise SweepRefused(
+            f"{len(orphans)} of {checked} uploads are unreferenced, more than the "
+            f"{max_fraction:.0%} a sweep removes; check DB_NAME and that the database is complete"
+        )
+    for path in orphans:
+        logger.info(f"{'Would remove' if dry_run else 'Removing'} orphaned upload {path}")
+        if not dry_run:
+            try:
+                await aiofiles.os.remove(path)
+            except FileNotFoundError:
+                pass
+    return len(orphans)
+
+
+async def claim_sweep(db, interval_seconds):
+    """Whether this process runs the sweep that is due; one process does per interval"""
+    now = datetime.now(timezone.utc)
+    try:
+        await db[SWEEP_COLLECTION].find_one_and_update(
+            {"_id": "orphans", "next_run_at": {"$lte": now}},
+            {"$set": {"next_run_at": now + timedelta(seconds=interval_seconds), "claimed_by": os.getpid()}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        # The sweep isn't due, or another process claimed it first
+        return False
+    return True
+
+
+async def run_sweeper(db, upload_dir, grace_seconds, batch_size, interval_seconds, max_fraction):
+    """Background loop started by the app lifespan"""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            if not await claim_sweep(db, interval_seconds):
+                continue
+            removed = await sweep_orphans(db, upload_dir, grace_seconds, batch_size, max_fraction=max_fraction)
+            if removed:
+                logger.info(f"Removed {removed} orphaned uploads")
+        except Exception as e:
+            logger.error(f"Upload sweep failed: {e}")
+
+
+async def run_reclaimer(db, upload_dir, grace_seconds, batch_size, interval_seconds):
+    """Background loop started by the app lifespan; workers running it together claim each blob once"""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            while reclaimed := await reclaim_released(db, upload_dir, grace_seconds, batch_size):
+                logger.info(f"Removed {reclaimed} released uploads")
+        except Exception as e:
+            logger.error(f"Reclaiming released uploads failed: {e}")
+
+
+def _move_batch(upload_dir, names):
+    for name in names:
+        target = shard_path(upload_dir, name)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(upload_dir / name, target)
+
+
+async def migrate_flat_files(upload_dir, batch_size=1000):
+    """Move files of the flat layout into their shards; returns how many"""
+    upload_dir = Path(upload_dir)
+    moved = 0
+    while True:
+        # Moved files leave the top directory, so each listing starts on the next batch
+        batch = [name for name, _ in await asyncio.to_thread(_list_files, upload_dir, batch_size)]
+        if not batch:
+            return moved
+        await asyncio.to_thread(_move_batch, upload_dir, batch)
+        moved += len(batch)
+        logger.info(f"Moved {moved} uploads into the sharded layout")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Manage the upload directory")
+    parser.add_argument("--migrate", action="store_true", help="move flat-layout files into shards")
+    parser.add_argument("--sweep", action="store_true", help="remove files no document references any more")
+    parser.add_argument("--dry-run", action="store_true", help="with --sweep, only list what would be removed")
+    parser.add_argument("--force", action="store_true",
+                        help="with --sweep, remove orphans however large a share of the files they are")
+    parser.add_argument("--report", action="store_true", help="print the space saved by deduplication")
+    args = parser.parse_args()
+
+    async def main():
+        load_dotenv(Path(__file__).parent / '.env')
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        upload_dir = Path(__file__).parent / "uploads"
+        if args.migrate:
+            print(f"Moved {await migrate_flat_files(upload_dir)} files")
+        if args.sweep:
+            client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+            db = client[os.environ['DB_NAME']]
+            await ensure_indexes(db)
+            grace_seconds = int(os.environ.get('UPLOAD_ORPHAN_GRACE_MINUTES', '60')) * 60
+            batch_size = int(os.environ.get('UPLOAD_SWEEP_BATCH', '500'))
+            max_fraction = 1.0 if args.force else float(os.environ.get('UPLOAD_SWEEP_MAX_ORPHAN_FRACTION', '0.1'))
+            removed = await sweep_orphans(
+                db, upload_dir, grace_seconds, batch_size, dry_run=args.dry_run, max_fraction=max_fraction
+            )
+            print(f"{'Found' if args.dry_run else 'Removed'} {removed} orphaned files")
+            if args.dry_run:
+                reclaimed = await reclaim_released(db, upload_dir, grace_seconds, batch_size, dry_run=True)
+            else:
+                reclaimed = 0
+                while batch := await reclaim_released(db, upload_dir, grace_seconds, batch_size):
+                    reclaimed += batch
+            print(f"{'Found' if args.dry_run else 'Removed'} {reclaimed} released files")
+            client.close()
+        if args.report:
+            client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+            totals = await report(client[os.environ['DB_NAME']])
+            saved = totals["referenced_bytes"] - totals["stored_bytes"]
+            print(f"{totals['references']} documents share {totals['blobs']} stored files: "
+                  f"{totals['stored_bytes']} bytes on disk for {totals['referenced_bytes']} bytes uploaded, {saved} saved")
+            client.close()
+
+    asyncio.run(main())
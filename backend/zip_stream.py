@@ -0,0 +1,117 @@
+"""Stream a ZIP archive of files as it is built.
+
+``zipfile`` writes to an unseekable sink by putting each entry's CRC and sizes
+in a data descriptor after its data, so the archive can be produced front to
+back. Entries are stored rather than deflated: uploads are PDFs and images,
+which are already compressed. Each file is read in ``CHUNK_SIZE`` pieces and
+every piece is handed to the response as soon as it is written, so memory use
+stays at one chunk however large the archive gets and the first bytes go out
+immediately.
+
+Entry names come from applicants' file names, so each is reduced to a plain
+base name first: an archive never holds an entry that extracts outside the
+directory it is extracted into.
+"""
+from datetime import datetime
+from io import RawIOBase
+import logging
+import re
+import zipfile
+
+import aiofiles
+
+CHUNK_SIZE = 256 * 1024
+
+# Name of an entry whose file name has nothing usable left
+FALLBACK_NAME = "document"
+
+# Control characters, and the drive separator of Windows paths
+UNSAFE_CHARACTERS = re.compile(r"[\x00-\x1f\x7f:]")
+
+logger = logging.getLogger(__name__)
+
+
+class _Sink(RawIOBase):
+    """Unseekable stream collecting what zipfile writes until it is drained"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def safe_name(name):
+    """The last path component of ``name``, without control characters; never empty, ``.`` or ``..``"""
+    name = re.split(r"[/\\]", name or "")[-1]
+    name = UNSAFE_CHARACTERS.sub("_", name).strip()
+    if name.strip(".") == "":
+        return FALLBACK_NAME
+    return name
+
+
+def unique_name(name, used):
+    """``name``, or ``name (2)``, ``name (3)``, ... if already in the archive"""
+    candidate = name
+    stem, dot, extension = name.rpartition(".")
+    if not dot:
+        stem, extension = name, ""
+    counter = 2
+    while candidate in used:
+        candidate = f"{stem} ({counter}){dot}{extension}"
+        counter += 1
+    used.add(candidate)
+    return candidate
+
+
+async def stream_zip(entries):
+    """Yield a ZIP of ``(path, archive name, modified datetime, size)`` entries, chunk by chunk"""
+    sink = _Sink()
+    used = set()
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED) as archive:
+        for path, name, modified, size in entries:
+            try:
+                source = await aiofiles.open(path, "rb")
+            except FileNotFoundError:
+                logger.warning(f"Skipping missing file {path} in ZIP download")
+                continue
+            info = zipfile.ZipInfo(unique_name(safe_name(name), used), date_time=_zip_time(modified))
+            info.compress_type = zipfile.ZIP_STORED
+            # Lets zipfile decide up front whether the entry needs ZIP64 fields
+            info.file_size = size
+            try:
+                with archive.open(info, mode="w") as entry:
+                    while chunk := await source.read(CHUNK_SIZE):
+                        entry.write(chunk)
+                        yield sink.drain()
+            finally:
+                await source.close()
+            # The data descriptor is written when the entry closes
+            if data := sink.drain():
+                yield data
+    # Central directory
+    yield sink.drain()
+
+
+def _zip_time(modified):
+    # ZIP timestamps cannot predate 1980
+    if modified is None or modified.year < 1980:
+        modified = datetime(1980, 1, 1)
+    return modified.timetuple()[:6]
@@ -0,0 +1,134 @@
+"""Concurrency check of loan acceptance: parallel submissions for one application.
+
+Each round creates and approves an application, then fires ``--parallel``
+identical accept-loan submissions at it at once, the way double clicks,
+retrying clients and impatient applicants do. Exactly one may succeed; the
+others must be refused with 400 "already submitted", and the application must
+end up with a single banking record. The script reports the outcome counts and
+submission latencies as JSON and exits non-zero if any round broke that rule.
+
+Targets:
+  --mode in-process   the app with the in-memory fake database, which yields
+                      to the event loop on every operation so requests
+                      interleave between their reads and writes
+  --mode url          an already running server at --base-url (start it with
+                      ADMISSION_CONTROL=0, or the per-client limits refuse
+                      most submissions before they reach the handler)
+
+Example:
+  python benchmarks/accept_race.py --parallel 500 --rounds 20
+"""
+from time import perf_counter
+import argparse
+import asyncio
+import json
+import logging
+import random
+import sys
+
+import httpx
+
+import load_test
+
+SUBMISSION = {
+    "agree_to_terms": True,
+    "account_number": "123456789012",
+    "routing_number": "021000021",
+    "card_number": "4111111111111111",
+    "card_cvv": "123",
+    "card_expiration": "12/2030",
+}
+
+
+async def run_round(client, payload, parallel):
+    application = (await client.post("/api/applications", json=payload)).json()
+    application_id = application["id"]
+    response = await client.patch(f"/api/applications/{application_id}/status", json={"status": "approved"})
+    token = response.json()["approval_token"]
+
+    async def submit():
+        start = perf_counter()
+        response = await client.post(
+            "/api/applications/accept-loan",
+            json={"application_id": application_id, "token": token, **SUBMISSION}
+        )
+        return response.status_code, perf_counter() - start
+
+    results = await asyncio.gather(*(submit() for _ in range(parallel)))
+    statuses = [status for status, _ in results]
+    banking = await client.get(f"/api/applications/{application_id}/banking-info")
+    return {
+        "application_id": application_id,
+        "accepted": statuses.count(200),
+        "already_submitted": statuses.count(400),
+        "other": len(statuses) - statuses.count(200) - statuses.count(400),
+        "banking_info_status": banking.status_code,
+        "latencies": [elapsed for _, elapsed in results],
+    }
+
+
+async def run(args):
+    if args.mode == "in-process":
+        client = load_test.in_process_client(admission=False)
+        import server
+
+        # The lifespan doesn't run here; create the indexes it would, unique ones included
+        await server.ensure_indexes()
+    else:
+        await load_test.wait_until_ready(args.base_url)
+        limits = httpx.Limits(max_connections=args.parallel, max_keepalive_connections=args.parallel)
+        client = httpx.AsyncClient(base_url=args.base_url, timeout=60, limits=limits)
+
+    rounds = []
+    try:
+        user = load_test.VirtualUser(client, load_test.Recorder(), [], random.Random(args.seed), b"")
+        for _ in range(args.rounds):
+            rounds.append(await run_round(client, user.application_payload(), args.parallel))
+    finally:
+        await client.aclose()
+
+    if args.mode == "in-process":
+        for result in rounds:
+            result["banking_records"] = await server.db.banking_info.count_documents(
+                {"application_id": result["application_id"]}
+            )
+
+    latencies = sorted(elapsed for result in rounds for elapsed in result.pop("latencies"))
+    failed = [
+        result for result in rounds
+        if result["accepted"] != 1 or result["other"] or result["banking_info_status"] != 200
+        or result.get("banking_records", 1) != 1
+    ]
+    return {
+        "mode": args.mode,
+        "rounds": args.rounds,
+        "parallel": args.parallel,
+        "accepted": sum(result["accepted"] for result in rounds),
+        "already_submitted": sum(result["already_submitted"] for result in rounds),
+        "other": sum(result["other"] for result in rounds),
+        "p50_ms": round(load_test.percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(load_test.percentile(latencies, 99) * 1000, 2),
+        "failed_rounds": failed,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["in-process", "url"], default="in-process")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8001", help="target for --mode url")
+    parser.add_argument("--parallel", type=int, default=200, help="simultaneous submissions per application")
+    parser.add_argument("--rounds", type=int, default=10, help="applications to accept")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+    if report["failed_rounds"]:
+        print(f"{len(report['failed_rounds'])} of {args.rounds} rounds did not accept exactly once", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,753 @@
+"""In-memory stand-in for the subset of Motor used by ``backend/server.py``.
+
+This is not a MongoDB emulator. It implements just enough of the query,
+update and aggregation language for the API handlers to run unchanged, so the
+benchmarks can measure the app without a mongod (and, for micro-benchmarks,
+without any database time at all).
+
+Every operation yields to the event loop once before running, like a real
+driver round trip, so concurrent requests interleave realistically. Unique
+indexes are enforced so that duplicate-key code paths behave as in MongoDB.
+"""
+from copy import deepcopy
+from datetime import datetime
+import asyncio
+import re
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from pymongo.results import DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+_MISSING = object()
+
+# Values projections can share with the stored document instead of copying
+_IMMUTABLE = (str, int, float, bool, type(None), datetime)
+
+
+def _get_path(doc, path):
+    value = doc
+    for part in path.split("."):
+        if isinstance(value, dict):
+            value = value.get(part, _MISSING)
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        elif isinstance(value, list):
+            # "documents.id" on an array of subdocuments: the values of every element
+            value = [item[part] for item in value if isinstance(item, dict) and part in item] or _MISSING
+        else:
+            return _MISSING
+        if value is _MISSING:
+            return _MISSING
+    return value
+
+
+def _set_path(doc, path, value):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def _unset_path(doc, path):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+
+def _sort_key(value):
+    # Order None/missing first, then numbers, then strings, like BSON comparison order
+    if value is _MISSING or value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (3, value)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    return (4, str(value))
+
+
+def _compare(op, value, operand):
+    if value is _MISSING or value is None:
+        return False
+    try:
+        if op == "$gt":
+            return value > operand
+        if op == "$gte":
+            return value >= operand
+        if op == "$lt":
+            return value < operand
+        if op == "$lte":
+            return value <= operand
+    except TypeError:
+        return False
+    raise NotImplementedError(op)
+
+
+def _match_condition(value, condition):
+    if isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition):
+        for op, operand in condition.items():
+            if op == "$eq":
+                if not _match_condition(value, operand):
+                    return False
+            elif op == "$ne":
+                if _match_condition(value, operand):
+                    return False
+            elif op == "$in":
+                if not any(_match_condition(value, item) for item in operand):
+                    return False
+            elif op == "$nin":
+                if any(_match_condition(value, item) for item in operand):
+                    return False
+            elif op == "$exists":
+                if (value is not _MISSING) != bool(operand):
+                    return False
+            elif op in ("$gt", "$gte", "$lt", "$lte"):
+                candidates = value if isinstance(value, list) else [value]
+                if not any(_compare(op, candidate, operand) for candidate in candidates):
+                    return False
+            elif op == "$regex":
+                flags = re.IGNORECASE if "i" in condition.get("$options", "") else 0
+                if not isinstance(value, str) or not re.search(operand, value, flags):
+                    return False
+            elif op == "$options":
+                continue
+            else:
+                raise NotImplementedError(f"fake_db does not support query operator {op}")
+        return True
+    if isinstance(condition, re.Pattern):
+        return isinstance(value, str) and bool(condition.search(value))
+    if isinstance(value, list) and not isinstance(condition, list):
+        return condition in value
+    if value is _MISSING:
+        return condition is None
+    return value == condition
+
+
+def matches(doc, query):
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(matches(doc, sub) for sub in condition):
+                return False
+        elif key == "$and":
+            if not all(matches(doc, sub) for sub in condition):
+                return False
+        elif key == "$nor":
+            if any(matches(doc, sub) for sub in condition):
+                return False
+        elif not _match_condition(_get_path(doc, key), condition):
+            return False
+    return True
+
+
+def _copy(value):
+    return value if isinstance(value, _IMMUTABLE) else deepcopy(value)
+
+
+def _include(source, parts, target):
+    """Copy the field at path ``parts`` of ``source`` into ``target``, through arrays like Mongo does"""
+    head = parts[0]
+    if head not in source:
+        return
+    value = source[head]
+    if len(parts) == 1:
+        target[head] = _copy(value)
+    elif isinstance(value, dict):
+        _include(value, parts[1:], target.setdefault(head, {}))
+    elif isinstance(value, list):
+        # "documents.id" keeps the array, with only the ids of its subdocuments
+        items = [item for item in value if isinstance(item, dict)]
+        for item, projected in zip(items, target.setdefault(head, [{} for _ in items])):
+            _include(item, parts[1:], projected)
+
+
+def _project(doc, projection):
+    if not projection:
+        return deepcopy(doc)
+    include_id = projection.get("_id", 1)
+    fields = {key: value for key, value in projection.items() if key != "_id"}
+    if fields and all(value for value in fields.values()):
+        result = {}
+        for key in fields:
+            if "." not in key:
+                if key in doc:
+                    result[key] = _copy(doc[key])
+            else:
+                _include(doc, key.split("."), result)
+        if include_id and "_id" in doc:
+            result["_id"] = doc["_id"]
+        return result
+    result = {key: _copy(value) for key, value in doc.items()}
+    for key in fields:
+        _unset_path(result, key)
+    if not include_id:
+        result.pop("_id", None)
+    return result
+
+
+def _apply_update(doc, update, inserting=False):
+    for op, fields in update.items():
+        if op == "$set":
+            for key, value in fields.items():
+                _set_path(doc, key, deepcopy(value))
+        elif op == "$setOnInsert":
+            if inserting:
+                for key, value in fields.items():
+                    _set_path(doc, key, deepcopy(value))
+        elif op == "$unset":
+            for key in fields:
+                _unset_path(doc, key)
+        elif op == "$inc":
+            for key, amount in fields.items():
+                current = _get_path(doc, key)
+                _set_path(doc, key, (0 if current is _MISSING else current) + amount)
+        elif op == "$max":
+            for key, value in fields.items():
+                current = _get_path(doc, key)
+                if current is _MISSING or value > current:
+                    _set_path(doc, key, value)
+        elif op == "$min":
+            for key, value in fields.items():
+                current = _get_path(doc, key)
+                if current is _MISSING or value < current:
+                    _set_path(doc, key, value)
+        elif op in ("$push", "$addToSet"):
+            for key, value in fields.items():
+                current = _get_path(doc, key)
+                if current is _MISSING:
+                    current = []
+                    _set_path(doc, key, current)
+                items = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                for item in items:
+                    if op == "$push" or item not in current:
+                        current.append(deepcopy(item))
+        elif op == "$pull":
+            for key, condition in fields.items():
+                current = _get_path(doc, key)
+                if isinstance(current, list):
+                    current[:] = [
+                        item for item in current
+                        if not (matches(item, condition) if isinstance(condition, dict) else item == condition)
+                    ]
+        else:
+            raise NotImplementedError(f"fake_db does not support update operator {op}")
+
+
+def _evaluate(expression, doc):
+    if isinstance(expression, str) and expression.startswith("$"):
+        value = _get_path(doc, expression[1:])
+        return None if value is _MISSING else value
+    if isinstance(expression, dict):
+        if len(expression) == 1:
+            op, args = next(iter(expression.items()))
+            if op.startswith("$"):
+                return _evaluate_operator(op, args, doc)
+        return {key: _evaluate(value, doc) for key, value in expression.items()}
+    return expression
+
+
+def _evaluate_operator(op, args, doc):
+    if op == "$cond":
+        if isinstance(args, dict):
+            args = [args["if"], args["then"], args["else"]]
+        return _evaluate(args[1] if _evaluate(args[0], doc) else args[2], doc)
+    if op == "$regexMatch":
+        spec = {key: _evaluate(value, doc) for key, value in args.items()}
+        flags = re.IGNORECASE if "i" in spec.get("options", "") else 0
+        return bool(re.search(spec["regex"], spec["input"] or "", flags))
+    values = [_evaluate(arg, doc) for arg in (args if isinstance(args, list) else [args])]
+    if op == "$eq":
+        return values[0] == values[1]
+    if op == "$ne":
+        return values[0] != values[1]
+    if op == "$gt":
+        return values[0] is not None and values[1] is not None and values[0] > values[1]
+    if op == "$gte":
+        return values[0] is not None and values[1] is not None and values[0] >= values[1]
+    if op == "$lt":
+        return values[0] is not None and values[1] is not None and values[0] < values[1]
+    if op == "$lte":
+        return values[0] is not None and values[1] is not None and values[0] <= values[1]
+    if op == "$in":
+        return values[0] in (values[1] or [])
+    if op == "$add":
+        return sum(value or 0 for value in values)
+    if op == "$subtract":
+        return (values[0] or 0) - (values[1] or 0)
+    if op == "$multiply":
+        result = 1
+        for value in values:
+            result *= value or 0
+        return result
+    if op == "$divide":
+        return values[0] / values[1] if values[1] else None
+    if op == "$ifNull":
+        return values[0] if values[0] is not None else values[1]
+    if op == "$size":
+        return len(values[0] or [])
+    if op == "$substrCP":
+        return (values[0] or "")[values[1]:values[1] + values[2]]
+    if op == "$toUpper":
+        return (values[0] or "").upper()
+    if op == "$toLower":
+        return (values[0] or "").lower()
+    raise NotImplementedError(f"fake_db does not support expression operator {op}")
+
+
+def _accumulate(op, values):
+    if op == "$sum":
+        return sum(value for value in values if isinstance(value, (int, float)) and not isinstance(value, bool))
+    if op == "$avg":
+        numbers = [value for value in values if isinstance(value, (int, float))]
+        return sum(numbers) / len(numbers) if numbers else None
+    if op == "$min":
+        present = [value for value in values if value is not None]
+        return min(present) if present else None
+    if op == "$max":
+        present = [value for value in values if value is not None]
+        return max(present) if present else None
+    if op == "$first":
+        return values[0] if values else None
+    if op == "$last":
+        return values[-1] if values else None
+    if op == "$push":
+        return list(values)
+    if op == "$addToSet":
+        result = []
+        for value in values:
+            if value not in result:
+                result.append(value)
+        return result
+    raise NotImplementedError(f"fake_db does not support accumulator {op}")
+
+
+def _sort_docs(docs, spec):
+    if isinstance(spec, dict):
+        spec = list(spec.items())
+    for key, direction in reversed(spec):
+        docs.sort(key=lambda doc: _sort_key(_get_path(doc, key)), reverse=direction < 0)
+    return docs
+
+
+class FakeCursor:
+    def __init__(self, loader):
+        self._loader = loader
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key_or_list, direction=1):
+        self._sort = [(key_or_list, direction)] if isinstance(key_or_list, str) else list(key_or_list)
+        return self
+
+    def skip(self, count):
+        self._skip = count
+        return self
+
+    def limit(self, count):
+        self._limit = count
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def _results(self):
+        docs = self._loader()
+        if self._sort:
+            _sort_docs(docs, self._sort)
+        docs = docs[self._skip:]
+        if self._limit:
+            docs = docs[:self._limit]
+        return docs
+
+    async def to_list(self, length=None):
+        await asyncio.sleep(0)
+        docs = self._results()
+        return docs[:length] if length else docs
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        await asyncio.sleep(0)
+        for doc in self._results():
+            yield doc
+
+
+class FakeCollection:
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self._docs = []
+        # _id -> document, for the documents whose _id is hashable
+        self._by_id = {}
+        self._unique_indexes = []
+        self.indexes = {}
+
+    def _find_docs(self, query):
+        if query and len(query) == 1 and "_id" in query and not isinstance(query["_id"], (dict, list)):
+            doc = self._by_id.get(query["_id"])
+            return [doc] if doc is not None else []
+        return [doc for doc in self._docs if matches(doc, query or {})]
+
+    def _add(self, doc):
+        self._check_unique(doc)
+        self._docs.append(doc)
+        if not isinstance(doc["_id"], (dict, list)):
+            self._by_id[doc["_id"]] = doc
+
+    def _remove(self, doc):
+        self._docs.remove(doc)
+        if self._by_id.get(doc["_id"]) is doc:
+            del self._by_id[doc["_id"]]
+
+    def _check_unique(self, candidate, ignore=None):
+        for keys, partial in [(["_id"], None)] + self._unique_indexes:
+            if partial and not matches(candidate, partial):
+                continue
+            if keys == ["_id"] and not isinstance(candidate["_id"], (dict, list)):
+                existing = self._by_id.get(candidate["_id"])
+                if existing is not None and existing is not ignore:
+                    raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {keys}")
+                continue
+            value = tuple(_get_path(candidate, key) for key in keys)
+            if ignore is not None and value == tuple(_get_path(ignore, key) for key in keys):
+                # An update that leaves the indexed values alone can't make them collide
+                continue
+            for doc in self._docs:
+                if doc is ignore or (partial and not matches(doc, partial)):
+                    continue
+                if tuple(_get_path(doc, key) for key in keys) == value:
+                    raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {keys}")
+
+    async def create_index(self, keys, unique=False, name=None, partialFilterExpression=None, **kwargs):
+        await asyncio.sleep(0)
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        name = name or "_".join(f"{key}_{direction}" for key, direction in keys)
+        self.indexes[name] = {"key": list(keys), "unique": unique, **kwargs}
+        if unique:
+            self._unique_indexes.append(([key for key, _ in keys], partialFilterExpression))
+        return name
+
+    async def create_indexes(self, indexes):
+        names = []
+        for index in indexes:
+            document = dict(index.document)
+            keys = list(document.pop("key").items())
+            names.append(await self.create_index(keys, **document))
+        return names
+
+    async def drop_indexes(self):
+        self.indexes.clear()
+        self._unique_indexes.clear()
+
+    async def insert_one(self, document):
+        await asyncio.sleep(0)
+        document.setdefault("_id", ObjectId())
+        stored = deepcopy(document)
+        self._add(stored)
+        return InsertOneResult(document["_id"], True)
+
+    async def insert_many(self, documents, ordered=True):
+        ids = []
+        for document in documents:
+            result = await self.insert_one(document)
+            ids.append(result.inserted_id)
+        return InsertManyResult(ids, True)
+
+    async def find_one(self, filter=None, projection=None, sort=None, **kwargs):
+        await asyncio.sleep(0)
+        docs = self._find_docs(filter)
+        if sort:
+            _sort_docs(docs, sort)
+        return _project(docs[0], projection) if docs else None
+
+    def find(self, filter=None, projection=None, sort=None, skip=0, limit=0, **kwargs):
+        cursor = FakeCursor(lambda: [_project(doc, projection) for doc in self._find_docs(filter)])
+        if sort:
+            cursor.sort(sort)
+        return cursor.skip(skip).limit(limit)
+
+    async def count_documents(self, filter, **kwargs):
+        await asyncio.sleep(0)
+        docs = self._find_docs(filter)
+        docs = docs[kwargs.get("skip", 0):]
+        if kwargs.get("limit"):
+            docs = docs[:kwargs["limit"]]
+        return len(docs)
+
+    async def estimated_document_count(self):
+        await asyncio.sleep(0)
+        return len(self._docs)
+
+    async def distinct(self, key, filter=None):
+        await asyncio.sleep(0)
+        values = []
+        for doc in self._find_docs(filter):
+            value = _get_path(doc, key)
+            for item in (value if isinstance(value, list) else [value]):
+                if item is not _MISSING and item not in values:
+                    values.append(item)
+        return values
+
+    def _upsert_document(self, filter, update):
+        doc = {
+            key: value for key, value in filter.items()
+            if not key.startswith("$") and not (isinstance(value, dict) and any(k.startswith("$") for k in value))
+        }
+        if any(key.startswith("$") for key in update):
+            _apply_update(doc, update, inserting=True)
+        else:
+            doc.update(deepcopy(update))
+        doc.setdefault("_id", ObjectId())
+        self._add(doc)
+        return doc
+
+    def _update_doc(self, doc, update):
+        candidate = deepcopy(doc)
+        if any(key.startswith("$") for key in update):
+            _apply_update(candidate, update)
+        else:
+            candidate = {"_id": doc["_id"], **deepcopy(update)}
+        self._check_unique(candidate, ignore=doc)
+        modified = candidate != doc
+        doc.clear()
+        doc.update(candidate)
+        return modified
+
+    async def update_one(self, filter, update, upsert=False, **kwargs):
+        await asyncio.sleep(0)
+        docs = self._find_docs(filter)
+        if docs:
+            modified = self._update_doc(docs[0], update)
+            return UpdateResult({"n": 1, "nModified": int(modified)}, True)
+        if upsert:
+            doc = self._upsert_document(filter, update)
+            return UpdateResult({"n": 1, "nModified": 0, "upserted": doc["_id"]}, True)
+        return UpdateResult({"n": 0, "nModified": 0}, True)
+
+    async def update_many(self, filter, update, upsert=False, **kwargs):
+        await asyncio.sleep(0)
+        docs = self._find_docs(filter)
+        modified = sum(self._update_doc(doc, update) for doc in docs)
+        if not docs and upsert:
+            doc = self._upsert_document(filter, update)
+            return UpdateResult({"n": 1, "nModified": 0, "upserted": doc["_id"]}, True)
+        return UpdateResult({"n": len(docs), "nModified": modified}, True)
+
+    async def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        return await self.update_one(filter, replacement, upsert=upsert)
+
+    async def find_one_and_update(
+        self, filter, update, projection=None, sort=None, upsert=False,
+        return_document=ReturnDocument.BEFORE, **kwargs
+    ):
+        await asyncio.sleep(0)
+        docs = self._find_docs(filter)
+        if sort:
+            _sort_docs(docs, sort)
+        if docs:
+            before = deepcopy(docs[0])
+            self._update_doc(docs[0], update)
+            result = docs[0] if return_document == ReturnDocument.AFTER else before
+            return _project(result, projection)
+        if upsert:
+            doc = self._upsert_document(filter, update)
+            return _project(doc, projection) if return_document == ReturnDocument.AFTER else None
+        return None
+
+    async def find_one_and_delete(self, filter, projection=None, sort=None, **kwargs):
+        await asyncio.sleep(0)
+        docs = self._find_docs(filter)
+        if sort:
+            _sort_docs(docs, sort)
+        if not docs:
+            return None
+        self._remove(docs[0])
+        return _project(docs[0], projection)
+
+    async def delete_one(self, filter, **kwargs):
+        await asyncio.sleep(0)
+        docs = self._find_docs(filter)
+        if docs:
+            self._remove(docs[0])
+        return DeleteResult({"n": len(docs[:1])}, True)
+
+    async def delete_many(self, filter, **kwargs):
+        await asyncio.sleep(0)
+        docs = self._find_docs(filter)
+        ids = {id(doc) for doc in docs}
+        self._docs = [doc for doc in self._docs if id(doc) not in ids]
+        for doc in docs:
+            if self._by_id.get(doc["_id"]) is doc:
+                del self._by_id[doc["_id"]]
+        return DeleteResult({"n": len(docs)}, True)
+
+    async def bulk_write(self, requests, ordered=True, **kwargs):
+        matched = modified = inserted = deleted = 0
+        upserted = {}
+        for index, request in enumerate(requests):
+            kind = type(request).__name__
+            if kind == "InsertOne":
+                await self.insert_one(request._doc)
+                inserted += 1
+            elif kind in ("UpdateOne", "UpdateMany", "ReplaceOne"):
+                method = self.update_many if kind == "UpdateMany" else self.update_one
+                result = await method(request._filter, request._doc, upsert=bool(request._upsert))
+                matched += result.matched_count
+                modified += result.modified_count
+                if result.upserted_id is not None:
+                    upserted[index] = result.upserted_id
+            elif kind in ("DeleteOne", "DeleteMany"):
+                method = self.delete_many if kind == "DeleteMany" else self.delete_one
+                deleted += (await method(request._filter)).deleted_count
+            else:
+                raise NotImplementedError(f"fake_db does not support bulk operation {kind}")
+        return FakeBulkWriteResult(inserted, matched, modified, deleted, upserted)
+
+    def aggregate(self, pipeline, **kwargs):
+        return FakeCursor(lambda: self._aggregate(pipeline))
+
+    def _aggregate(self, pipeline):
+        docs = [deepcopy(doc) for doc in self._docs]
+        for stage in pipeline:
+            (op, spec), = stage.items()
+            if op == "$match":
+                docs = [doc for doc in docs if matches(doc, spec)]
+            elif op == "$group":
+                groups = {}
+                for doc in docs:
+                    key = _evaluate(spec["_id"], doc)
+                    hashable = repr(key)
+                    groups.setdefault(hashable, (key, []))[1].append(doc)
+                docs = []
+                for key, members in groups.values():
+                    result = {"_id": key}
+                    for field, accumulator in spec.items():
+                        if field == "_id":
+                            continue
+                        (acc_op, expression), = accumulator.items()
+                        result[field] = _accumulate(acc_op, [_evaluate(expression, doc) for doc in members])
+                    docs.append(result)
+            elif op == "$sort":
+                _sort_docs(docs, spec)
+            elif op == "$skip":
+                docs = docs[spec:]
+            elif op == "$limit":
+                docs = docs[:spec]
+            elif op == "$count":
+                docs = [{spec: len(docs)}] if docs else []
+            elif op == "$project":
+                docs = [self._project_stage(doc, spec) for doc in docs]
+            elif op in ("$addFields", "$set"):
+                for doc in docs:
+                    computed = {key: _evaluate(expression, doc) for key, expression in spec.items()}
+                    for key, value in computed.items():
+                        _set_path(doc, key, value)
+            elif op == "$unwind":
+                path = spec if isinstance(spec, str) else spec["path"]
+                field = path[1:]
+                unwound = []
+                for doc in docs:
+                    for item in _get_path(doc, field) or []:
+                        copy = deepcopy(doc)
+                        _set_path(copy, field, item)
+                        unwound.append(copy)
+                docs = unwound
+            elif op == "$lookup":
+                foreign = self.database[spec["from"]]
+                for doc in docs:
+                    local = _get_path(doc, spec["localField"])
+                    joined = [
+                        deepcopy(other) for other in foreign._docs
+                        if _get_path(other, spec["foreignField"]) == local
+                    ]
+                    doc[spec["as"]] = foreign._aggregate_docs(joined, spec["pipeline"]) if "pipeline" in spec else joined
+            elif op == "$facet":
+                docs = [{name: self._aggregate_docs(docs, sub) for name, sub in spec.items()}]
+            else:
+                raise NotImplementedError(f"fake_db does not support aggregation stage {op}")
+        return docs
+
+    @staticmethod
+    def _project_stage(doc, spec):
+        flags = {key: value for key, value in spec.items() if isinstance(value, (bool, int)) and key != "_id"}
+        computed = {key: value for key, value in spec.items() if key not in flags and key != "_id"}
+        if flags and not any(flags.values()) and not computed:
+            return _project(doc, spec)
+        result = {}
+        if spec.get("_id", 1) and "_id" in doc:
+            result["_id"] = doc["_id"] if spec.get("_id", 1) in (1, True) else _evaluate(spec["_id"], doc)
+        for key in flags:
+            value = _get_path(doc, key)
+            if value is not _MISSING:
+                _set_path(result, key, value)
+        for key, expression in computed.items():
+            _set_path(result, key, _evaluate(expression, doc))
+        return result
+
+    def _aggregate_docs(self, docs, pipeline):
+        scratch = FakeCollection(self.database, self.name)
+        scratch._docs = docs
+        return scratch._aggregate(pipeline)
+
+
+class FakeBulkWriteResult:
+    def __init__(self, inserted, matched, modified, deleted, upserted):
+        self.inserted_count = inserted
+        self.matched_count = matched
+        self.modified_count = modified
+        self.deleted_count = deleted
+        self.upserted_ids = upserted
+        self.upserted_count = len(upserted)
+        self.acknowledged = True
+
+
+class FakeDatabase:
+    def __init__(self, name="loanease_fake"):
+        self.name = name
+        self._collections = {}
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name):
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections[name] = FakeCollection(self, name)
+        return collection
+
+    async def command(self, command, *args, **kwargs):
+        await asyncio.sleep(0)
+        return {"ok": 1.0}
+
+    async def list_collection_names(self):
+        return list(self._collections)
+
+    async def create_collection(self, name, **kwargs):
+        await asyncio.sleep(0)
+        return self[name]
+
+
+class FakeClient:
+    """Stand-in for ``AsyncIOMotorClient``"""
+
+    def __init__(self, *args, **kwargs):
+        self._databases = {}
+        self.admin = FakeDatabase("admin")
+
+    def __getitem__(self, name):
+        database = self._databases.get(name)
+        if database is None:
+            database = self._databases[name] = FakeDatabase(name)
+        return database
+
+    def close(self):
+        pass
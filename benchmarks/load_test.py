@@ -0,0 +1,495 @@
+"""Local load-testing benchmark for the LoanEase API.
+
+Drives a realistic mixed workload (applicants applying and tracking, admins
+triaging, document uploads and loan acceptance) with a fixed number of
+concurrent virtual users, then reports per-endpoint latency percentiles and
+throughput as JSON so runs can be compared for regressions.
+
+Targets:
+  --mode in-process   the app is driven through an in-process ASGI transport
+                      with the in-memory fake database (no mongod needed)
+  --mode local        uvicorn is started on this machine against --mongo-url
+  --mode url          an already running server at --base-url
+
+Examples:
+  python benchmarks/load_test.py --mode in-process --concurrency 32 --duration 20 -o run.json
+  python benchmarks/load_test.py --mode local --workers 4 --baseline run.json
+"""
+from datetime import datetime, timezone
+from pathlib import Path
+from time import perf_counter
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import uuid
+
+import httpx
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+BACKEND_DIR = REPO_ROOT / "backend"
+
+# Scenario weights, roughly matching production traffic
+WORKLOAD = {
+    "apply": 20,
+    "track": 35,
+    "admin_triage": 25,
+    "upload": 10,
+    "accept_loan": 10,
+    "calculator": 0,
+}
+
+FIRST_NAMES = ["John", "Maria", "Wei", "Aisha", "Carlos", "Olga", "Priya", "Tom"]
+LAST_NAMES = ["Doe", "Garcia", "Zhang", "Khan", "Silva", "Ivanova", "Patel", "Brown"]
+CITIES = [("New York", "NY"), ("Austin", "TX"), ("Denver", "CO"), ("Miami", "FL"), ("Seattle", "WA")]
+EMPLOYMENT = ["employed", "self_employed", "unemployed", "retired", "student"]
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.recording = False
+
+    def record(self, endpoint, elapsed, ok):
+        if not self.recording:
+            return
+        self.latencies.setdefault(endpoint, []).append(elapsed)
+        if not ok:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def summary(self, elapsed_seconds):
+        endpoints = {}
+        all_latencies = []
+        for endpoint, values in sorted(self.latencies.items()):
+            values.sort()
+            all_latencies.extend(values)
+            endpoints[endpoint] = self._stats(values, self.errors.get(endpoint, 0), elapsed_seconds)
+        all_latencies.sort()
+        totals = self._stats(all_latencies, sum(self.errors.values()), elapsed_seconds)
+        return totals, endpoints
+
+    @staticmethod
+    def _stats(values, errors, elapsed_seconds):
+        count = len(values)
+        return {
+            "count": count,
+            "errors": errors,
+            "throughput_rps": round(count / elapsed_seconds, 2) if elapsed_seconds else 0.0,
+            "mean_ms": round(sum(values) / count * 1000, 3) if count else 0.0,
+            "p50_ms": round(percentile(values, 50) * 1000, 3),
+            "p95_ms": round(percentile(values, 95) * 1000, 3),
+            "p99_ms": round(percentile(values, 99) * 1000, 3),
+            "max_ms": round(values[-1] * 1000, 3) if count else 0.0,
+        }
+
+
+def _pdf_stream(data):
+    return b"<< /Length %d >>\nstream\n" % len(data) + data + b"\nendstream"
+
+
+def pdf_document(padding=b""):
+    """A valid one-page PDF, so preview jobs render it; ``padding`` pads it out in an unreferenced stream"""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R"
+        b" /Resources << /Font << /F1 5 0 R >> >> >>",
+        _pdf_stream(b"BT /F1 24 Tf 72 720 Td (Pay stub) Tj ET"),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        _pdf_stream(padding),
+    ]
+    document = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(document))
+        document += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(document)
+    document += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    document += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    document += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(document)
+
+
+class VirtualUser:
+    def __init__(self, client, recorder, pool, rng, upload_bytes):
+        self.client = client
+        self.recorder = recorder
+        self.pool = pool
+        self.rng = rng
+        self.upload_bytes = upload_bytes
+
+    async def call(self, endpoint, method, url, expected=(200,), **kwargs):
+        start = perf_counter()
+        try:
+            response = await self.client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            self.recorder.record(endpoint, perf_counter() - start, False)
+            return None
+        self.recorder.record(endpoint, perf_counter() - start, response.status_code in expected)
+        return response
+
+    def application_payload(self):
+        rng = self.rng
+        city, state = rng.choice(CITIES)
+        first_name = rng.choice(FIRST_NAMES)
+        last_name = rng.choice(LAST_NAMES)
+        return {
+            "first_name": first_name,
+            "last_name": last_name,
+            "email": f"{first_name.lower()}.{last_name.lower()}.{uuid.uuid4().hex[:8]}@example.com",
+            "phone": f"555{rng.randint(1000000, 9999999)}",
+            "date_of_birth": f"19{rng.randint(50, 99)}-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}",
+            "street_address": f"{rng.randint(1, 9999)} Main Street",
+            "city": city,
+            "state": state,
+            "zip_code": f"{rng.randint(10000, 99999)}",
+            "annual_income": float(rng.randint(15000, 250000)),
+            "employment_status": rng.choice(EMPLOYMENT),
+            "loan_amount_requested": float(rng.randint(1, 50) * 100),
+            "ssn_last_four": f"{rng.randint(0, 9999):04d}",
+        }
+
+    async def apply(self, share=True):
+        """Submit an application; share=False keeps it out of the pool until the caller's flow is done"""
+        response = await self.call("POST /api/applications", "POST", "/api/applications", json=self.application_payload())
+        if response is None or response.status_code != 200:
+            return None
+        application = response.json()
+        if share:
+            self.share(application)
+        return application
+
+    def share(self, application):
+        self.pool.append((application["id"], application["email"]))
+
+    async def track(self):
+        if not self.pool:
+            await self.apply()
+            return
+        application_id, email = self.rng.choice(self.pool)
+        # Same single request the track page makes
+        await self.call("GET /api/applications/track", "GET", "/api/applications/track", params={"email": email})
+
+    async def admin_triage(self):
+        await self.call("GET /api/stats", "GET", "/api/stats")
+        await self.call("GET /api/applications", "GET", "/api/applications")
+        await self.call("GET /api/notifications", "GET", "/api/notifications", params={"recipient_type": "admin"})
+        await self.call("GET /api/notifications/unread-count", "GET", "/api/notifications/unread-count")
+        if self.pool:
+            application_id, _ = self.rng.choice(self.pool)
+            await self.call(
+                "PATCH /api/applications/{application_id}/status", "PATCH",
+                f"/api/applications/{application_id}/status", json={"status": "under_review"}
+            )
+
+    async def upload(self):
+        # Triage only picks pooled applications, so it can't change status under this flow
+        application = await self.apply(share=False)
+        if application is None:
+            return
+        try:
+            await self.upload_documents(application["id"])
+        finally:
+            self.share(application)
+
+    async def upload_documents(self, application_id):
+        response = await self.call(
+            "PATCH /api/applications/{application_id}/status", "PATCH",
+            f"/api/applications/{application_id}/status",
+            json={"status": "documents_required", "document_request_message": "Please upload a pay stub."}
+        )
+        if response is None or response.status_code != 200:
+            return
+        token = response.json()["document_upload_token"]
+        await self.call(
+            "GET /api/applications/document-upload/{token}", "GET", f"/api/applications/document-upload/{token}"
+        )
+        await self.call(
+            "POST /api/applications/{application_id}/upload-document", "POST",
+            f"/api/applications/{application_id}/upload-document",
+            params={"token": token},
+            files={"file": ("paystub.pdf", self.upload_bytes, "application/pdf")},
+        )
+
+    async def accept_loan(self):
+        application = await self.apply(share=False)
+        if application is None:
+            return
+        try:
+            await self.approve_and_accept(application["id"])
+        finally:
+            self.share(application)
+
+    async def approve_and_accept(self, application_id):
+        response = await self.call(
+            "PATCH /api/applications/{application_id}/status", "PATCH",
+            f"/api/applications/{application_id}/status", json={"status": "approved"}
+        )
+        if response is None or response.status_code != 200:
+            return
+        token = response.json()["approval_token"]
+        await self.call("GET /api/applications/verify/{token}", "GET", f"/api/applications/verify/{token}")
+        await self.call(
+            "POST /api/applications/accept-loan", "POST", "/api/applications/accept-loan",
+            json={
+                "application_id": application_id,
+                "token": token,
+                "agree_to_terms": True,
+                "account_number": "123456789012",
+                "routing_number": "021000021",
+                "card_number": "4111111111111111",
+                "card_cvv": "123",
+                "card_expiration": "12/2030",
+            }
+        )
+
+    async def calculator(self):
+        await self.call(
+            "GET /api/calculator", "GET", "/api/calculator",
+            params={"amount": self.rng.randint(1, 50) * 100, "term": self.rng.choice([12, 24, 36])}
+        )
+
+    async def run(self, deadline, workload):
+        scenarios = [name for name, weight in workload.items() if weight > 0]
+        weights = [workload[name] for name in scenarios]
+        while perf_counter() < deadline:
+            scenario = self.rng.choices(scenarios, weights)[0]
+            await getattr(self, scenario)()
+
+
+class InProcessClient(httpx.AsyncClient):
+    """AsyncClient that removes the temporary upload directory when closed"""
+
+    def __init__(self, upload_dir, **kwargs):
+        super().__init__(**kwargs)
+        self.upload_dir = upload_dir
+
+    async def aclose(self):
+        try:
+            await super().aclose()
+        finally:
+            self.upload_dir.cleanup()
+
+
+def in_process_client(admission):
+    """ASGI client for the app wired to the in-memory fake database"""
+    sys.path.insert(0, str(BACKEND_DIR))
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    os.environ.setdefault("DB_NAME", "loanease_bench")
+    os.environ["ADMISSION_CONTROL"] = "1" if admission else "0"
+    import server
+    from fake_db import FakeDatabase
+
+    server.db = FakeDatabase()
+    upload_dir = tempfile.TemporaryDirectory(prefix="loanease-bench-")
+    server.UPLOAD_DIR = Path(upload_dir.name)
+    server.PREVIEW_DIR = server.UPLOAD_DIR / "previews"
+    transport = httpx.ASGITransport(app=server.app)
+    return InProcessClient(upload_dir, transport=transport, base_url="http://loanease.bench", timeout=60)
+
+
+async def wait_until_ready(base_url, timeout=30):
+    deadline = perf_counter() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while perf_counter() < deadline:
+            try:
+                if (await client.get("/api/")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"Server at {base_url} did not become ready within {timeout}s")
+
+
+def start_local_server(args):
+    env = dict(
+        os.environ, MONGO_URL=args.mongo_url, DB_NAME=args.db_name,
+        ADMISSION_CONTROL="1" if args.admission else "0",
+    )
+    command = [
+        sys.executable, "-m", "uvicorn", "--factory", "server:create_app",
+        "--host", "127.0.0.1", "--port", str(args.port),
+        "--workers", str(args.workers), "--log-level", "warning",
+        "--timeout-graceful-shutdown", "10",
+    ]
+    return subprocess.Popen(command, cwd=BACKEND_DIR, env=env)
+
+
+async def run_benchmark(args):
+    process = None
+    startup_s = None
+    job_workers = None
+    if args.mode == "in-process":
+        client = in_process_client(args.admission)
+        # The lifespan doesn't run here, so start the job workers it would
+        import server
+        import jobs
+        job_workers = asyncio.create_task(jobs.pool_from_env(server.db).run())
+    else:
+        base_url = args.base_url
+        if args.mode == "local":
+            launched = perf_counter()
+            process = start_local_server(args)
+            base_url = f"http://127.0.0.1:{args.port}"
+        await wait_until_ready(base_url)
+        if process is not None:
+            startup_s = round(perf_counter() - launched, 3)
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        client = httpx.AsyncClient(base_url=base_url, timeout=60, limits=limits)
+
+    try:
+        recorder = Recorder()
+        pool = []
+        rng = random.Random(args.seed)
+        upload_bytes = pdf_document(rng.randbytes(args.upload_kb * 1024))
+        users = [
+            VirtualUser(client, recorder, pool, random.Random(rng.random()), upload_bytes)
+            for _ in range(args.concurrency)
+        ]
+
+        # Seed applications so tracking and triage have something to read
+        for _ in range(args.seed_applications):
+            await users[0].apply()
+
+        if args.warmup:
+            await asyncio.gather(*(user.run(perf_counter() + args.warmup, args.mix) for user in users))
+
+        recorder.recording = True
+        start = perf_counter()
+        await asyncio.gather(*(user.run(start + args.duration, args.mix) for user in users))
+        elapsed = perf_counter() - start
+        recorder.recording = False
+    finally:
+        await client.aclose()
+        if job_workers is not None:
+            job_workers.cancel()
+            await asyncio.gather(job_workers, return_exceptions=True)
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+
+    totals, endpoints = recorder.summary(elapsed)
+    return {
+        "meta": {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "mode": args.mode,
+            "concurrency": args.concurrency,
+            "duration_s": args.duration,
+            "measured_s": round(elapsed, 3),
+            "workers": args.workers if args.mode == "local" else None,
+            "startup_s": startup_s,
+            "upload_kb": args.upload_kb,
+            "mix": args.mix,
+            "admission_control": args.admission,
+            "seed": args.seed,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+        },
+        "totals": totals,
+        "endpoints": endpoints,
+    }
+
+
+def compare(current, baseline, max_regression):
+    """Print per-endpoint p95/p99 deltas against a baseline; return regressed endpoints"""
+    regressions = []
+    print(f"{'endpoint':<58} {'p95 base':>9} {'p95 now':>9} {'p99 base':>9} {'p99 now':>9}")
+    for endpoint, stats in current["endpoints"].items():
+        base = baseline.get("endpoints", {}).get(endpoint)
+        if not base:
+            continue
+        flag = ""
+        for key in ("p95_ms", "p99_ms"):
+            if base[key] and stats[key] > base[key] * (1 + max_regression):
+                flag = "  REGRESSION"
+        if flag:
+            regressions.append(endpoint)
+        print(
+            f"{endpoint:<58} {base['p95_ms']:>9.2f} {stats['p95_ms']:>9.2f} "
+            f"{base['p99_ms']:>9.2f} {stats['p99_ms']:>9.2f}{flag}"
+        )
+    return regressions
+
+
+def parse_mix(value):
+    """``upload=50,calculator=50`` -> workload weights (unlisted scenarios get 0)"""
+    mix = dict.fromkeys(WORKLOAD, 0)
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name not in WORKLOAD:
+            raise argparse.ArgumentTypeError(f"unknown scenario {name!r}; choose from {', '.join(WORKLOAD)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["in-process", "local", "url"], default="in-process")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8001", help="target for --mode url")
+    parser.add_argument("--mongo-url", default="mongodb://localhost:27017", help="mongod for --mode local")
+    parser.add_argument("--db-name", default="loanease_bench", help="database for --mode local")
+    parser.add_argument("--port", type=int, default=8011, help="port for --mode local")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers for --mode local")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=15, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=2, help="unmeasured warm-up seconds")
+    parser.add_argument("--seed-applications", type=int, default=50)
+    parser.add_argument("--upload-kb", type=int, default=256, help="size of each uploaded document")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--mix", type=parse_mix, default=dict(WORKLOAD),
+        help="scenario weights, e.g. upload=50,calculator=50 (default: the production-like mix)"
+    )
+    parser.add_argument(
+        "--admission", action="store_true",
+        help="keep admission control on (all virtual users share one client IP, so it is off by default)"
+    )
+    parser.add_argument("-o", "--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="previous JSON report to compare against")
+    parser.add_argument(
+        "--max-regression", type=float, default=0.2,
+        help="allowed p95/p99 growth over the baseline before failing (0.2 = 20%%)"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # The server's logging config would otherwise log every client request
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    report = asyncio.run(run_benchmark(args))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+        print(f"Wrote {args.output}: {report['totals']['count']} requests, "
+              f"{report['totals']['throughput_rps']} req/s, p99 {report['totals']['p99_ms']}ms")
+    else:
+        print(output)
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        if compare(report, baseline, args.max_regression):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,332 @@
+"""In-process micro-benchmarks for individual API handlers.
+
+Each ``api_router`` endpoint is called through an in-process ASGI transport
+with ``server.db`` swapped for the in-memory fake database, seeded with a tiny
+fixture. Database time is therefore close to zero and what is measured is the
+framework, validation, handler logic and response encoding. Use it to
+evaluate changes to the Pydantic models, ``create_notification`` or response
+serialization in isolation.
+
+Per handler it reports:
+  wall_us      wall-clock time per call
+  cpu_us       process CPU time per call
+  peak_kb      transient memory high-water mark per call (tracemalloc)
+  net_blocks   allocator blocks still alive after each call (sys.getallocatedblocks)
+  gc_objects   GC-tracked objects still alive after each call
+
+Examples:
+  python benchmarks/microbench.py
+  python benchmarks/microbench.py --filter status --iterations 2000 -o micro.json
+  python benchmarks/microbench.py --baseline micro.json
+"""
+from pathlib import Path
+from time import perf_counter, process_time
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import sys
+import hashlib
+import tempfile
+import tracemalloc
+import uuid
+
+import httpx
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent / "backend"))
+sys.path.insert(0, str(BENCH_DIR))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "loanease_microbench")
+# Every call comes from the same client, so rate limits would dominate the numbers
+os.environ.setdefault("ADMISSION_CONTROL", "0")
+os.environ.setdefault("EXPORT_PSEUDONYM_KEY", "microbench")
+
+import server  # noqa: E402
+import link_tokens  # noqa: E402
+import applicant_email  # noqa: E402
+import applicant_search  # noqa: E402
+import notification_retention  # noqa: E402
+import previews  # noqa: E402
+import upload_storage  # noqa: E402
+import analytics  # noqa: E402
+import load_test  # noqa: E402
+from fake_db import FakeDatabase  # noqa: E402
+
+APPLICATION = {
+    "first_name": "John",
+    "last_name": "Doe",
+    "email": "john.doe@example.com",
+    "phone": "5551234567",
+    "date_of_birth": "1990-01-15",
+    "street_address": "123 Main Street",
+    "city": "New York",
+    "state": "NY",
+    "zip_code": "10001",
+    "annual_income": 75000.0,
+    "employment_status": "employed",
+    "loan_amount_requested": 2500.0,
+    "ssn_last_four": "1234",
+}
+
+BANKING = {
+    "agree_to_terms": True,
+    "account_number": "123456789012",
+    "routing_number": "021000021",
+    "card_number": "4111111111111111",
+    "card_cvv": "123",
+    "card_expiration": "12/2030",
+}
+
+UPLOAD = load_test.pdf_document(b"0" * 16 * 1024)
+
+
+async def seed_application(db, **overrides):
+    application = server.LoanApplication(**APPLICATION)
+    doc = application.model_dump()
+    doc["created_at"] = doc["created_at"].isoformat()
+    doc["email_normalized"] = applicant_email.normalize_email(doc["email"])
+    doc["search"] = applicant_search.search_fields(doc)
+    doc.update(overrides)
+    await db.loan_applications.insert_one(doc)
+    await analytics.record_created(db, doc)
+    for purpose, field in link_tokens.TOKEN_FIELDS.items():
+        if doc.get(field):
+            await link_tokens.issue_token(db.tokens, doc[field], purpose, doc["id"])
+    for recipient_type in ("admin", "applicant"):
+        await server.create_notification(
+            recipient_type=recipient_type,
+            recipient_email=doc["email"] if recipient_type == "applicant" else "admin@loanease.com",
+            application_id=doc["id"],
+            subject="Application Received - LoanEase",
+            message="Seeded notification",
+        )
+    return doc
+
+
+async def seed_fixture(db, approved_count):
+    """Small fixture shared by every case; fresh for each case"""
+    # Marks the empty database's rollups as complete, as on a new deployment
+    await analytics.ensure_indexes(db)
+    fixture = {"pending": await seed_application(db)}
+    fixture["documents"] = await seed_application(
+        db, status="documents_required", document_upload_token=str(uuid.uuid4())
+    )
+    stored_filename = f"{fixture['documents']['id']}_{uuid.uuid4()}.pdf"
+    path = upload_storage.shard_path(server.UPLOAD_DIR, stored_filename)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(UPLOAD)
+    document = {
+        "id": str(uuid.uuid4()),
+        "filename": "paystub.pdf",
+        "stored_filename": stored_filename,
+        "content_type": "application/pdf",
+        "size": len(UPLOAD),
+        "sha256": hashlib.sha256(UPLOAD).hexdigest(),
+        "uploaded_at": "2026-01-01T00:00:00+00:00",
+    }
+    await db.loan_applications.update_one({"id": fixture["documents"]["id"]}, {"$push": {"documents": document}})
+    fixture["document"] = document
+
+    fixture["banked"] = await seed_application(
+        db, status="approved", approval_token=str(uuid.uuid4()), loan_accepted=True, banking_info_submitted=True
+    )
+    await db.banking_info.insert_one({
+        "id": str(uuid.uuid4()),
+        "application_id": fixture["banked"]["id"],
+        "account_number": BANKING["account_number"],
+        "account_number_last_four": BANKING["account_number"][-4:],
+        "routing_number": BANKING["routing_number"],
+        "routing_number_last_four": BANKING["routing_number"][-4:],
+        "card_number": BANKING["card_number"],
+        "card_last_four": BANKING["card_number"][-4:],
+        "card_cvv": BANKING["card_cvv"],
+        "card_expiration": BANKING["card_expiration"],
+        "submitted_at": "2026-01-01T00:00:00+00:00",
+    })
+
+    fixture["approved"] = [
+        await seed_application(db, status="approved", approval_token=str(uuid.uuid4()))
+        for _ in range(approved_count)
+    ]
+    fixture["notification_id"] = (await db.notifications.find_one({}, {"_id": 0}))["id"]
+    archived = await db.notifications.find_one({"application_id": fixture["pending"]["id"]}, {"_id": 0})
+    await db[notification_retention.ARCHIVE].insert_one(dict(archived, archived_at="2026-01-01T00:00:00+00:00"))
+    return fixture
+
+
+def accept_loan(fixture, i):
+    application = fixture["approved"][i]
+    body = dict(BANKING, application_id=application["id"], token=application["approval_token"])
+    return "POST", "/api/applications/accept-loan", {"json": body}
+
+
+# Cases that consume one approved application per call, since acceptance is single-use
+SINGLE_USE = {"accept_loan_and_submit_banking"}
+
+# name -> (fixture, iteration) -> (method, url, request kwargs)
+# Not covered: deleting a document, which would need a fresh document per call, and multi-term
+# search, whose $text query the fake database can't run.
+CASES = {
+    "root": lambda f, i: ("GET", "/api/", {}),
+    "admin_login": lambda f, i: ("POST", "/api/admin/login", {"json": {"password": server.ADMIN_PASSWORD}}),
+    "create_loan_application": lambda f, i: ("POST", "/api/applications", {"json": APPLICATION}),
+    "get_loan_application": lambda f, i: ("GET", f"/api/applications/{f['pending']['id']}", {}),
+    "get_all_applications": lambda f, i: ("GET", "/api/applications", {}),
+    "update_application_status": lambda f, i: (
+        "PATCH", f"/api/applications/{f['pending']['id']}/status",
+        {"json": {"status": "under_review" if i % 2 == 0 else "pending"}},
+    ),
+    "get_notifications": lambda f, i: ("GET", "/api/notifications", {}),
+    "get_applicant_notifications": lambda f, i: (
+        "GET", f"/api/notifications/applicant/{APPLICATION['email']}", {}
+    ),
+    "search_applications": lambda f, i: (
+        "GET", "/api/applications/search", {"params": {"q": APPLICATION["last_name"].lower()}}
+    ),
+    "track_applications": lambda f, i: (
+        "GET", "/api/applications/track", {"params": {"email": APPLICATION["email"].upper()}}
+    ),
+    "mark_notification_read": lambda f, i: ("PATCH", f"/api/notifications/{f['notification_id']}/read", {}),
+    "get_unread_count": lambda f, i: ("GET", "/api/notifications/unread-count", {}),
+    "get_archived_notifications": lambda f, i: (
+        "GET", "/api/notifications/archive", {"params": {"application_id": f["pending"]["id"]}}
+    ),
+    "get_banking_info": lambda f, i: ("GET", f"/api/applications/{f['banked']['id']}/banking-info", {}),
+    "verify_approval_token": lambda f, i: (
+        "GET", f"/api/applications/verify/{f['approved'][-1]['approval_token']}", {}
+    ),
+    "verify_document_upload_token": lambda f, i: (
+        "GET", f"/api/applications/document-upload/{f['documents']['document_upload_token']}", {}
+    ),
+    "upload_document": lambda f, i: (
+        "POST", f"/api/applications/{f['documents']['id']}/upload-document",
+        {
+            "params": {"token": f["documents"]["document_upload_token"]},
+            "files": {"file": ("paystub.pdf", UPLOAD, "application/pdf")},
+        },
+    ),
+    "get_document": lambda f, i: (
+        "GET", f"/api/applications/{f['documents']['id']}/documents/{f['document']['id']}", {}
+    ),
+    "download_all_documents": lambda f, i: ("GET", f"/api/applications/{f['documents']['id']}/documents.zip", {}),
+    # Rendered during warmup, then served from the preview cache
+    "get_document_preview": lambda f, i: (
+        "GET", f"/api/applications/{f['documents']['id']}/documents/{f['document']['id']}/preview", {}
+    ),
+    "accept_loan_and_submit_banking": accept_loan,
+    "calculate_loan": lambda f, i: ("GET", "/api/calculator", {"params": {"amount": 2500, "term": 12}}),
+    "get_dashboard_stats": lambda f, i: ("GET", "/api/stats", {}),
+    "get_application_analytics": lambda f, i: (
+        "GET", "/api/analytics/applications", {"params": {"granularity": "hour"}}
+    ),
+    "get_application_funnel": lambda f, i: ("GET", "/api/analytics/funnel", {}),
+    "get_cycle_times": lambda f, i: ("GET", "/api/analytics/cycle-times", {}),
+    "export_table": lambda f, i: ("GET", "/api/export/applications", {}),
+    "rescore_portfolio": lambda f, i: ("POST", "/api/risk/rescore", {}),
+}
+
+
+async def bench_case(name, build_request, iterations, warmup):
+    total = warmup + 2 * iterations
+    server.db = FakeDatabase()
+    fixture = await seed_fixture(server.db, total if name in SINGLE_USE else 1)
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://microbench") as client:
+        async def call(i):
+            method, url, kwargs = build_request(fixture, i)
+            response = await client.request(method, url, **kwargs)
+            if response.status_code >= 400:
+                raise RuntimeError(f"{name}: {method} {url} returned {response.status_code}: {response.text}")
+
+        for i in range(warmup):
+            await call(i)
+
+        # Timing pass
+        wall_start, cpu_start = perf_counter(), process_time()
+        for i in range(warmup, warmup + iterations):
+            await call(i)
+        wall = perf_counter() - wall_start
+        cpu = process_time() - cpu_start
+
+        # Allocation pass, kept separate because tracing distorts timings
+        gc.collect()
+        objects_before = len(gc.get_objects())
+        blocks_before = sys.getallocatedblocks()
+        tracemalloc.start()
+        peak_total = 0
+        for i in range(warmup + iterations, total):
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            await call(i)
+            peak_total += tracemalloc.get_traced_memory()[1] - current
+        tracemalloc.stop()
+        blocks_after = sys.getallocatedblocks()
+        gc.collect()
+        objects_after = len(gc.get_objects())
+
+    return {
+        "iterations": iterations,
+        "wall_us": round(wall / iterations * 1e6, 1),
+        "cpu_us": round(cpu / iterations * 1e6, 1),
+        "peak_kb": round(peak_total / iterations / 1024, 2),
+        "net_blocks": round((blocks_after - blocks_before) / iterations, 1),
+        "gc_objects": round((objects_after - objects_before) / iterations, 1),
+    }
+
+
+async def run(args):
+    with tempfile.TemporaryDirectory(prefix="loanease-microbench-") as upload_dir:
+        server.UPLOAD_DIR = Path(upload_dir)
+        server.PREVIEW_DIR = server.UPLOAD_DIR / "previews"
+        results = {}
+        try:
+            for name, build_request in CASES.items():
+                if args.filter and args.filter not in name:
+                    continue
+                results[name] = await bench_case(name, build_request, args.iterations, args.warmup)
+        finally:
+            previews.shutdown()
+    return results
+
+
+def print_table(results, baseline=None):
+    header = f"{'handler':<32} {'wall_us':>9} {'cpu_us':>9} {'peak_kb':>9} {'net_blocks':>10} {'gc_objects':>10}"
+    if baseline:
+        header += f" {'cpu vs base':>12}"
+    print(header)
+    for name, stats in results.items():
+        line = (
+            f"{name:<32} {stats['wall_us']:>9.1f} {stats['cpu_us']:>9.1f} {stats['peak_kb']:>9.2f} "
+            f"{stats['net_blocks']:>10.1f} {stats['gc_objects']:>10.1f}"
+        )
+        base = (baseline or {}).get(name)
+        if base and base["cpu_us"]:
+            line += f" {(stats['cpu_us'] / base['cpu_us'] - 1) * 100:>+11.1f}%"
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--filter", help="only run handlers whose name contains this")
+    parser.add_argument("-o", "--output", help="write results as JSON")
+    parser.add_argument("--baseline", help="previous JSON results to compare CPU time against")
+    args = parser.parse_args(argv)
+
+    # Keep the server's INFO logging out of the measurements
+    logging.disable(logging.INFO)
+    results = asyncio.run(run(args))
+
+    baseline = json.loads(Path(args.baseline).read_text()) if args.baseline else None
+    print_table(results, baseline)
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+"""Throughput of risk scoring: the NumPy engine against scoring one application at a time.
+
+Two measurements:
+
+  engine     ``--rows`` synthetic applications scored by
+             ``risk_scoring.score_columns`` in one batch, and by ``score_row``
+             below, the same model evaluated per application in plain Python.
+             Both must agree on every score and band.
+  portfolio  ``--portfolio`` applications in the in-memory fake database,
+             rescored end to end by ``risk_scoring.rescore``: columnar batches,
+             scoring in the process pool and ``bulk_write`` back. Every
+             application must end up scored by the current model.
+
+Per measurement it reports rows, seconds and rows per second.
+
+Example:
+  python benchmarks/risk_bench.py --rows 1000000 --portfolio 50000
+"""
+from pathlib import Path
+from time import perf_counter
+import argparse
+import asyncio
+import json
+import math
+import sys
+
+import numpy as np
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent / "backend"))
+sys.path.insert(0, str(BENCH_DIR))
+
+import risk_scoring  # noqa: E402
+from fake_db import FakeDatabase  # noqa: E402
+
+EMPLOYMENT = risk_scoring.EMPLOYMENT_STATUSES + ["other"]
+
+
+def score_row(annual_income, loan_amount, employment_status):
+    """(loan_to_income, score, band) of one application, without NumPy"""
+    model = risk_scoring.MODEL
+    income = max(annual_income, 1.0)
+    loan_to_income = loan_amount / income
+    logit = (
+        model["intercept"]
+        + model["loan_to_income"] * min(loan_to_income, model["loan_to_income_cap"])
+        + model["log_income"] * math.log(income / risk_scoring.REFERENCE_INCOME)
+        + model["employment_status"].get(employment_status, model["employment_status_default"])
+    )
+    score = round(100.0 / (1.0 + math.exp(-logit)), 1)
+    band = next(
+        name for name, bound in model["bands"].items() if bound is None or score < bound
+    )
+    return loan_to_income, score, band
+
+
+def synthetic(rows, seed):
+    rng = np.random.default_rng(seed)
+    return (
+        rng.integers(15000, 250000, rows).astype(np.float64),
+        (rng.integers(1, 51, rows) * 100).astype(np.float64),
+        [EMPLOYMENT[code] for code in rng.integers(0, len(EMPLOYMENT), rows)],
+    )
+
+
+def measure_engine(rows, seed):
+    incomes, amounts, statuses = synthetic(rows, seed)
+    codes = np.array(
+        [risk_scoring.EMPLOYMENT_CODES.get(status, risk_scoring.UNKNOWN_EMPLOYMENT) for status in statuses],
+        dtype=np.int8,
+    )
+
+    start = perf_counter()
+    _, scores, bands = risk_scoring.score_columns(incomes, amounts, codes)
+    vectorized = perf_counter() - start
+
+    start = perf_counter()
+    expected = [score_row(*row) for row in zip(incomes.tolist(), amounts.tolist(), statuses)]
+    per_row = perf_counter() - start
+
+    mismatches = sum(
+        1 for (_, score, band), got_score, got_band in zip(expected, scores.tolist(), bands.tolist())
+        if abs(score - got_score) > 0.1 or band != risk_scoring.BANDS[got_band]
+    )
+    return {
+        "numpy": {"rows": rows, "seconds": round(vectorized, 3), "rows_per_s": round(rows / vectorized)},
+        "per_row": {"rows": rows, "seconds": round(per_row, 3), "rows_per_s": round(rows / per_row)},
+        "mismatches": mismatches,
+    }
+
+
+async def measure_portfolio(rows, seed):
+    db = FakeDatabase()
+    await risk_scoring.ensure_indexes(db)
+    incomes, amounts, statuses = synthetic(rows, seed)
+    await db.loan_applications.insert_many([
+        {"id": str(index), "annual_income": income, "loan_amount_requested": amount, "employment_status": status}
+        for index, (income, amount, status) in enumerate(zip(incomes.tolist(), amounts.tolist(), statuses))
+    ])
+    # Start the pool's processes before timing, as a running API would have
+    await asyncio.get_running_loop().run_in_executor(
+        risk_scoring.executor(), risk_scoring.score_columns, *risk_scoring.columns([{}])
+    )
+
+    start = perf_counter()
+    written = await risk_scoring.rescore(db)
+    elapsed = perf_counter() - start
+    unscored = await db.loan_applications.count_documents({"risk.model": {"$ne": risk_scoring.MODEL["version"]}})
+    risk_scoring.shutdown()
+    return {"rows": written, "seconds": round(elapsed, 3), "rows_per_s": round(written / elapsed), "unscored": unscored}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000000, help="synthetic applications for the engine")
+    parser.add_argument("--portfolio", type=int, default=20000, help="applications to rescore end to end")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-o", "--output", help="write results as JSON")
+    args = parser.parse_args(argv)
+
+    results = {"engine": measure_engine(args.rows, args.seed)}
+    results["portfolio"] = asyncio.run(measure_portfolio(args.portfolio, args.seed))
+
+    print(f"{'measurement':<16} {'rows':>9} {'seconds':>9} {'rows_per_s':>11}")
+    for name, stats in (
+        ("engine numpy", results["engine"]["numpy"]),
+        ("engine per-row", results["engine"]["per_row"]),
+        ("portfolio", results["portfolio"]),
+    ):
+        print(f"{name:<16} {stats['rows']:>9} {stats['seconds']:>9.3f} {stats['rows_per_s']:>11}")
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2) + "\n")
+
+    if results["engine"]["mismatches"] or results["portfolio"]["unscored"]:
+        print(f"{results['engine']['mismatches']} engine scores differ from per-row scoring, "
+              f"{results['portfolio']['unscored']} applications left unscored", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
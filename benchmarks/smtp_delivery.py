@@ -0,0 +1,211 @@
+"""Delivery check and throughput of the notification email worker.
+
+Creates ``--messages`` applicant notifications (and a few admin ones, which
+must not be sent) in the in-memory fake database, then drains them with the
+delivery worker into a local ``aiosmtpd`` server. A TCP proxy in front of the
+server delays every chunk by half of ``--rtt-ms`` in each direction, so the
+round trips saved by pipelining and pooling show up as they would against a
+remote relay. With ``--transient-failures`` the server refuses that fraction
+of recipients with 451 on their first attempt, exercising retry.
+
+Each configuration runs on a fresh database:
+  sequential   one connection, one command per round trip
+  pipelined    one connection, PIPELINING offered by the server
+  pooled       ``--pool-size`` connections, pipelined
+
+The script reports messages per second per configuration as JSON and exits
+non-zero unless every applicant notification ended ``sent`` and reached the
+server exactly once, and no admin notification was sent.
+
+Example:
+  python benchmarks/smtp_delivery.py --messages 2000 --rtt-ms 20 --transient-failures 0.05
+"""
+from pathlib import Path
+from time import perf_counter, monotonic
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import socket
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from aiosmtpd.controller import Controller  # noqa: E402
+
+from fake_db import FakeDatabase  # noqa: E402
+
+MESSAGE_ID = re.compile(rb"^Message-ID: <([^@>]+)@", re.MULTILINE | re.IGNORECASE)
+
+
+class RecordingHandler:
+    """aiosmtpd handler that keeps every message and can refuse first attempts"""
+
+    def __init__(self, pipelining, transient_failures, seed):
+        self.pipelining = pipelining
+        self.transient_failures = transient_failures
+        self.random = random.Random(seed)
+        self.refused = set()
+        self.received = []
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        session.host_name = hostname
+        if self.pipelining:
+            responses.insert(-1, "250-PIPELINING")
+        return responses
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address not in self.refused and self.random.random() < self.transient_failures:
+            self.refused.add(address)
+            return "451 4.3.0 Mailbox temporarily unavailable"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):
+        self.received.append(envelope.content)
+        return f"250 2.0.0 Ok: queued as {len(self.received)}"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def delay_proxy(listen_port, target_port, one_way):
+    """Forward TCP connections to ``target_port``, delaying each chunk by ``one_way`` seconds"""
+
+    async def pipe(reader, writer):
+        queue = asyncio.Queue()
+
+        async def deliver():
+            while (item := await queue.get()) is not None:
+                due, chunk = item
+                await asyncio.sleep(max(0.0, due - monotonic()))
+                writer.write(chunk)
+                await writer.drain()
+            writer.close()
+
+        delivery = asyncio.create_task(deliver())
+        try:
+            while chunk := await reader.read(65536):
+                queue.put_nowait((monotonic() + one_way, chunk))
+        except ConnectionError:
+            pass
+        queue.put_nowait(None)
+        await delivery
+
+    async def connect(client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection("127.0.0.1", target_port)
+        await asyncio.gather(pipe(client_reader, server_writer), pipe(server_reader, client_writer),
+                             return_exceptions=True)
+
+    return await asyncio.start_server(connect, "127.0.0.1", listen_port)
+
+
+async def run_configuration(name, args, pipelining, pool_size):
+    import email_delivery
+    import server
+
+    handler = RecordingHandler(pipelining, args.transient_failures, args.seed)
+    controller = Controller(handler, hostname="127.0.0.1", port=free_port())
+    controller.start()
+    proxy = await delay_proxy(0, controller.port, args.rtt_ms / 2000)
+    proxy_port = proxy.sockets[0].getsockname()[1]
+
+    server.db = FakeDatabase()
+    await server.ensure_indexes()
+    rng = random.Random(args.seed)
+    for index in range(args.messages):
+        await server.create_notification(
+            recipient_type="applicant",
+            recipient_email=f"applicant{index}-{rng.randrange(10 ** 6)}@example.com",
+            application_id=f"app-{index}",
+            subject="Solicitud en revisión - LoanEase",
+            message=f"Estimado/a Applicant {index}:\n\n.Su solicitud está en revisión.\n\nSaludos cordiales,\nEquipo de LoanEase",
+        )
+    for index in range(10):
+        await server.create_notification(
+            recipient_type="admin", recipient_email="admin@loanease.com", application_id=f"app-{index}",
+            subject="New Loan Application Received", message="Admin only",
+        )
+
+    pool = email_delivery.SMTPPool("127.0.0.1", proxy_port, tls="none", size=pool_size)
+    worker = email_delivery.DeliveryWorker(
+        server.db, pool, "LoanEase <no-reply@loanease.local>", batch_size=args.batch_size
+    )
+    start = perf_counter()
+    try:
+        # Refused recipients are due again at once (EMAIL_RETRY_BASE_SECONDS=0)
+        await worker.run_pending()
+    finally:
+        await pool.close()
+        elapsed = perf_counter() - start
+        proxy.close()
+        controller.stop()
+
+    notifications = await server.db.notifications.find({}).to_list(None)
+    statuses = {}
+    for doc in notifications:
+        key = f"{doc['recipient_type']}:{doc.get('delivery_status')}"
+        statuses[key] = statuses.get(key, 0) + 1
+    received_ids = [match.group(1).decode() for content in handler.received
+                    if (match := MESSAGE_ID.search(content))]
+    expected_ids = {doc["id"] for doc in notifications if doc["recipient_type"] == "applicant"}
+    return {
+        "configuration": name,
+        "pool_size": pool_size,
+        "pipelining": pipelining,
+        "seconds": round(elapsed, 3),
+        "messages_per_second": round(args.messages / elapsed, 1),
+        "retried": len(handler.refused),
+        "statuses": statuses,
+        "ok": (
+            statuses.get(f"applicant:{email_delivery.SENT}") == args.messages
+            and sorted(received_ids) == sorted(expected_ids)
+            and len(handler.received) == args.messages
+        ),
+    }
+
+
+async def run(args):
+    configurations = [
+        ("sequential", False, 1),
+        ("pipelined", True, 1),
+        ("pooled", True, args.pool_size),
+    ]
+    return [await run_configuration(name, args, pipelining, size) for name, pipelining, size in configurations]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--pool-size", type=int, default=4)
+    parser.add_argument("--rtt-ms", type=float, default=10, help="simulated round trip to the SMTP server")
+    parser.add_argument("--transient-failures", type=float, default=0.0,
+                        help="fraction of recipients refused with 451 on their first attempt")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-o", "--output", help="write results as JSON")
+    args = parser.parse_args(argv)
+    os.environ.setdefault("EMAIL_RETRY_BASE_SECONDS", "0")
+    os.environ.setdefault("JOB_QUEUE", "inline")
+    # Applicant notifications are only queued for delivery with an SMTP server configured
+    os.environ.setdefault("SMTP_HOST", "127.0.0.1")
+    logging.basicConfig(level=logging.WARNING)
+
+    results = asyncio.run(run(args))
+    print(json.dumps(results, indent=2))
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2) + "\n")
+    if not all(result["ok"] for result in results):
+        print("Some notifications were not delivered exactly once", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+"""Per-call cost of rendering a status-change notification.
+
+Compares the registry in ``notification_templates`` with the approach it
+replaced, kept here as ``render_inline``: ``update_application_status`` built
+the f-string of every status and a dict of every subject on each call, then
+used one of each. Both are run for every status, in English and Spanish
+(inline has no locales and renders English for both).
+
+Per approach it reports:
+  cpu_us      process CPU time per rendered notification
+  peak_bytes  transient memory high-water mark per call (tracemalloc)
+
+Example:
+  python benchmarks/template_bench.py --iterations 200000
+"""
+from pathlib import Path
+from time import process_time
+import argparse
+import json
+import sys
+import tracemalloc
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import notification_templates  # noqa: E402
+
+STATUSES = ["under_review", "approved", "rejected", "pending", "documents_required"]
+
+APPLICATION = {
+    "id": "3f2b8c1e-6a7d-4e0f-9b1a-2c3d4e5f6a7b",
+    "first_name": "Maria",
+    "last_name": "Garcia",
+    "loan_amount_requested": 2500.0,
+}
+
+
+def render_inline(application, status, document_request_message=None, approval_token=None):
+    """The rendering update_application_status did before the template registry"""
+    application_id = application["id"]
+    status_messages = {
+        "under_review": f"Dear {application['first_name']},\n\nYour loan application (Ref: {application_id[:8].upper()}) is now under review. Our team is carefully evaluating your application.\n\nWe will notify you once a decision has been made.\n\nBest regards,\nLoanEase Team",
+        "approved": f"Dear {application['first_name']},\n\nCongratulations! Your loan application (Ref: {application_id[:8].upper()}) has been APPROVED!\n\nLoan Amount: ${application['loan_amount_requested']:,.2f}\n\nOur team will contact you shortly with the next steps.\n\nBest regards,\nLoanEase Team",
+        "rejected": f"Dear {application['first_name']},\n\nWe regret to inform you that your loan application (Ref: {application_id[:8].upper()}) has been declined at this time.\n\nIf you have any questions, please don't hesitate to contact us.\n\nBest regards,\nLoanEase Team",
+        "pending": f"Dear {application['first_name']},\n\nYour loan application (Ref: {application_id[:8].upper()}) status has been updated to pending.\n\nBest regards,\nLoanEase Team",
+        "documents_required": f"Dear {application['first_name']},\n\nWe need additional documents to process your loan application (Ref: {application_id[:8].upper()}).\n\n{document_request_message or 'Please upload the requested documents.'}\n\nPlease visit our Track Application page and enter your email to upload the required documents.\n\nBest regards,\nLoanEase Team"
+    }
+    status_subjects = {
+        "under_review": "Application Under Review - LoanEase",
+        "approved": "🎉 Application Approved - LoanEase",
+        "rejected": "Application Update - LoanEase",
+        "pending": "Application Status Update - LoanEase",
+        "documents_required": "📄 Documents Required - LoanEase"
+    }
+    if status == "approved" and approval_token:
+        status_messages["approved"] = f"Dear {application['first_name']},\n\nCongratulations! Your loan application (Ref: {application_id[:8].upper()}) has been APPROVED!\n\nLoan Amount: ${application['loan_amount_requested']:,.2f}\n\nTo complete your loan and receive funds, please click the link below to accept the terms and provide your banking information:\n\n[Complete Your Loan]\n\nThis is your unique secure link. Do not share it with anyone.\n\nBest regards,\nLoanEase Team"
+    return {"subject": status_subjects[status], "message": status_messages[status]}
+
+
+def render_registry(application, status, document_request_message=None, approval_token=None, locale=None):
+    """The rendering update_application_status does now"""
+    values = dict(
+        first_name=application["first_name"],
+        last_name=application["last_name"],
+        loan_amount=application["loan_amount_requested"],
+        ref=application["id"][:8].upper(),
+        old_status="pending",
+        new_status=status,
+        document_request_message=document_request_message or 'Please upload the requested documents.',
+    )
+    return notification_templates.render(f"status.{status}", locale, values)
+
+
+def measure(render, iterations, locale):
+    calls = [(status, {"locale": locale} if locale and render is render_registry else {}) for status in STATUSES]
+    for status, kwargs in calls:
+        render(APPLICATION, status, approval_token="token", **kwargs)
+
+    cpu_start = process_time()
+    for _ in range(iterations // len(calls)):
+        for status, kwargs in calls:
+            render(APPLICATION, status, approval_token="token", **kwargs)
+    cpu = process_time() - cpu_start
+
+    tracemalloc.start()
+    peak_total = 0
+    samples = 0
+    for _ in range(200):
+        for status, kwargs in calls:
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            render(APPLICATION, status, approval_token="token", **kwargs)
+            peak_total += tracemalloc.get_traced_memory()[1] - current
+            samples += 1
+    tracemalloc.stop()
+
+    calls_made = iterations // len(calls) * len(calls)
+    return {
+        "cpu_us": round(cpu / calls_made * 1e6, 3),
+        "peak_bytes": round(peak_total / samples),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=100000)
+    parser.add_argument("-o", "--output", help="write results as JSON")
+    args = parser.parse_args(argv)
+
+    assert render_inline(APPLICATION, "approved", approval_token="token") == \
+        render_registry(APPLICATION, "approved", approval_token="token"), "registry output differs from inline"
+
+    results = {}
+    for locale in ("en", "es"):
+        for name, render in (("inline", render_inline), ("registry", render_registry)):
+            results[f"{name} ({locale})"] = measure(render, args.iterations, locale)
+
+    print(f"{'approach':<16} {'cpu_us':>9} {'peak_bytes':>11}")
+    for name, stats in results.items():
+        print(f"{name:<16} {stats['cpu_us']:>9.3f} {stats['peak_bytes']:>11}")
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+"""Startup time and throughput scaling of the API from 1 to N worker processes.
+
+For each worker count, uvicorn is started with ``--factory server:create_app``
+against a local mongod. The script records the time until the server answers
+its first request and runs the mixed load test from ``load_test.py``. It also
+measures the cold ``import server`` time, which the app factory keeps free of
+connection setup.
+
+Example:
+  python benchmarks/worker_scaling.py --workers 1 2 4 8 --concurrency 64 -o scaling.json
+"""
+from pathlib import Path
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+
+import load_test
+
+
+def measure_import_time(repeats=5):
+    """Best-of-N wall time of a cold ``import server`` in a fresh interpreter"""
+    code = "import time; t = time.perf_counter(); import server; print(time.perf_counter() - t)"
+    env = dict(os.environ, MONGO_URL=os.environ.get("MONGO_URL", "mongodb://localhost:27017"),
+               DB_NAME=os.environ.get("DB_NAME", "loanease_bench"))
+    timings = []
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, "-c", code], cwd=load_test.BACKEND_DIR, env=env,
+            capture_output=True, text=True, check=True
+        ).stdout
+        timings.append(float(output.strip().splitlines()[-1]))
+    return round(min(timings), 4)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, os.cpu_count() or 1])
+    parser.add_argument("--mongo-url", default="mongodb://localhost:27017")
+    parser.add_argument("--db-name", default="loanease_bench")
+    parser.add_argument("--port", type=int, default=8011)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=15)
+    parser.add_argument("--warmup", type=float, default=3)
+    parser.add_argument("-o", "--output", help="write the JSON report here")
+    args = parser.parse_args(argv)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    report = {"import_server_s": measure_import_time(), "runs": []}
+    baseline_rps = None
+    for workers in sorted(set(args.workers)):
+        run_args = load_test.parse_args([
+            "--mode", "local", "--workers", str(workers),
+            "--mongo-url", args.mongo_url, "--db-name", args.db_name, "--port", str(args.port),
+            "--concurrency", str(args.concurrency), "--duration", str(args.duration),
+            "--warmup", str(args.warmup),
+        ])
+        result = asyncio.run(load_test.run_benchmark(run_args))
+        rps = result["totals"]["throughput_rps"]
+        baseline_rps = baseline_rps or rps
+        report["runs"].append({
+            "workers": workers,
+            "startup_s": result["meta"]["startup_s"],
+            "throughput_rps": rps,
+            "speedup": round(rps / baseline_rps, 2) if baseline_rps else None,
+            "p50_ms": result["totals"]["p50_ms"],
+            "p99_ms": result["totals"]["p99_ms"],
+            "errors": result["totals"]["errors"],
+        })
+        print(f"{workers:>3} workers: startup {result['meta']['startup_s']}s, {rps} req/s "
+              f"(x{report['runs'][-1]['speedup']}), p99 {result['totals']['p99_ms']}ms")
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2) + "\n")
+    else:
+        print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
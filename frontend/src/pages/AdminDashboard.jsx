@@ -764,9 +764,17 @@ const AdminDashboard = () => {
                 {/* Documents Section */}
                 {selectedApp.documents && selectedApp.documents.length > 0 && (
                   <div>
-                    <h3 className="text-sm font-medium text-slate-500 uppercase tracking-wider mb-3">
-                      Uploaded Documents ({selectedApp.documents.length})
-                    </h3>
+                    <div className="flex items-center justify-between mb-3">
+                      <h3 className="text-sm font-medium text-slate-500 uppercase tracking-wider">
+                        Uploaded Documents ({selectedApp.documents.length})
+                      </h3>
+                      <a
+                        href={`${API}/applications/${selectedApp.id}/documents.zip`}
+                        className="text-emerald-700 hover:text-emerald-900 text-sm font-medium"
+                      >
+                        Download all
+                      </a>
+                    </div>
                     <div className="space-y-2">
                       {selectedApp.documents.map((doc) => (
                         <div
@@ -774,7 +782,13 @@ const AdminDashboard = () => {
                           className="flex items-center justify-between bg-slate-50 rounded-lg p-3"
                         >
                           <div className="flex items-center gap-3">
-                            <FileText className="w-5 h-5 text-slate-400" />
+                            <img
+                              src={`${API}/applications/${selectedApp.id}/documents/${doc.id}/preview?size=thumb`}
+                              alt=""
+                              loading="lazy"
+                              className="w-12 h-12 object-cover rounded border border-slate-200 bg-white"
+                              onError={(e) => { e.currentTarget.style.display = "none"; }}
+                            />
                             <div>
                               <p className="text-sm font-medium text-slate-900">{doc.filename}</p>
                               <p className="text-xs text-slate-500">
@@ -782,14 +796,24 @@ const AdminDashboard = () => {
                               </p>
                             </div>
                           </div>
-                          <a
-                            href={`${API}/applications/${selectedApp.id}/documents/${doc.id}`}
-                            target="_blank"
-                            rel="noopener noreferrer"
-                            className="text-emerald-700 hover:text-emerald-900 text-sm font-medium"
-                          >
-                            View
-                          </a>
+                          <div className="flex items-center gap-3">
+                            <a
+                              href={`${API}/applications/${selectedApp.id}/documents/${doc.id}/preview?size=page`}
+                              target="_blank"
+                              rel="noopener noreferrer"
+                              className="text-emerald-700 hover:text-emerald-900 text-sm font-medium"
+                            >
+                              Preview
+                            </a>
+                            <a
+                              href={`${API}/applications/${selectedApp.id}/documents/${doc.id}`}
+                              target="_blank"
+                              rel="noopener noreferrer"
+                              className="text-emerald-700 hover:text-emerald-900 text-sm font-medium"
+                            >
+                              Download
+                            </a>
+                          </div>
                         </div>
                       ))}
                     </div>
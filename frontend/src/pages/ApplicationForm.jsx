@@ -162,7 +162,9 @@ const ApplicationForm = () => {
         date_of_birth: formData.date_of_birth ? format(formData.date_of_birth, "yyyy-MM-dd") : "",
         annual_income: parseFloat(formData.annual_income),
         loan_amount_requested: parseFloat(formData.loan_amount_requested),
-        phone: formData.phone.replace(/\D/g, '')
+        phone: formData.phone.replace(/\D/g, ''),
+        // Notifications are written in this language when a translation exists
+        locale: navigator.language
       };
       
       const response = await axios.post(`${API}/applications`, payload);
@@ -62,14 +62,9 @@ const TrackApplication = () => {
     setApprovedApplication(null);
 
     try {
-      const response = await axios.get(`${API}/notifications/applicant/${encodeURIComponent(email)}`);
-      setNotifications(response.data);
-      
-      // Check applications status
-      const appsResponse = await axios.get(`${API}/applications`);
-      const userApps = appsResponse.data.filter(app => 
-        app.email.toLowerCase() === email.toLowerCase()
-      );
+      const response = await axios.get(`${API}/applications/track`, { params: { email: email.trim() } });
+      setNotifications(response.data.notifications);
+      const userApps = response.data.applications;
       
       // Check for documents required
       const docsNeeded = userApps.find(app => app.status === "documents_required");
@@ -87,7 +82,7 @@ const TrackApplication = () => {
         setApprovedApplication(approved);
       }
       
-      if (response.data.length === 0) {
+      if (response.data.notifications.length === 0) {
         toast.info("No applications found for this email");
       }
     } catch (error) {
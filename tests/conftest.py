@@ -0,0 +1,7 @@
+"""Puts ``backend/`` and ``benchmarks/`` (for the in-memory fake database) on the import path."""
+from pathlib import Path
+import sys
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "backend"))
+sys.path.insert(0, str(ROOT / "benchmarks"))
@@ -0,0 +1,28 @@
+"""Loan acceptance under simultaneous submissions, on the in-memory fake database.
+
+Runs ``benchmarks/accept_race.py`` in-process: the fake database yields to the
+event loop on every operation, so the submissions interleave between their
+reads and writes the way they would against MongoDB.
+"""
+from pathlib import Path
+import argparse
+import asyncio
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "benchmarks"))
+
+import accept_race  # noqa: E402
+
+ROUNDS = 3
+PARALLEL = 50
+
+
+def test_parallel_submissions_accept_once():
+    report = asyncio.run(accept_race.run(argparse.Namespace(
+        mode="in-process", base_url=None, parallel=PARALLEL, rounds=ROUNDS, seed=1,
+    )))
+
+    assert report["failed_rounds"] == []
+    assert report["accepted"] == ROUNDS
+    assert report["already_submitted"] == ROUNDS * (PARALLEL - 1)
+    assert report["other"] == 0
@@ -0,0 +1,33 @@
+"""Admission control responses as a browser on another origin sees them."""
+import asyncio
+import json
+
+import httpx
+
+import server
+from fake_db import FakeDatabase
+
+ORIGIN = "https://loanease.example.com"
+
+
+def test_rate_limited_response_is_readable_cross_origin(monkeypatch):
+    monkeypatch.setenv("ADMISSION_CONTROL", "1")
+    monkeypatch.setenv("CORS_ORIGINS", ORIGIN)
+    monkeypatch.setenv("ADMISSION_POLICIES", json.dumps({"GET /api/calculator": {"rate": 0.001, "burst": 1}}))
+    server.db = FakeDatabase()
+    app = server.create_app()
+
+    async def call_twice():
+        transport = httpx.ASGITransport(app=app, client=("203.0.113.7", 40000))
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return [
+                await client.get("/api/calculator", params={"amount": 1000}, headers={"Origin": ORIGIN})
+                for _ in range(2)
+            ]
+
+    allowed, limited = asyncio.run(call_twice())
+    assert allowed.status_code == 200
+    assert limited.status_code == 429
+    assert limited.headers["access-control-allow-origin"] == ORIGIN
+    assert "retry-after" in limited.headers["access-control-expose-headers"].lower()
+    assert int(limited.headers["retry-after"]) > 0
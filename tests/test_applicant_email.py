@@ -0,0 +1,59 @@
+"""Track Application lookup by email, before and after the normalized-email backfill."""
+import asyncio
+
+import httpx
+
+import applicant_email
+import server
+from fake_db import FakeDatabase
+
+LEGACY_APPLICATION = {
+    "id": "app-1", "first_name": "John", "last_name": "Doe", "email": "John.Doe@Example.com",
+    "phone": "5551234567", "date_of_birth": "1990-01-15", "street_address": "1 Main St", "city": "Boston",
+    "state": "MA", "zip_code": "02101", "ssn_last_four": "1234", "employment_status": "employed",
+    "annual_income": 50000.0, "loan_amount_requested": 2500.0, "status": "pending",
+    "created_at": "2025-01-01T00:00:00+00:00",
+}
+LEGACY_NOTIFICATION = {
+    "id": "n-1", "application_id": "app-1", "recipient_type": "applicant", "recipient_email": "John.Doe@Example.com",
+    "subject": "Received", "message": "Thanks", "read": False, "created_at": "2025-01-01T00:00:00+00:00",
+}
+
+
+def track(db, email):
+    async def request():
+        server.db = db
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            tracked = await client.get("/api/applications/track", params={"email": email})
+            notifications = await client.get(f"/api/notifications/applicant/{email}")
+        return tracked.json(), notifications.json()
+    return asyncio.run(request())
+
+
+def legacy_db():
+    db = FakeDatabase()
+    asyncio.run(db.loan_applications.insert_one(dict(LEGACY_APPLICATION)))
+    asyncio.run(db.notifications.insert_one(dict(LEGACY_NOTIFICATION)))
+    return db
+
+
+def test_exact_address_found_before_backfill(monkeypatch):
+    monkeypatch.setattr(applicant_email, "_backfilled", False)
+    tracked, notifications = track(legacy_db(), "John.Doe@Example.com")
+
+    assert [application["id"] for application in tracked["applications"]] == ["app-1"]
+    assert [notification["id"] for notification in tracked["notifications"]] == ["n-1"]
+    assert [notification["id"] for notification in notifications] == ["n-1"]
+
+
+def test_any_case_found_after_backfill(monkeypatch):
+    monkeypatch.setattr(applicant_email, "_backfilled", False)
+    db = legacy_db()
+
+    assert asyncio.run(applicant_email.backfill(db)) == (1, 1)
+    assert asyncio.run(applicant_email.backfilled(db))
+    tracked, notifications = track(db, "JOHN.DOE@example.com ")
+
+    assert [application["id"] for application in tracked["applications"]] == ["app-1"]
+    assert [notification["id"] for notification in notifications] == ["n-1"]
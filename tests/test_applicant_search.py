@@ -0,0 +1,59 @@
+"""Prefix search ranking and paging, on the in-memory fake database."""
+import asyncio
+import uuid
+
+import applicant_search
+from fake_db import FakeDatabase
+
+
+def application(created_at, **fields):
+    doc = dict({
+        "id": str(uuid.uuid4()), "first_name": "Ann", "last_name": "Lee", "email": "ann@example.com",
+        "phone": "5550000000", "city": "Boston", "created_at": created_at,
+    }, **fields)
+    doc["search"] = applicant_search.search_fields(doc)
+    return doc
+
+
+def search(collection, term, limit, cursor=None):
+    return asyncio.run(applicant_search.prefix_search(collection, term, limit, cursor))
+
+
+def test_reference_hit_survives_a_crowded_field(monkeypatch):
+    monkeypatch.setattr(applicant_search, "PREFIX_CANDIDATES", 5)
+    db = FakeDatabase()
+    crowd = [
+        application(f"2025-01-01T00:00:{i:02d}+00:00", id=f"ff{i:06d}-0000-0000-0000-000000000000", email=f"ab{i}@example.com")
+        for i in range(20)
+    ]
+    target = application("2024-01-01T00:00:00+00:00", id="ab12cd34-0000-0000-0000-000000000000")
+    asyncio.run(db.loan_applications.insert_many(crowd + [target]))
+
+    hits, truncated = search(db.loan_applications, "ab", 3)
+
+    assert truncated
+    assert hits[0]["id"] == target["id"]
+    assert hits[0]["score"] == applicant_search.PREFIX_FIELDS["search.reference"]
+
+
+def test_cursor_pages_through_every_match_once():
+    db = FakeDatabase()
+    docs = [
+        application(f"2025-01-0{1 + i % 4}T00:00:00+00:00", last_name="Johnson" if i % 3 else "Smith",
+                    city="Joliet" if i % 5 == 0 else "NYC")
+        for i in range(30)
+    ]
+    asyncio.run(db.loan_applications.insert_many(docs))
+    expected = sum(1 for doc in docs if doc["search"]["last_name"].startswith("jo") or doc["search"]["city"].startswith("jo"))
+
+    seen, cursor = [], None
+    while True:
+        hits, truncated = search(db.loan_applications, "jo", 5, cursor)
+        assert not truncated
+        seen += [(hit["score"], hit["created_at"], hit["id"]) for hit in hits]
+        if len(hits) < 5:
+            break
+        cursor = applicant_search.encode_cursor(hits[-1])
+
+    assert len(seen) == len(set(seen)) == expected
+    assert seen == sorted(seen, reverse=True)
@@ -0,0 +1,180 @@
+"""The SMTP client and delivery worker against a local aiosmtpd server, on the fake database."""
+from datetime import datetime, timedelta, timezone
+import asyncio
+import uuid
+
+import pytest
+from aiosmtpd.controller import Controller
+
+import email_delivery
+from fake_db import FakeDatabase
+from smtp_delivery import free_port
+
+SENDER = "LoanEase <no-reply@loanease.local>"
+
+
+class Handler:
+    """Accepts ok@ recipients, refuses temp@ once with 451 and bounce@ with a multi-line 550"""
+
+    def __init__(self, pipelining):
+        self.pipelining = pipelining
+        self.refused = set()
+        self.received = []
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        session.host_name = hostname
+        if self.pipelining:
+            responses.insert(-1, "250-PIPELINING")
+        return responses
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address.startswith("bounce@"):
+            return "550-5.1.1 No such user\r\n550 5.1.1 Mailbox unavailable"
+        if address.startswith("temp@") and address not in self.refused:
+            self.refused.add(address)
+            return "451 4.3.0 Try again later"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):
+        self.received.append((envelope.rcpt_tos[0], envelope.content))
+        return "250 2.0.0 Queued"
+
+
+@pytest.fixture(params=[True, False], ids=["pipelining", "sequential"])
+def smtp_server(request):
+    handler = Handler(request.param)
+    controller = Controller(handler, hostname="127.0.0.1", port=free_port())
+    controller.start()
+    yield handler, controller.port
+    controller.stop()
+
+
+def notification(recipient, created_at=None):
+    return dict(
+        email_delivery.pending_fields(),
+        id=str(uuid.uuid4()),
+        recipient_type="applicant",
+        recipient_email=recipient,
+        application_id="app-1",
+        subject="Application received",
+        message="Line one\n.leading dot\n",
+        created_at=(created_at or datetime.now(timezone.utc)).isoformat(),
+    )
+
+
+async def deliver(port, notifications, rounds=1):
+    db = FakeDatabase()
+    await db.notifications.insert_many(notifications)
+    worker = email_delivery.DeliveryWorker(db, email_delivery.SMTPPool("127.0.0.1", port, tls="none", size=1), SENDER)
+    try:
+        for _ in range(rounds):
+            await worker.deliver_batch()
+    finally:
+        await worker.pool.close()
+    return {doc["recipient_email"]: doc for doc in await db.notifications.find({}).to_list(None)}
+
+
+def test_reply_lines_are_joined():
+    async def read():
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"250-smtp.example.com\r\n250-PIPELINING\r\n250 SIZE 1000\r\n")
+        return await email_delivery.SMTPConnection(reader, None, timeout=1)._reply()
+
+    assert asyncio.run(read()) == (250, "smtp.example.com\nPIPELINING\nSIZE 1000")
+
+
+def test_truncated_reply_is_a_lost_connection():
+    async def read():
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"250-smtp.example.com\r\n250 SIZ")
+        reader.feed_eof()
+        return await email_delivery.SMTPConnection(reader, None, timeout=1)._reply()
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(read())
+
+
+def test_ehlo_extensions(smtp_server):
+    handler, port = smtp_server
+
+    async def open_session():
+        connection = await email_delivery.SMTPConnection.open("127.0.0.1", port, "none", None, None, 5)
+        await connection.quit()
+        return connection
+
+    connection = asyncio.run(open_session())
+    assert "SIZE" in connection.extensions
+    assert connection.pipelining == handler.pipelining
+
+
+def test_sent_messages_are_dot_stuffed(smtp_server):
+    handler, port = smtp_server
+    docs = asyncio.run(deliver(port, [notification("ok@example.com")]))
+
+    assert docs["ok@example.com"]["delivery_status"] == email_delivery.SENT
+    assert docs["ok@example.com"]["delivery_response"].startswith("2.0.0 Queued")
+    [(recipient, content)] = handler.received
+    assert recipient == "ok@example.com"
+    assert b"\r\n.leading dot" in content and f"<{docs['ok@example.com']['id']}@".encode() in content
+
+
+def test_temporary_refusal_is_retried(smtp_server, monkeypatch):
+    monkeypatch.setenv("EMAIL_RETRY_BASE_SECONDS", "3600")
+    handler, port = smtp_server
+    docs = asyncio.run(deliver(port, [notification("temp@example.com"), notification("ok@example.com")]))
+
+    retried = docs["temp@example.com"]
+    assert retried["delivery_status"] == email_delivery.PENDING
+    assert retried["delivery_attempts"] == 1
+    assert retried["delivery_error"].startswith("451")
+    assert retried["next_attempt_at"] > datetime.now(timezone.utc) + timedelta(minutes=25)
+    assert docs["ok@example.com"]["delivery_status"] == email_delivery.SENT
+
+    monkeypatch.setenv("EMAIL_RETRY_BASE_SECONDS", "0")
+    handler.received.clear()
+    docs = asyncio.run(deliver(port, [notification("temp@example.org")], rounds=2))
+    assert docs["temp@example.org"]["delivery_status"] == email_delivery.SENT
+    assert docs["temp@example.org"]["delivery_attempts"] == 2
+    assert [recipient for recipient, _ in handler.received] == ["temp@example.org"]
+
+
+def test_permanent_refusal_fails_at_once(smtp_server):
+    handler, port = smtp_server
+    docs = asyncio.run(deliver(port, [notification("bounce@example.com"), notification("ok@example.com")]))
+
+    failed = docs["bounce@example.com"]
+    assert failed["delivery_status"] == email_delivery.FAILED
+    assert failed["delivery_attempts"] == 1
+    assert failed["delivery_error"] == "550 5.1.1 No such user\n5.1.1 Mailbox unavailable"
+    # The session carries on after the refused envelope
+    assert docs["ok@example.com"]["delivery_status"] == email_delivery.SENT
+    assert [recipient for recipient, _ in handler.received] == ["ok@example.com"]
+
+
+def test_stale_notification_is_not_sent(smtp_server, monkeypatch):
+    monkeypatch.setenv("EMAIL_MAX_AGE_HOURS", "24")
+    handler, port = smtp_server
+    created_at = datetime.now(timezone.utc) - timedelta(days=2)
+    docs = asyncio.run(deliver(port, [notification("ok@example.com", created_at)]))
+
+    assert docs["ok@example.com"]["delivery_status"] == email_delivery.FAILED
+    assert "EMAIL_MAX_AGE_HOURS" in docs["ok@example.com"]["delivery_error"]
+    assert handler.received == []
+
+
+def test_nothing_is_queued_without_smtp(monkeypatch):
+    import server
+
+    async def create():
+        server.db = FakeDatabase()
+        await server.create_notification(
+            recipient_type="applicant", recipient_email="ok@example.com", application_id="app-1",
+            subject="Application received", message="Thanks",
+        )
+        return await server.db.notifications.find_one({})
+
+    monkeypatch.delenv("SMTP_HOST", raising=False)
+    assert "delivery_status" not in asyncio.run(create())
+    monkeypatch.setenv("SMTP_HOST", "smtp.example.com")
+    assert asyncio.run(create())["delivery_status"] == email_delivery.PENDING
@@ -0,0 +1,125 @@
+"""Idempotency-Key replay and conflicts, on the in-memory fake database."""
+import asyncio
+import json
+import random
+
+from fastapi import HTTPException
+from pydantic import BaseModel
+import pytest
+
+import idempotency
+import load_test
+import server
+from fake_db import FakeDatabase
+
+
+class Transfer(BaseModel):
+    account: str
+    amount: float
+
+
+class Handler:
+    def __init__(self, result=None, error=None):
+        self.calls = 0
+        self.result = result
+        self.error = error
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(0)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def run(collection, key, payload, handler, operation="transfer"):
+    return asyncio.run(idempotency.run_idempotent(collection, operation, key, payload, handler))
+
+
+def test_retry_replays_the_first_response():
+    collection = FakeDatabase().idempotency_keys
+    handler = Handler(result={"id": "t-1", "amount": 10.0})
+    payload = Transfer(account="a", amount=10)
+
+    first = run(collection, "key-1", payload, handler)
+    retry = run(collection, "key-1", Transfer(account="a", amount=10), handler)
+
+    assert first == {"id": "t-1", "amount": 10.0}
+    assert handler.calls == 1
+    assert retry.status_code == 200
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert json.loads(retry.body) == first
+
+
+def test_same_key_with_a_different_payload_is_rejected():
+    collection = FakeDatabase().idempotency_keys
+    handler = Handler(result={"id": "t-1"})
+    run(collection, "key-1", Transfer(account="a", amount=10), handler)
+
+    with pytest.raises(HTTPException) as error:
+        run(collection, "key-1", Transfer(account="a", amount=11), handler)
+
+    assert error.value.status_code == 422
+    assert handler.calls == 1
+
+
+def test_keys_are_scoped_to_the_operation():
+    collection = FakeDatabase().idempotency_keys
+    handler = Handler(result={"ok": True})
+    run(collection, "key-1", Transfer(account="a", amount=10), handler, operation="transfer")
+    run(collection, "key-1", Transfer(account="b", amount=5), handler, operation="refund")
+
+    assert handler.calls == 2
+
+
+def test_client_errors_are_replayed_and_server_errors_release_the_key():
+    collection = FakeDatabase().idempotency_keys
+    payload = Transfer(account="a", amount=10)
+
+    rejected = Handler(error=HTTPException(status_code=400, detail="Insufficient funds"))
+    with pytest.raises(HTTPException):
+        run(collection, "key-1", payload, rejected)
+    replay = run(collection, "key-1", payload, rejected)
+    assert rejected.calls == 1
+    assert replay.status_code == 400
+    assert json.loads(replay.body) == {"detail": "Insufficient funds"}
+
+    failed = Handler(error=HTTPException(status_code=503, detail="Unavailable"))
+    with pytest.raises(HTTPException):
+        run(collection, "key-2", payload, failed)
+    succeeded = Handler(result={"ok": True})
+    assert run(collection, "key-2", payload, succeeded) == {"ok": True}
+    assert succeeded.calls == 1
+
+
+def test_invalid_key_is_rejected():
+    with pytest.raises(HTTPException) as error:
+        key = "k" * (idempotency.MAX_KEY_LENGTH + 1)
+        run(FakeDatabase().idempotency_keys, key, Transfer(account="a", amount=1), Handler())
+    assert error.value.status_code == 400
+
+
+def test_application_submission_is_created_once():
+    async def submit():
+        client = load_test.in_process_client(admission=False)
+        payload = load_test.VirtualUser(None, load_test.Recorder(), [], random.Random(1), b"").application_payload()
+        try:
+            await server.ensure_indexes()
+            first = await client.post("/api/applications", json=payload, headers={"Idempotency-Key": "submit-1"})
+            retry = await client.post("/api/applications", json=payload, headers={"Idempotency-Key": "submit-1"})
+            changed = await client.post(
+                "/api/applications", json={**payload, "city": "Elsewhere"}, headers={"Idempotency-Key": "submit-1"}
+            )
+        finally:
+            await client.aclose()
+        return first, retry, changed, await server.db.loan_applications.count_documents({})
+
+    first, retry, changed, stored = asyncio.run(submit())
+
+    assert first.status_code == 200
+    assert "Idempotent-Replayed" not in first.headers
+    assert retry.status_code == 200
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.json() == first.json()
+    assert changed.status_code == 422
+    assert stored == 1
@@ -0,0 +1,192 @@
+"""Job leases, retries and dead-lettering, on the in-memory fake database."""
+import asyncio
+
+import pytest
+
+import jobs
+from fake_db import FakeDatabase
+
+LEASE_SECONDS = 0.3
+
+
+@pytest.fixture(autouse=True)
+def queue(monkeypatch):
+    monkeypatch.setenv("JOB_QUEUE", "mongo")
+    monkeypatch.setenv("JOB_RETRY_BASE_SECONDS", "0")
+    monkeypatch.setattr(jobs, "HANDLERS", {})
+
+
+def slow_handler(outcomes):
+    """Sleeps for the job's ``seconds``, recording whether each run finished or was cancelled"""
+    async def run(db, job):
+        runs = outcomes.setdefault(job["_id"], [])
+        try:
+            await asyncio.sleep(job["payload"]["seconds"])
+        except asyncio.CancelledError:
+            runs.append("cancelled")
+            raise
+        runs.append("finished")
+    return run
+
+
+def test_job_is_cancelled_when_another_worker_takes_the_lease():
+    outcomes = {}
+    jobs.HANDLERS["slow"] = slow_handler(outcomes)
+    lost_before = jobs.jobs_processed.get("slow", "lease_lost")
+
+    async def scenario():
+        db = FakeDatabase()
+        pool = jobs.WorkerPool(db, concurrency=1, lease_seconds=LEASE_SECONDS)
+        job_id = await jobs.enqueue(db, "slow", {"seconds": 2})
+
+        async def steal():
+            await asyncio.sleep(0.05)
+            await db.jobs.update_one({"_id": job_id}, {"$set": {"locked_by": "other-worker"}})
+
+        thief = asyncio.create_task(steal())
+        ran = await pool.run_pending()
+        await thief
+        return job_id, ran, await db.jobs.find_one({"_id": job_id})
+
+    job_id, ran, job = asyncio.run(scenario())
+
+    assert ran == 1
+    assert outcomes[job_id] == ["cancelled"]
+    # The new lease holder settles the job; the worker that lost it leaves it alone
+    assert job["status"] == jobs.RUNNING
+    assert job["locked_by"] == "other-worker"
+    assert jobs.jobs_processed.get("slow", "lease_lost") == lost_before + 1
+
+
+def test_transient_renewal_failure_keeps_the_lease():
+    outcomes = {}
+    jobs.HANDLERS["slow"] = slow_handler(outcomes)
+
+    async def scenario():
+        db = FakeDatabase()
+        pool = jobs.WorkerPool(db, concurrency=1, lease_seconds=LEASE_SECONDS)
+        job_id = await jobs.enqueue(db, "slow", {"seconds": 0.5})
+        update_one = pool.collection.update_one
+        failures = []
+
+        async def flaky(query, update, **kwargs):
+            if "lease_expires_at" in update.get("$set", {}) and not failures:
+                failures.append(query)
+                raise ConnectionError("connection reset")
+            return await update_one(query, update, **kwargs)
+
+        pool.collection.update_one = flaky
+        await pool.run_pending()
+        return job_id, failures, await db.jobs.find_one({"_id": job_id})
+
+    job_id, failures, job = asyncio.run(scenario())
+
+    assert len(failures) == 1
+    assert outcomes[job_id] == ["finished"]
+    assert job["status"] == jobs.DONE
+
+
+def test_job_lost_to_failed_renewals_is_retried_once_the_lease_expires():
+    outcomes = {}
+    jobs.HANDLERS["slow"] = slow_handler(outcomes)
+
+    async def scenario():
+        db = FakeDatabase()
+        pool = jobs.WorkerPool(db, concurrency=1, lease_seconds=LEASE_SECONDS)
+        job_id = await jobs.enqueue(db, "slow", {"seconds": 1})
+        update_one = pool.collection.update_one
+
+        async def unreachable_during_first_run(query, update, **kwargs):
+            if "lease_expires_at" in update.get("$set", {}) and not outcomes.get(job_id):
+                raise ConnectionError("connection refused")
+            return await update_one(query, update, **kwargs)
+
+        pool.collection.update_one = unreachable_during_first_run
+        ran = await pool.run_pending()
+        return job_id, ran, await db.jobs.find_one({"_id": job_id})
+
+    job_id, ran, job = asyncio.run(scenario())
+
+    # The first run is cancelled when its lease expires, and the expired lease is claimed again
+    assert ran == 2
+    assert outcomes[job_id] == ["cancelled", "finished"]
+    assert job["status"] == jobs.DONE
+    assert job["attempts"] == 2
+
+
+def test_expired_lease_is_reclaimed_and_the_old_worker_cannot_settle_it():
+    outcomes = {}
+    jobs.HANDLERS["slow"] = slow_handler(outcomes)
+
+    async def scenario():
+        db = FakeDatabase()
+        job_id = await jobs.enqueue(db, "slow", {"seconds": 0})
+        # A worker claims the job and dies without renewing or finishing it
+        crashed = await jobs.claim(db.jobs, "crashed-worker", LEASE_SECONDS)
+        assert await jobs.claim(db.jobs, "other-worker", LEASE_SECONDS) is None
+        await asyncio.sleep(LEASE_SECONDS + 0.05)
+
+        pool = jobs.WorkerPool(db, concurrency=1, lease_seconds=LEASE_SECONDS)
+        ran = await pool.run_pending()
+        await jobs.complete(db.jobs, crashed, "crashed-worker")
+        return job_id, ran, await db.jobs.find_one({"_id": job_id})
+
+    job_id, ran, job = asyncio.run(scenario())
+
+    assert ran == 1
+    assert outcomes[job_id] == ["finished"]
+    assert job["status"] == jobs.DONE
+    assert job["attempts"] == 2
+
+
+def test_failing_job_is_retried_then_dead_lettered_and_requeued(monkeypatch):
+    monkeypatch.setenv("JOB_MAX_ATTEMPTS", "3")
+    calls = []
+
+    async def broken(db, job):
+        calls.append(job["attempts"])
+        raise RuntimeError("upstream unavailable")
+
+    jobs.HANDLERS["broken"] = broken
+
+    async def scenario():
+        db = FakeDatabase()
+        pool = jobs.WorkerPool(db, concurrency=1, lease_seconds=LEASE_SECONDS)
+        job_id = await jobs.enqueue(db, "broken", {})
+        await pool.run_pending()
+        dead = await db.jobs.find_one({"_id": job_id})
+        requeued = await jobs.retry_dead(db.jobs)
+        return dead, requeued, await db.jobs.find_one({"_id": job_id})
+
+    dead, requeued, job = asyncio.run(scenario())
+
+    assert calls == [1, 2, 3]
+    assert dead["status"] == jobs.DEAD
+    assert dead["last_error"] == "RuntimeError: upstream unavailable"
+    assert "locked_by" not in dead
+    assert requeued == 1
+    assert job["status"] == jobs.QUEUED
+    assert job["attempts"] == 0
+
+
+def test_interrupted_job_is_released_without_using_an_attempt():
+    outcomes = {}
+    jobs.HANDLERS["slow"] = slow_handler(outcomes)
+
+    async def scenario():
+        db = FakeDatabase()
+        pool = jobs.WorkerPool(db, concurrency=1, lease_seconds=LEASE_SECONDS)
+        job_id = await jobs.enqueue(db, "slow", {"seconds": 5})
+        task = asyncio.create_task(pool.run_pending())
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return job_id, await db.jobs.find_one({"_id": job_id})
+
+    job_id, job = asyncio.run(scenario())
+
+    assert outcomes[job_id] == ["cancelled"]
+    assert job["status"] == jobs.QUEUED
+    assert job["attempts"] == 0
+    assert "locked_by" not in job
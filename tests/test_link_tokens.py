@@ -0,0 +1,62 @@
+"""Link token issue, expiry, revocation and backfill, on the in-memory fake database."""
+from datetime import datetime, timedelta, timezone
+import asyncio
+
+import link_tokens
+from fake_db import FakeDatabase
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_issued_token_resolves_for_its_purpose_only():
+    db = FakeDatabase()
+    run(link_tokens.issue_token(db.tokens, "t1", link_tokens.APPROVAL, "app-1"))
+
+    assert run(link_tokens.resolve_token(db.tokens, "t1", link_tokens.APPROVAL)) == "app-1"
+    assert run(link_tokens.resolve_token(db.tokens, "t1", link_tokens.DOCUMENT_UPLOAD)) is None
+    assert run(link_tokens.resolve_token(db.tokens, "other", link_tokens.APPROVAL)) is None
+
+
+def test_expired_token_does_not_resolve():
+    db = FakeDatabase()
+    issued_at = datetime.now(timezone.utc) - link_tokens.token_ttl(link_tokens.APPROVAL) - timedelta(seconds=1)
+    run(link_tokens.issue_token(db.tokens, "t1", link_tokens.APPROVAL, "app-1", issued_at))
+
+    assert run(link_tokens.resolve_token(db.tokens, "t1", link_tokens.APPROVAL)) is None
+
+
+def test_reissue_and_revoke():
+    db = FakeDatabase()
+    run(link_tokens.issue_token(db.tokens, "old", link_tokens.APPROVAL, "app-1"))
+    run(link_tokens.issue_token(db.tokens, "new", link_tokens.APPROVAL, "app-1"))
+    run(link_tokens.issue_token(db.tokens, "upload", link_tokens.DOCUMENT_UPLOAD, "app-1"))
+
+    assert run(link_tokens.resolve_token(db.tokens, "old", link_tokens.APPROVAL)) is None
+    assert run(link_tokens.resolve_token(db.tokens, "new", link_tokens.APPROVAL)) == "app-1"
+
+    run(link_tokens.revoke_tokens(db.tokens, "app-1", link_tokens.APPROVAL))
+
+    assert run(link_tokens.resolve_token(db.tokens, "new", link_tokens.APPROVAL)) is None
+    assert run(link_tokens.resolve_token(db.tokens, "upload", link_tokens.DOCUMENT_UPLOAD)) == "app-1"
+
+
+def test_backfill_indexes_only_live_links():
+    db = FakeDatabase()
+    run(link_tokens.ensure_indexes(db.tokens))
+    run(db.loan_applications.insert_many([
+        {"id": "approved", "status": "approved", "approval_token": "a1"},
+        {"id": "accepted", "status": "approved", "approval_token": "a2", "banking_info_submitted": True},
+        {"id": "rejected", "status": "rejected", "approval_token": "a3"},
+        {"id": "documents", "status": "documents_required", "document_upload_token": "d1"},
+        {"id": "reviewed", "status": "under_review", "document_upload_token": "d2"},
+    ]))
+
+    assert run(link_tokens.backfill(db, batch_size=1)) == 2
+    assert run(link_tokens.backfill(db)) == 0
+    assert run(link_tokens.resolve_token(db.tokens, "a1", link_tokens.APPROVAL)) == "approved"
+    assert run(link_tokens.resolve_token(db.tokens, "d1", link_tokens.DOCUMENT_UPLOAD)) == "documents"
+    for token in ("a2", "a3"):
+        assert run(link_tokens.resolve_token(db.tokens, token, link_tokens.APPROVAL)) is None
+    assert run(link_tokens.resolve_token(db.tokens, "d2", link_tokens.DOCUMENT_UPLOAD)) is None
@@ -0,0 +1,55 @@
+"""Backfilling the status history of applications that predate it, on the in-memory fake database."""
+from datetime import datetime, timezone
+import asyncio
+
+import status_transitions
+from fake_db import FakeDatabase
+
+CREATED_AT = "2025-01-01T00:00:00+00:00"
+
+
+def history(db, application_id):
+    events = asyncio.run(db[status_transitions.COLLECTION].find({"application_id": application_id}).to_list(None))
+    return {(event["from_status"], event["to_status"]) for event in events}
+
+
+async def change_status(db, application_id, to_status):
+    """A status change after the history began, as the API records it"""
+    application = await db.loan_applications.find_one({"id": application_id})
+    event = status_transitions.new_event(application, to_status, datetime.now(timezone.utc))
+    await db.loan_applications.update_one(
+        {"id": application_id},
+        {"$set": {"status": to_status, "status_changed_at": event["at"].isoformat()}},
+    )
+    await status_transitions.publish(db, application_id, [event])
+
+
+def test_backfill_covers_applications_changed_since_the_history_began():
+    db = FakeDatabase()
+    asyncio.run(status_transitions.ensure_indexes(db))
+    asyncio.run(db.loan_applications.insert_many([
+        {"id": "untouched", "created_at": CREATED_AT, "status": "pending"},
+        {"id": "approved-before", "created_at": CREATED_AT, "status": "approved"},
+        {"id": "reviewed-before", "created_at": CREATED_AT, "status": "under_review"},
+        {"id": "pending-before", "created_at": CREATED_AT, "status": "pending"},
+    ]))
+    asyncio.run(change_status(db, "reviewed-before", "approved"))
+    asyncio.run(change_status(db, "pending-before", "rejected"))
+
+    assert asyncio.run(status_transitions.backfill(db)) == 6
+
+    assert history(db, "untouched") == {(None, "pending")}
+    assert history(db, "approved-before") == {(None, "pending"), (None, "approved")}
+    # The status it had reached before its recorded change, not its current one
+    assert history(db, "reviewed-before") == {(None, "pending"), (None, "under_review"), ("under_review", "approved")}
+    assert history(db, "pending-before") == {(None, "pending"), ("pending", "rejected")}
+    assert asyncio.run(status_transitions.backfill(db)) == 0
+
+
+def test_backfill_skips_applications_still_publishing_their_creation():
+    db = FakeDatabase()
+    application = {"id": "new", "created_at": CREATED_AT, "status": "pending"}
+    event = status_transitions.creation_event(application)
+    asyncio.run(db.loan_applications.insert_one(dict(application, **{status_transitions.OUTBOX: [event]})))
+
+    assert asyncio.run(status_transitions.backfill(db)) == 0
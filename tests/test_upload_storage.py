@@ -0,0 +1,94 @@
+"""Content-addressed upload blobs: reference counting, deduplication and reclaiming, on the fake database."""
+import asyncio
+import hashlib
+
+import upload_storage
+from fake_db import FakeDatabase
+
+DATA = b"%PDF-1.4 statement"
+SHA256 = hashlib.sha256(DATA).hexdigest()
+
+
+def blob(db):
+    return asyncio.run(db[upload_storage.BLOB_COLLECTION].find_one({"_id": SHA256}))
+
+
+def test_identical_uploads_share_one_file(tmp_path):
+    db = FakeDatabase()
+
+    async def upload_twice():
+        return await asyncio.gather(*(upload_storage.add_reference(db, tmp_path, SHA256, DATA) for _ in range(2)))
+
+    assert asyncio.run(upload_twice()) == [SHA256, SHA256]
+    assert blob(db)["refs"] == 2
+    assert upload_storage.shard_path(tmp_path, SHA256).read_bytes() == DATA
+    assert [name for _, name, _ in asyncio.run(_stored_files(tmp_path))] == [SHA256]
+
+
+async def _stored_files(upload_dir):
+    return [entry async for entry in upload_storage.iter_stored_files(upload_dir)]
+
+
+def test_file_is_reclaimed_after_its_last_reference(tmp_path):
+    db = FakeDatabase()
+    path = upload_storage.shard_path(tmp_path, SHA256)
+    for _ in range(2):
+        asyncio.run(upload_storage.add_reference(db, tmp_path, SHA256, DATA))
+
+    asyncio.run(upload_storage.release_reference(db, SHA256))
+    assert blob(db)["refs"] == 1 and "released_at" not in blob(db)
+    assert asyncio.run(upload_storage.reclaim_released(db, tmp_path, 0)) == 0
+
+    asyncio.run(upload_storage.release_reference(db, SHA256))
+    assert "released_at" in blob(db)
+    # Still within the grace period
+    assert asyncio.run(upload_storage.reclaim_released(db, tmp_path, 3600)) == 0
+    assert path.exists()
+
+    assert asyncio.run(upload_storage.reclaim_released(db, tmp_path, 0)) == 1
+    assert not path.exists()
+    assert blob(db) is None
+
+
+def test_reference_after_release_keeps_the_file(tmp_path):
+    db = FakeDatabase()
+    asyncio.run(upload_storage.add_reference(db, tmp_path, SHA256, DATA))
+    asyncio.run(upload_storage.release_reference(db, SHA256))
+    asyncio.run(upload_storage.add_reference(db, tmp_path, SHA256, DATA))
+
+    assert asyncio.run(upload_storage.reclaim_released(db, tmp_path, 0)) == 0
+    assert blob(db)["refs"] == 1 and "released_at" not in blob(db)
+    assert upload_storage.shard_path(tmp_path, SHA256).exists()
+
+
+def test_content_is_written_again_after_reclaiming(tmp_path):
+    db = FakeDatabase()
+    asyncio.run(upload_storage.add_reference(db, tmp_path, SHA256, DATA))
+    asyncio.run(upload_storage.release_reference(db, SHA256))
+    asyncio.run(upload_storage.reclaim_released(db, tmp_path, 0))
+
+    asyncio.run(upload_storage.add_reference(db, tmp_path, SHA256, DATA))
+
+    assert blob(db)["refs"] == 1 and blob(db)["stored"]
+    assert upload_storage.shard_path(tmp_path, SHA256).read_bytes() == DATA
+
+
+def test_uniquely_named_files_are_not_counted(tmp_path):
+    db = FakeDatabase()
+    asyncio.run(upload_storage.release_reference(db, "app-1_3f2a.pdf"))
+
+    assert asyncio.run(db[upload_storage.BLOB_COLLECTION].count_documents({})) == 0
+
+
+def test_reclaimer_runs_without_the_orphan_sweep(tmp_path):
+    db = FakeDatabase()
+    asyncio.run(upload_storage.add_reference(db, tmp_path, SHA256, DATA))
+    asyncio.run(upload_storage.release_reference(db, SHA256))
+
+    async def run_briefly():
+        task = asyncio.create_task(upload_storage.run_reclaimer(db, tmp_path, 0, 10, 0.01))
+        await asyncio.sleep(0.2)
+        task.cancel()
+
+    asyncio.run(run_briefly())
+    assert not upload_storage.shard_path(tmp_path, SHA256).exists()
@@ -0,0 +1,33 @@
+"""Entry names of streamed document archives."""
+from datetime import datetime, timezone
+import asyncio
+import io
+import zipfile
+
+import zip_stream
+
+
+def archive_names(tmp_path, names):
+    path = tmp_path / "upload.pdf"
+    path.write_bytes(b"%PDF-1.4")
+    entries = [(path, name, datetime(2025, 1, 1, tzinfo=timezone.utc), 8) for name in names]
+
+    async def build():
+        return b"".join([chunk async for chunk in zip_stream.stream_zip(entries)])
+
+    return zipfile.ZipFile(io.BytesIO(asyncio.run(build()))).namelist()
+
+
+def test_names_are_reduced_to_base_names(tmp_path):
+    names = archive_names(tmp_path, [
+        "../../etc/cron.d/job", "/var/www/index.html", "C:\\Users\\me\\statement.pdf", "..\\..\\boot.ini",
+        "D:payslip.pdf", "pay\x00slip.pdf",
+    ])
+
+    assert names == ["job", "index.html", "statement.pdf", "boot.ini", "D_payslip.pdf", "pay_slip.pdf"]
+
+
+def test_empty_names_fall_back_and_duplicates_are_numbered(tmp_path):
+    names = archive_names(tmp_path, ["", "..", "uploads/", "statement.pdf", "a/statement.pdf"])
+
+    assert names == ["document", "document (2)", "document (3)", "statement.pdf", "statement (2).pdf"]